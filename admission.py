@@ -0,0 +1,178 @@
+"""Admission control shedding requests the server cannot serve in time.
+
+A request is answered with a fast "overloaded" failure instead of being
+queued when its client IP ran out of tokens, when too many requests are
+in flight or when too many cursors already wait for storage shards.
+
+Writes (POST) and reads (GET) may be prioritized: the other class only
+gets `1 - reserved_share` of the in-flight and queue limits, so the
+prioritized one is still admitted when the other fills the server.
+Monitoring routes are never shed.
+"""
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Callable
+
+from settings import (
+    DEFAULT_ADMISSION_IP_BURST,
+    DEFAULT_ADMISSION_IP_RATE,
+    DEFAULT_ADMISSION_MAX_IN_FLIGHT,
+    DEFAULT_ADMISSION_MAX_QUEUE_DEPTH,
+    DEFAULT_ADMISSION_PRIORITY,
+    DEFAULT_ADMISSION_RESERVED_SHARE,
+    DEFAULT_ADMISSION_RETRY_AFTER_SECS,
+)
+
+READS = "reads"
+WRITES = "writes"
+NONE = "none"
+PRIORITIES = (WRITES, READS, NONE)
+
+RATE = "rate"
+IN_FLIGHT = "in_flight"
+QUEUE = "queue"
+
+EXEMPT_PREFIXES = ("/metrics", "/admin/")
+MAX_BUCKETS = 10000
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        elapsed = now - self.updated
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """Takes a token, returns 0 or the seconds until one is available"""
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+@dataclass
+class Rejection:
+    reason: str
+    request_class: str
+    retry_after: float
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_in_flight: int = DEFAULT_ADMISSION_MAX_IN_FLIGHT,
+        max_queue_depth: int = DEFAULT_ADMISSION_MAX_QUEUE_DEPTH,
+        priority: str = DEFAULT_ADMISSION_PRIORITY,
+        reserved_share: float = DEFAULT_ADMISSION_RESERVED_SHARE,
+        ip_rate: float = DEFAULT_ADMISSION_IP_RATE,
+        ip_burst: float = DEFAULT_ADMISSION_IP_BURST,
+        retry_after_secs: float = DEFAULT_ADMISSION_RETRY_AFTER_SECS,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        if priority not in PRIORITIES:
+            raise ValueError(f"priority should be one of {PRIORITIES}")
+        self.max_in_flight = max_in_flight
+        self.max_queue_depth = max_queue_depth
+        self.priority = priority
+        self.reserved_share = reserved_share
+        self.ip_rate = ip_rate
+        self.ip_burst = ip_burst or max(ip_rate, 1)
+        self.retry_after_secs = retry_after_secs
+        self.clock = clock
+        self.in_flight = 0
+        self.buckets: dict[str, TokenBucket] = {}
+        self.admitted = Counter()
+        self.shed = Counter()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_in_flight or self.max_queue_depth or self.ip_rate)
+
+    @staticmethod
+    def request_class(method: str) -> str:
+        return WRITES if method == "POST" else READS
+
+    def limit(self, limit: int, request_class: str) -> float:
+        """The whole limit for the prioritized class, less for the other"""
+        if self.priority in (request_class, NONE):
+            return limit
+        return limit * (1 - self.reserved_share)
+
+    def bucket(self, host: str, now: float) -> TokenBucket:
+        if (bucket := self.buckets.get(host)) is None:
+            if len(self.buckets) >= MAX_BUCKETS:
+                self.evict_full_buckets(now)
+            bucket = self.buckets[host] = TokenBucket(
+                self.ip_rate, self.ip_burst, now
+            )
+        return bucket
+
+    def evict_full_buckets(self, now: float) -> None:
+        """Forgets hosts idle long enough to have a full bucket again"""
+        for host, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[host]
+
+    def check(
+        self, request_class: str, host: str, queue_depth: int
+    ) -> Rejection | None:
+        if self.ip_rate:
+            now = self.clock()
+            if wait := self.bucket(host, now).take(now):
+                return Rejection(RATE, request_class, wait)
+        if self.max_in_flight and self.in_flight >= self.limit(
+            self.max_in_flight, request_class
+        ):
+            return Rejection(IN_FLIGHT, request_class, self.retry_after_secs)
+        if self.max_queue_depth and queue_depth >= self.limit(
+            self.max_queue_depth, request_class
+        ):
+            return Rejection(QUEUE, request_class, self.retry_after_secs)
+        return None
+
+    def admit(
+        self, method: str, url: str, host: str, queue_depth: int
+    ) -> Rejection | None:
+        """Returns why the request is shed, or None and counts it in flight
+
+        Every admitted request must be released when it is answered.
+        """
+        request_class = self.request_class(method)
+        if not url.startswith(EXEMPT_PREFIXES):
+            if rejection := self.check(request_class, host, queue_depth):
+                self.shed[rejection.reason, request_class] += 1
+                return rejection
+        self.admitted[request_class] += 1
+        self.in_flight += 1
+        return None
+
+    def release(self) -> None:
+        self.in_flight -= 1
+
+    def stats(self, queue_depth: int) -> dict:
+        return dict(
+            in_flight=self.in_flight,
+            queue_depth=queue_depth,
+            max_in_flight=self.max_in_flight,
+            max_queue_depth=self.max_queue_depth,
+            priority=self.priority,
+            ip_rate=self.ip_rate,
+            ip_burst=self.ip_burst,
+            tracked_ips=len(self.buckets),
+            admitted=dict(self.admitted),
+            shed={
+                f"{reason}/{request_class}": count
+                for (reason, request_class), count in self.shed.items()
+            },
+        )
@@ -0,0 +1,692 @@
+"""Streaming export and bulk import of a whole chat storage.
+
+An archive lists a storage record by record: the default chat id, users,
+chats with their members, the messages of every chat oldest first and
+complaints. NDJSON archives hold a JSON document per line:
+
+    {"storage": {"default_chat_id": "..."}}
+    {"user": {"id": "...", "banned_when": null, ...}}
+    {"chat": {"id": "...", "name": "default", "type": "common", ...}}
+    {"message": {"chat_id": "...", "id": "...", "created": "...", ...}}
+    {"complaint": {"id": "...", "author": "...", ...}}
+
+Binary archives hold pickled batches of rows of plain values, ids as
+ints and times as ISO strings, and load several times faster. Loading
+one never builds objects other than those rows.
+
+Exporting reads users, chats, complaints and the timeline of every chat
+in slices of `BATCH_ROWS`, each under a cursor of its own, and yields to
+the event loop between them, so a running server keeps serving and
+memory does not grow with the storage. Importing builds chats aside and
+stores each once all its messages are read, so timelines, membership,
+presence and retention indexes are built once per chat, not per message.
+
+A running server started with `--archive-dir` writes an archive of its
+storage on `POST /admin/archive`, which the `export` command sends.
+
+Usage:
+    python archive.py export --port 8001 --format ndjson
+    python archive.py generate seed.bin --users 100000 --messages 10000000
+    python archive.py load seed.bin
+    python archive.py convert seed.bin seed.ndjson
+"""
+import argparse
+import asyncio
+import bisect
+import gc
+import heapq
+import io
+import json
+import os
+import pickle
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import chain, islice
+from operator import attrgetter
+from typing import IO, Any, AsyncIterator, Callable, Iterable, Iterator
+
+import utils
+from client import AsyncClient
+from constants import ChatType
+from db import (
+    Chat,
+    ChatStorage,
+    ChatStorageCursor,
+    Complaint,
+    DbEncoder,
+    Message,
+    PeerToPeerChat,
+    User,
+    timeline_key,
+)
+from settings import DEFAULT_HOST, DEFAULT_PORT
+
+NDJSON = "ndjson"
+BINARY = "binary"
+FORMATS = (NDJSON, BINARY)
+EXTENSIONS = {".ndjson": NDJSON, ".jsonl": NDJSON, ".bin": BINARY}
+SUFFIXES = {NDJSON: ".ndjson", BINARY: ".bin"}
+BINARY_MAGIC = b"YACHAT-ARCHIVE-1\n"
+
+STORAGE = "storage"
+USER = "user"
+CHAT = "chat"
+MESSAGE = "message"
+COMPLAINT = "complaint"
+
+BATCH_ROWS = 10000
+ADMIN_ARCHIVE_URL = "/admin/archive"
+
+
+def detect_format(path: str) -> str:
+    extension = os.path.splitext(path)[1]
+    if extension not in EXTENSIONS:
+        raise ValueError(f"Unknown archive extension {extension!r}")
+    return EXTENSIONS[extension]
+
+
+def load_time(value: str | None) -> datetime | None:
+    return None if value is None else datetime.fromisoformat(value)
+
+
+def dump_time(value: datetime | None) -> str | None:
+    return None if value is None else value.isoformat()
+
+
+def int_or_none(value: uuid.UUID | None) -> int | None:
+    return None if value is None else value.int
+
+
+def uuid_or_none(value: int | None) -> uuid.UUID | None:
+    return None if value is None else uuid.UUID(int=value)
+
+
+def timeline_slice(
+    chat: Chat, after: tuple | None, size: int
+) -> tuple[tuple | None, list[Message]]:
+    """Up to `size` timeline entries following the key `after`
+
+    Returns the key to resume from, None past the end, and the messages
+    among the entries that are not deleted. Keys stay valid while the
+    timeline changes in between.
+    """
+    start = 0
+    if after is not None:
+        start = bisect.bisect_right(chat.timeline, after, key=timeline_key)
+    entries = chat.timeline[start:start + size]
+    if not entries:
+        return None, []
+    return timeline_key(entries[-1]), [
+        message
+        for message in entries
+        if chat.messages.get(message.id) is message
+    ]
+
+
+class NdjsonWriter:
+    def __init__(self, file: IO[bytes]) -> None:
+        self.file = io.TextIOWrapper(file, encoding="utf-8", newline="\n")
+        self.encoder = DbEncoder(separators=(",", ":"))
+
+    def write(self, kind: str, data: Any) -> None:
+        self.file.write(self.encoder.encode({kind: data}))
+        self.file.write("\n")
+
+    def storage(self, default_chat_id: str | None) -> None:
+        self.write(STORAGE, {"default_chat_id": default_chat_id})
+
+    def user(self, user: User) -> None:
+        self.write(USER, user)
+
+    def chat(self, chat: Chat) -> None:
+        self.write(
+            CHAT,
+            {
+                "id": chat.id,
+                "name": chat.name,
+                "type": chat.type,
+                "authors": chat.authors,
+            },
+        )
+
+    def messages(self, chat: Chat, messages: list[Message]) -> None:
+        for message in messages:
+            self.write(MESSAGE, dict(message.serialize(), chat_id=chat.id))
+
+    def complaint(self, complaint: Complaint) -> None:
+        self.write(COMPLAINT, complaint)
+
+    def close(self) -> None:
+        self.file.detach()
+
+
+class BinaryWriter:
+    """Batches of rows, pickled as `(kind, key, rows)` frames"""
+
+    def __init__(self, file: IO[bytes]) -> None:
+        self.file = file
+        self.file.write(BINARY_MAGIC)
+        self.kind, self.key, self.rows = None, None, []
+
+    def frame(self, kind: str, key: Any = None) -> None:
+        if (kind, key) != (self.kind, self.key) or (
+            len(self.rows) >= BATCH_ROWS
+        ):
+            self.flush()
+            self.kind, self.key = kind, key
+
+    def flush(self) -> None:
+        if self.rows:
+            pickle.dump(
+                (self.kind, self.key, self.rows),
+                self.file,
+                pickle.HIGHEST_PROTOCOL,
+            )
+        self.rows = []
+
+    def storage(self, default_chat_id: str | None) -> None:
+        self.frame(STORAGE)
+        self.rows.append(default_chat_id)
+
+    def user(self, user: User) -> None:
+        self.frame(USER)
+        self.rows.append(
+            (
+                user.id.int,
+                dump_time(user.banned_when),
+                user.is_banned,
+                user.reported_times,
+            )
+        )
+
+    def chat(self, chat: Chat) -> None:
+        self.frame(CHAT)
+        self.rows.append(
+            (
+                chat.id.int,
+                chat.name,
+                chat.type.value,
+                [author.int for author in chat.authors],
+            )
+        )
+
+    def messages(self, chat: Chat, messages: list[Message]) -> None:
+        for message in messages:
+            self.frame(MESSAGE, chat.id.int)
+            self.rows.append(
+                (
+                    message.id.int,
+                    message.created.isoformat(),
+                    message.author.int,
+                    message.text,
+                    int_or_none(message.is_comment_on),
+                    dump_time(message.expires),
+                )
+            )
+
+    def complaint(self, complaint: Complaint) -> None:
+        self.frame(COMPLAINT)
+        self.rows.append(
+            (
+                complaint.id.int,
+                complaint.author.int,
+                dump_time(complaint.created),
+                complaint.reported_user.int,
+                complaint.reason,
+                complaint.reviewed,
+            )
+        )
+
+    def close(self) -> None:
+        self.flush()
+
+
+WRITERS = {NDJSON: NdjsonWriter, BINARY: BinaryWriter}
+
+
+class RowUnpickler(pickle.Unpickler):
+    """Loads plain values only, an archive cannot name code to run"""
+
+    def find_class(self, module: str, name: str) -> Any:
+        raise pickle.UnpicklingError(f"Archive refers to {module}.{name}")
+
+
+def new_chat(pk: uuid.UUID, name: str, kind: str, authors: set) -> Chat:
+    chat_class = PeerToPeerChat if kind == ChatType.PRIVATE else Chat
+    return chat_class(id=pk, name=name, authors=authors)
+
+
+def read_ndjson(file: IO[bytes]) -> Iterator[tuple[str, Any]]:
+    """Records of an NDJSON archive as `(kind, object)` pairs"""
+    for line in file:
+        if not line.strip():
+            continue
+        ((kind, data),) = json.loads(line).items()
+        if kind == MESSAGE:
+            yield kind, (uuid.UUID(data["chat_id"]), [Message.load(data)])
+        elif kind == USER:
+            yield kind, User.load(data)
+        elif kind == CHAT:
+            yield kind, new_chat(
+                uuid.UUID(data["id"]),
+                data["name"],
+                data.get("type"),
+                set(map(uuid.UUID, data.get("authors", ()))),
+            )
+        elif kind == COMPLAINT:
+            yield kind, Complaint.load(data)
+        elif kind == STORAGE:
+            yield kind, data.get("default_chat_id")
+        else:
+            raise ValueError(f"Unknown archive record {kind!r}")
+
+
+class Authors(dict):
+    """User ids by their ints, built once per user"""
+
+    def __missing__(self, pk: int) -> uuid.UUID:
+        author = self[pk] = uuid.UUID(int=pk)
+        return author
+
+
+class BinaryReader:
+    """Objects of the frames of a binary archive
+
+    Messages come in batches of a chat as `(chat_id, messages)`.
+    """
+
+    def __init__(self, file: IO[bytes]) -> None:
+        if file.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError("Not a binary archive")
+        self.unpickler = RowUnpickler(file)
+        # authors write many messages, their ids are shared
+        self.authors = Authors()
+
+    def __iter__(self) -> Iterator[tuple[str, Any]]:
+        while True:
+            try:
+                kind, key, rows = self.unpickler.load()
+            except EOFError:
+                return
+            if kind == MESSAGE:
+                yield kind, (uuid.UUID(int=key), self.messages(rows))
+            elif kind in (USER, CHAT, COMPLAINT, STORAGE):
+                for item in getattr(self, kind)(rows):
+                    yield kind, item
+            else:
+                raise ValueError(f"Unknown archive record {kind!r}")
+
+    def messages(self, rows: list[tuple]) -> list[Message]:
+        new_id, authors = uuid.UUID, self.authors
+        load_created = datetime.fromisoformat
+        return [
+            Message(
+                new_id(int=pk),
+                load_created(created),
+                authors[author_id],
+                text,
+                uuid_or_none(comment_on),
+                load_time(expires),
+            )
+            for pk, created, author_id, text, comment_on, expires in rows
+        ]
+
+    def user(self, rows: list[tuple]) -> Iterator[User]:
+        for pk, banned_when, is_banned, reported_times in rows:
+            yield User(
+                uuid.UUID(int=pk),
+                load_time(banned_when),
+                is_banned,
+                reported_times,
+            )
+
+    def chat(self, rows: list[tuple]) -> Iterator[Chat]:
+        for pk, name, chat_type, members in rows:
+            yield new_chat(
+                uuid.UUID(int=pk),
+                name,
+                chat_type,
+                set(map(self.authors.__getitem__, members)),
+            )
+
+    def complaint(self, rows: list[tuple]) -> Iterator[Complaint]:
+        for pk, author, created, reported, reason, reviewed in rows:
+            yield Complaint(
+                uuid.UUID(int=pk),
+                self.authors[author],
+                load_time(created),
+                self.authors[reported],
+                reason,
+                reviewed,
+            )
+
+    def storage(self, rows: list) -> Iterator[str | None]:
+        yield from rows
+
+
+READERS = {NDJSON: read_ndjson, BINARY: BinaryReader}
+
+
+def write_records(
+    writer: NdjsonWriter | BinaryWriter, records: Iterable[tuple[str, Any]]
+) -> dict[str, int]:
+    """Writes records as read from an archive, to convert its format"""
+    counts = dict.fromkeys((USER, CHAT, MESSAGE, COMPLAINT), 0)
+    for kind, data in records:
+        if kind == MESSAGE:
+            chat_id, messages = data
+            # writers only read the id of the chat
+            writer.messages(Chat(id=chat_id, name=""), messages)
+            counts[kind] += len(messages)
+            continue
+        getattr(writer, kind)(data)
+        if kind in counts:
+            counts[kind] += 1
+    writer.close()
+    return counts
+
+
+def shard_values(name: str) -> Callable[[ChatStorageCursor], Iterator]:
+    """Values of a storage dict in the shards held by a cursor"""
+
+    def values(cursor: ChatStorageCursor) -> Iterator:
+        return chain.from_iterable(
+            getattr(shard, name).values() for shard in cursor.held_shards()
+        )
+
+    return values
+
+
+def chats_in_order(cursor: ChatStorageCursor) -> Iterator[Chat]:
+    """Chats of the held shards in the order they were created"""
+    return heapq.merge(
+        *(shard.chats.values() for shard in cursor.held_shards()),
+        key=attrgetter("sequence"),
+    )
+
+
+async def slices(
+    storage: ChatStorage, items: Callable[[ChatStorageCursor], Iterable]
+) -> AsyncIterator[list]:
+    """Items in slices of `BATCH_ROWS`, each read under a cursor of its own
+
+    Reading goes on where the previous slice stopped. Should the storage
+    change size in between, reading starts over past the items read.
+    """
+    iterator, offset = None, 0
+    while True:
+        cursor = await storage.connect()
+        try:
+            if iterator is None:
+                iterator = iter(items(cursor))
+            try:
+                batch = list(islice(iterator, BATCH_ROWS))
+            except RuntimeError:
+                iterator = islice(items(cursor), offset, None)
+                batch = list(islice(iterator, BATCH_ROWS))
+        finally:
+            cursor.disconnect()
+        if not batch:
+            return
+        offset += len(batch)
+        yield batch
+        await asyncio.sleep(0)
+
+
+async def export_chat(
+    storage: ChatStorage,
+    chat_id: uuid.UUID,
+    writer: NdjsonWriter | BinaryWriter,
+) -> int | None:
+    """Writes a chat and its messages, returns the count of messages
+
+    None stands for a chat deleted before it was written.
+    """
+    count, after, started = 0, None, False
+    while not started or after is not None:
+        cursor = await storage.connect(chat_id)
+        try:
+            if (chat := cursor.get_chat(chat_id)) is None:
+                break
+            if not started:
+                writer.chat(chat)
+                started = True
+            after, messages = timeline_slice(chat, after, BATCH_ROWS)
+        finally:
+            cursor.disconnect()
+        writer.messages(chat, messages)
+        count += len(messages)
+        await asyncio.sleep(0)
+    return count if started else None
+
+
+async def export_storage(
+    storage: ChatStorage, file: IO[bytes], fmt: str = BINARY
+) -> dict[str, int]:
+    """Streams the storage to an open binary file, returns record counts
+
+    Cursors are held for a slice of records at a time, the storage keeps
+    changing meanwhile. Records added while the export runs may or may
+    not make it into the archive.
+    """
+    writer = WRITERS[fmt](file)
+    counts = dict.fromkeys((USER, CHAT, MESSAGE, COMPLAINT), 0)
+    writer.storage(getattr(storage, "default_chat_id", None))
+    async for users in slices(storage, shard_values("users")):
+        for user in users:
+            writer.user(user)
+        counts[USER] += len(users)
+    async for chats in slices(storage, chats_in_order):
+        for chat in chats:
+            if (count := await export_chat(storage, chat.id, writer)) is None:
+                continue
+            counts[CHAT] += 1
+            counts[MESSAGE] += count
+    async for complaints in slices(storage, shard_values("complaints")):
+        for complaint in complaints:
+            writer.complaint(complaint)
+        counts[COMPLAINT] += len(complaints)
+    writer.close()
+    return counts
+
+
+@contextmanager
+def paused_gc() -> Iterator[None]:
+    """Stops cyclic garbage collection for a while
+
+    Loaded objects form no cycles, yet every few thousand of them start
+    a collection that walks all the objects allocated so far.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def import_storage(
+    cursor: ChatStorageCursor, file: IO[bytes], fmt: str = BINARY
+) -> dict[str, int]:
+    """Bulk loads an archive through a cursor holding every shard
+
+    Messages go straight into the chats they belong to, which are stored
+    after the whole archive is read. Storing a chat builds its timeline
+    and the storage indexes once.
+    """
+    with paused_gc():
+        return store_records(cursor, READERS[fmt](file))
+
+
+def store_records(
+    cursor: ChatStorageCursor, records: Iterable[tuple[str, Any]]
+) -> dict[str, int]:
+    counts = dict.fromkeys((USER, CHAT, MESSAGE, COMPLAINT), 0)
+    chats: dict[uuid.UUID, Chat] = {}
+    for kind, data in records:
+        if kind == MESSAGE:
+            chat_id, messages = data
+            chats[chat_id].messages.update(
+                (message.id, message) for message in messages
+            )
+            counts[kind] += len(messages)
+            continue
+        if kind == CHAT:
+            chats[data.id] = data
+        elif kind == USER:
+            cursor.add_user(data)
+        elif kind == COMPLAINT:
+            cursor.add_complaint(data)
+        elif kind == STORAGE and data is not None:
+            cursor.db.default_chat_id = data
+        if kind in counts:
+            counts[kind] += 1
+    for chat in chats.values():
+        # a loaded chat starts a new incarnation with a fresh timeline
+        chat.invalidate()
+        cursor.add_chat(chat)
+    return counts
+
+
+def generate(
+    writer: NdjsonWriter | BinaryWriter,
+    users: int,
+    chats: int,
+    messages: int,
+) -> dict[str, int]:
+    """Writes a synthetic storage for benchmarks, without holding it
+
+    Every user is in the default chat, which gets half of the messages,
+    the rest are spread over private chats of consecutive users.
+    """
+    user_ids = [uuid.uuid4() for _ in range(max(users, 2))]
+    default_chat = Chat(id=uuid.uuid4(), name="default", authors=set(user_ids))
+    writer.storage(str(default_chat.id))
+    for user_id in user_ids:
+        writer.user(User(user_id))
+    private_chats = [
+        PeerToPeerChat(
+            id=uuid.uuid4(),
+            name="p2p",
+            authors={user_ids[number], user_ids[number - 1]},
+        )
+        for number in range(1, min(chats, len(user_ids)))
+    ]
+    created = utils.now() - timedelta(days=1)
+    shares = [(default_chat, messages - messages // 2)]
+    for number, chat in enumerate(private_chats):
+        share = messages // 2 // len(private_chats)
+        if number < messages // 2 % len(private_chats):
+            share += 1
+        shares.append((chat, share))
+    written = 0
+    for chat, share in shares:
+        writer.chat(chat)
+        authors = sorted(chat.authors)
+        for start in range(0, share, BATCH_ROWS):
+            batch = [
+                Message(
+                    uuid.uuid4(),
+                    created + timedelta(microseconds=written + number),
+                    authors[number % len(authors)],
+                    f"message {written + number}",
+                )
+                for number in range(min(BATCH_ROWS, share - start))
+            ]
+            writer.messages(chat, batch)
+            written += len(batch)
+    writer.close()
+    return {
+        USER: len(user_ids),
+        CHAT: len(shares),
+        MESSAGE: written,
+        COMPLAINT: 0,
+    }
+
+
+def summarize(counts: dict[str, int]) -> str:
+    return ", ".join(f"{count} {kind}s" for kind, count in counts.items())
+
+
+async def export_file(
+    storage: ChatStorage, path: str, fmt: str | None = None
+) -> dict[str, int]:
+    """Streams the storage to a file, the format is told by its extension"""
+    with open(path, "wb") as file:
+        return await export_storage(storage, file, fmt or detect_format(path))
+
+
+async def load_file(
+    storage: ChatStorage, path: str, fmt: str | None = None
+) -> dict[str, int]:
+    """Bulk loads an archive file, the format is told by its extension"""
+    cursor = await storage.connect()
+    try:
+        with open(path, "rb") as file:
+            return import_storage(cursor, file, fmt or detect_format(path))
+    finally:
+        cursor.disconnect()
+
+
+async def request_export(host: str, port: int, fmt: str) -> dict:
+    # an export takes as long as the storage is large
+    client = AsyncClient(server_host=host, server_port=port, timeout=None)
+    return json.loads(
+        await client.post(ADMIN_ARCHIVE_URL, data={"format": fmt})
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--format", choices=FORMATS, help="by extension")
+    commands = parser.add_subparsers(dest="command", required=True)
+    generating = commands.add_parser("generate", help="write synthetic data")
+    generating.add_argument("output")
+    generating.add_argument("--users", type=int, default=1000)
+    generating.add_argument("--chats", type=int, default=100)
+    generating.add_argument("--messages", type=int, default=100_000)
+    exporting = commands.add_parser(
+        "export", help="have a running server write an archive"
+    )
+    exporting.add_argument("--host", default=DEFAULT_HOST)
+    exporting.add_argument("--port", type=int, default=DEFAULT_PORT)
+    loading = commands.add_parser("load", help="time loading an archive")
+    loading.add_argument("input")
+    converting = commands.add_parser("convert", help="change the format")
+    converting.add_argument("input")
+    converting.add_argument("output")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.command == "export":
+        response = asyncio.run(
+            request_export(args.host, args.port, args.format or BINARY)
+        )
+        if "fail" in response:
+            parser.exit(1, f"{response['fail']}\n")
+        print(f"{response.pop('path')}:", end=" ")
+        counts = response
+    elif args.command == "generate":
+        with open(args.output, "wb") as file:
+            writer = WRITERS[args.format or detect_format(args.output)](file)
+            counts = generate(writer, args.users, args.chats, args.messages)
+    elif args.command == "load":
+        fmt = args.format or detect_format(args.input)
+        counts = asyncio.run(load_file(ChatStorage(), args.input, fmt))
+    else:
+        with open(args.input, "rb") as source:
+            with open(args.output, "wb") as target:
+                records = READERS[detect_format(args.input)](source)
+                writer = WRITERS[args.format or detect_format(args.output)]
+                counts = write_records(writer(target), records)
+    print(f"{summarize(counts)} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
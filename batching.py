@@ -0,0 +1,83 @@
+"""Coalescing of concurrent calls into batches.
+
+Items submitted while a batch is open are applied together once the
+batch is full or its delay has passed, so a burst of writes pays for
+one storage acquisition instead of one per request. Every caller still
+gets its own result or exception, in arrival order.
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+
+class Batcher:
+    """Applies submitted items in batches of up to `max_size`
+
+    `apply` receives the items of a batch and returns a result or an
+    exception for each of them.
+    """
+
+    def __init__(
+        self,
+        apply: Callable[[list], Awaitable[list]],
+        max_size: int,
+        max_delay_secs: float,
+    ) -> None:
+        self.apply = apply
+        self.max_size = max_size
+        self.max_delay_secs = max_delay_secs
+        self.pending: list[tuple[Any, asyncio.Future]] = []
+        self.timer: asyncio.TimerHandle | asyncio.Handle | None = None
+        self.tasks: set[asyncio.Task] = set()
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            # without a delay the batch still collects the current tick
+            self.timer = (
+                loop.call_later(self.max_delay_secs, self.flush)
+                if self.max_delay_secs
+                else loop.call_soon(self.flush)
+            )
+        return await future
+
+    def flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        task = asyncio.get_running_loop().create_task(self.run(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, batch: list[tuple[Any, asyncio.Future]]) -> None:
+        self.batches += 1
+        self.items += len(batch)
+        logger.debug("Applying a batch of %d", len(batch))
+        try:
+            try:
+                results = await self.apply([item for item, _ in batch])
+            except Exception as error:
+                results = [error] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        finally:
+            # a cancelled batch must not leave its callers waiting
+            for _, future in batch:
+                if not future.done():
+                    future.cancel()
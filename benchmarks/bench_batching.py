@@ -0,0 +1,91 @@
+"""Write throughput of /send with and without micro-batching.
+
+Messages are offered to an in-process server at fixed rates (open loop),
+so the numbers show how many writes the handlers sustain and at what
+latency, without the client and socket costs of `bench_server`. Once the
+offered rate passes what the server sustains, the achieved throughput
+levels off and latencies grow with the backlog.
+
+Usage:
+    python -m benchmarks.bench_batching --rates 1000 10000 50000 \\
+        --output batching.json
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from benchmarks import harness
+from server import Server
+from settings import DEFAULT_SEND_BATCH_DELAY_SECS, DEFAULT_SEND_BATCH_SIZE
+
+DEFAULT_RATES = [1000, 5000, 10000, 20000, 50000]
+USERS = 100
+TICK_SECS = 0.001
+
+
+async def offer(
+    server: Server, rate: int, duration: float
+) -> tuple[list[float], float]:
+    """Sends `rate` messages a second for `duration`, timing each one"""
+    users = [(await server.register({}))["token"] for _ in range(USERS)]
+    bodies = [
+        json.dumps(dict(author_id=user, message="benchmark message"))
+        for user in users
+    ]
+    latencies = []
+
+    async def send(body: str, scheduled: float) -> None:
+        await server.parse("POST", "/send", body)
+        latencies.append(time.perf_counter() - scheduled)
+
+    tasks = []
+    started = time.perf_counter()
+    sent = 0
+    while (elapsed := time.perf_counter() - started) < duration:
+        due = int(elapsed * rate)
+        for number in range(sent, due):
+            scheduled = started + number / rate
+            body = bodies[number % len(bodies)]
+            tasks.append(asyncio.ensure_future(send(body, scheduled)))
+        sent = due
+        await asyncio.sleep(TICK_SECS)
+    await asyncio.gather(*tasks)
+    return latencies, time.perf_counter() - started
+
+
+def run(
+    rates: list[int], duration: float, batch_size: int, delay: float
+) -> dict[str, dict]:
+    results = {}
+    for rate in rates:
+        for name, size in (("unbatched", 1), ("batched", batch_size)):
+            server = Server(send_batch_size=size, send_batch_delay_secs=delay)
+            latencies, elapsed = asyncio.run(offer(server, rate, duration))
+            results[f"batching/{name}[{rate}]"] = harness.summarize(
+                latencies, elapsed
+            )
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rates", type=int, nargs="+", default=DEFAULT_RATES)
+    parser.add_argument("--duration", type=float, default=2)
+    parser.add_argument(
+        "--batch-size", type=int, default=DEFAULT_SEND_BATCH_SIZE
+    )
+    parser.add_argument(
+        "--delay", type=float, default=DEFAULT_SEND_BATCH_DELAY_SECS
+    )
+    parser.add_argument("--output", help="write results to a JSON file")
+    args = parser.parse_args()
+
+    results = run(args.rates, args.duration, args.batch_size, args.delay)
+    harness.report(results)
+    if args.output:
+        harness.save(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""CPU vs bandwidth trade-off of response compression.
+
+Usage:
+    python -m benchmarks.bench_compression --chats 10 --messages 200
+"""
+import argparse
+import time
+import uuid
+
+import compression
+import utils
+from db import Chat, Message
+
+LEVELS = {
+    compression.DEFLATE: (1, 6, 9),
+    compression.ZSTD: (1, 3, 10),
+}
+BANDWIDTHS_MBIT = (10, 100, 1000)
+
+
+def build_payload(chats: int, messages: int) -> bytes:
+    """Builds a `/chats` response body of the given shape"""
+    author = uuid.uuid4()
+    objects = []
+    for _ in range(chats):
+        chat = Chat(id=uuid.uuid4(), name="bench", authors={author})
+        for number in range(messages):
+            chat.add_message(
+                Message(uuid.uuid4(), utils.now(), author, f"message {number}")
+            )
+        objects.append(chat.serialize(messages))
+    return utils.serialize({"chats": objects}).encode()
+
+
+def measure(
+    payload: bytes, encoding: str, level: int | None, chunk_size: int
+) -> tuple[float, int]:
+    started = time.perf_counter()
+    chunks = compression.split(payload, chunk_size)
+    size = sum(
+        map(len, compression.compress_stream(chunks, encoding, level))
+    )
+    return time.perf_counter() - started, size
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--chunk-size", type=int, default=2**14)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    payload = build_payload(args.chats, args.messages)
+    print(f"payload: {len(payload)} bytes")
+    header = ["encoding", "level", "cpu ms", "bytes", "ratio"]
+    header += [f"total ms @{mbit}Mbit" for mbit in BANDWIDTHS_MBIT]
+    print(" | ".join(header))
+
+    candidates = [(compression.IDENTITY, None)]
+    for encoding in compression.available_encodings():
+        candidates += [(encoding, level) for level in LEVELS[encoding]]
+    for encoding, level in candidates:
+        cpu, size = min(
+            measure(payload, encoding, level, args.chunk_size)
+            for _ in range(args.repeat)
+        )
+        transfer = [size * 8 / (mbit * 10**6) for mbit in BANDWIDTHS_MBIT]
+        row = [encoding, str(level), f"{cpu * 1000:.2f}", str(size)]
+        row.append(f"{len(payload) / size:.1f}")
+        row += [f"{(cpu + secs) * 1000:.2f}" for secs in transfer]
+        print(" | ".join(row))
+
+
+if __name__ == "__main__":
+    main()
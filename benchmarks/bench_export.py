@@ -0,0 +1,112 @@
+"""Peak memory and event loop lag of streaming a large chat history.
+
+Lag is the delay of a task waking every millisecond on the loop of the
+server while the history is streamed, in a pass of its own. Without
+offloading the history is encoded on that loop.
+
+Usage:
+    python -m benchmarks.bench_export --messages 100000 --offload-workers 2
+    python -m benchmarks.bench_export --offload-workers 0
+"""
+import argparse
+import asyncio
+import json
+import time
+import tracemalloc
+import uuid
+
+import utils
+from client import ChatClient
+from db import Message
+from server import Server
+from settings import DEFAULT_OFFLOAD_WORKERS
+
+LAG_PROBE_SECS = 0.001
+
+
+async def populate(server: Server, messages: int) -> tuple[str, str]:
+    cursor = await server.database.connect()
+    try:
+        user_id = cursor.create_user()
+        chat = cursor.get_chat(cursor.get_default_chat_id())
+        chat.enter(cursor.get_user(user_id))
+        author = uuid.UUID(user_id)
+        for number in range(messages):
+            chat.add_message(
+                Message(uuid.uuid4(), utils.now(), author, f"message {number}")
+            )
+        return user_id, str(chat.id)
+    finally:
+        cursor.disconnect()
+
+
+async def probe_lag(lags: list[float]) -> None:
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LAG_PROBE_SECS)
+        lags.append(time.perf_counter() - started - LAG_PROBE_SECS)
+
+
+async def export(
+    port: int, messages: int, encodings: list[str], offload_workers: int
+) -> None:
+    server = Server(port=port, offload_workers=offload_workers)
+    user_id, chat_id = await populate(server, messages)
+    if server.offloader is not None:
+        await server.offloader.start()
+    listener = asyncio.create_task(server.listen())
+    await asyncio.sleep(0.1)
+
+    client = ChatClient(server_port=port, encodings=encodings)
+    body = json.dumps(
+        dict(user_id=user_id, chat_id=chat_id, msg_count=messages)
+    )
+
+    # lag is measured apart, tracing slows every allocation down
+    lags = []
+    prober = asyncio.create_task(probe_lag(lags))
+    async for _ in client.stream(f"GET /chats {body}"):
+        pass
+    prober.cancel()
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    received = 0
+    async for text in client.stream(f"GET /chats {body}"):
+        received += len(text)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    listener.cancel()
+    if server.offloader is not None:
+        await server.offloader.shutdown()
+
+    print(f"messages: {messages}, encodings: {encodings or ['identity']}")
+    print(f"received: {received} chars in {elapsed:.2f}s")
+    print(f"peak traced memory while streaming: {peak / 2**20:.1f} MiB")
+    lags.sort()
+    print(
+        f"event loop lag, offload workers {offload_workers}: "
+        f"p50 {lags[len(lags) // 2] * 1000:.1f} ms, "
+        f"max {lags[-1] * 1000:.1f} ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--encoding", action="append", default=[])
+    parser.add_argument(
+        "--offload-workers", type=int, default=DEFAULT_OFFLOAD_WORKERS
+    )
+    args = parser.parse_args()
+    asyncio.run(
+        export(
+            args.port, args.messages, args.encoding, args.offload_workers
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
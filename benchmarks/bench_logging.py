@@ -0,0 +1,71 @@
+"""Requests/sec of the server under different logging modes.
+
+Starts `server.py` once per mode with its log written to a temporary file
+and drives it with concurrent clients requesting `/status`.
+
+Usage:
+    python -m benchmarks.bench_logging --duration 10
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_workers import drive, wait_for_port
+
+MODES = {
+    "off": ["--log-level", "WARNING"],
+    "sync": ["--log-level", "DEBUG", "--log-sync"],
+    "queued": ["--log-level", "DEBUG"],
+    "queued, sampled 1/100": [
+        "--log-level",
+        "DEBUG",
+        "--log-sample",
+        "__main__=100",
+    ],
+    "queued, json": ["--log-level", "DEBUG", "--log-json"],
+}
+
+
+def run(flags: list[str], port: int, args: argparse.Namespace) -> tuple:
+    with tempfile.TemporaryFile() as log:
+        server = subprocess.Popen(
+            [sys.executable, "server.py", "--port", str(port), *flags],
+            stdout=subprocess.DEVNULL,
+            stderr=log,
+        )
+        try:
+            wait_for_port(port)
+            time.sleep(0.5)
+            done = asyncio.run(
+                drive(port, args.concurrency, args.duration, "status")
+            )
+        finally:
+            server.terminate()
+            server.wait()
+        return done / args.duration, os.fstat(log.fileno()).st_size
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8890)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    print("logging | req/s | vs off | log MiB")
+    baseline = None
+    for offset, (mode, flags) in enumerate(MODES.items()):
+        rate, log_size = run(flags, args.port + offset, args)
+        baseline = baseline or rate
+        print(
+            f"{mode} | {rate:.0f} | {rate / baseline:.0%}"
+            f" | {log_size / 2**20:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Request parsing and routing throughput.
+
+`read_request` parses requests already buffered by a stream reader, so
+only the framing is timed. `server.parse` then routes and validates the
+body the connection read and runs a cheap handler, so its share of the
+request path is the part that does not depend on the storage.
+
+Usage:
+    python -m benchmarks.bench_parse --output parse.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+
+import protocol
+from benchmarks import harness
+from server import Server
+
+BATCH = 1000
+HEADERS = {
+    protocol.CONNECTION: protocol.KEEP_ALIVE,
+    protocol.ACCEPT_ENCODING: "gzip, deflate",
+}
+
+
+async def encode_requests(server: Server) -> dict[str, bytes]:
+    """Encodes a request of every benchmarked route for a new user"""
+    user_id = (await server.register({}))["token"]
+    chat_id = server.database.default_chat_id
+    requests = {
+        "status": ("GET", "/status", dict(user_id=user_id)),
+        "chat": ("GET", "/chats", dict(user_id=user_id, chat_id=chat_id)),
+        "heartbeat": ("POST", "/heartbeat", dict(user_id=user_id)),
+        "unknown": ("GET", "/unknown", {}),
+    }
+    return {
+        name: protocol.encode_request(method, url, json.dumps(body), HEADERS)
+        for name, (method, url, body) in requests.items()
+    }
+
+
+async def run(budget: float) -> dict[str, dict]:
+    server = Server()
+    results = {}
+    for name, raw in (await encode_requests(server)).items():
+        reader = asyncio.StreamReader()
+        reader.feed_data(raw)
+        request = await protocol.read_request(reader)
+
+        async def read_request() -> None:
+            if not reader._buffer:
+                reader.feed_data(raw * BATCH)
+            await protocol.read_request(reader)
+
+        async def parse() -> None:
+            await server.parse(request.method, request.url, request.body)
+
+        results[f"parse/read_request[{name}]"] = await harness.measure_async(
+            read_request, budget
+        )
+        results[f"parse/server.parse[{name}]"] = await harness.measure_async(
+            parse, budget
+        )
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=harness.DEFAULT_BUDGET_SECS,
+        help="seconds spent on each operation",
+    )
+    parser.add_argument("--output", help="write results to a JSON file")
+    args = parser.parse_args()
+
+    # failed requests would log a traceback each
+    logging.disable(logging.CRITICAL)
+    results = asyncio.run(run(args.budget))
+    harness.report(results)
+    if args.output:
+        harness.save(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
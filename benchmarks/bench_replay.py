@@ -0,0 +1,72 @@
+"""Latency of a recorded workload replayed against a fresh server.
+
+Starts `server.py` with an empty storage and replays a capture written by
+`server.py --record`, so optimizations can be compared on a real traffic
+mix with `benchmarks.compare`.
+
+Usage:
+    python -m benchmarks.bench_replay traffic.jsonl --speed 10 \\
+        --output replay.json
+"""
+import argparse
+import asyncio
+import subprocess
+import sys
+import time
+
+import traffic
+from benchmarks import harness
+from benchmarks.bench_workers import wait_for_port
+from client import AsyncClient
+
+
+def run(path: str, port: int, speed: float) -> dict[str, dict]:
+    server = subprocess.Popen(
+        [sys.executable, "server.py", "--port", str(port)]
+        + ["--log-level", "WARNING"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port)
+        time.sleep(0.5)
+        client = AsyncClient(
+            server_port=port, pool_size=traffic.REPLAY_POOL_SIZE
+        )
+        replayer = traffic.Replayer(client, speed)
+        started = time.perf_counter()
+        asyncio.run(replayer.replay(traffic.read_capture(path)))
+        elapsed = time.perf_counter() - started
+    finally:
+        server.terminate()
+        server.wait()
+
+    results = {}
+    for url, latencies in sorted(replayer.latencies.items()):
+        stats = harness.summarize(latencies, elapsed)
+        stats.update(errors=replayer.failures[url])
+        results[f"replay{url}"] = stats
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("capture", help="JSON-lines file to replay")
+    parser.add_argument("--port", type=int, default=8995)
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="time compression factor, 0 to send as fast as possible",
+    )
+    parser.add_argument("--output", help="write results to a JSON file")
+    args = parser.parse_args()
+
+    results = run(args.capture, args.port, args.speed)
+    harness.report(results)
+    if args.output:
+        harness.save(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""End-to-end latency and throughput of a server under mixed traffic.
+
+Starts `server.py` and drives it from load processes, each running many
+concurrent `ChatClient` users. Every user signs up, opens a private chat
+and then picks requests at random with the weights of the workload.
+
+Usage:
+    python -m benchmarks.bench_server --workload mixed --duration 10 \\
+        --output server.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from benchmarks import harness
+from benchmarks.bench_workers import wait_for_port
+from client import ChatClient
+
+WORKLOADS = {
+    "read-heavy": dict(
+        read_default=40, read_p2p=25, list_chats=20, status=10, send_p2p=5
+    ),
+    "mixed": dict(
+        read_default=20,
+        read_p2p=20,
+        list_chats=10,
+        status=10,
+        send_default=20,
+        send_p2p=20,
+    ),
+    "write-heavy": dict(
+        send_default=45, send_p2p=35, read_p2p=10, list_chats=10
+    ),
+}
+
+
+class User:
+    def __init__(self, port: int) -> None:
+        self.client = ChatClient(server_port=port)
+        self.peer = ChatClient(server_port=port)
+
+    async def setup(self) -> None:
+        await self.client.signup()
+        await self.peer.signup()
+        response = await self.client.post(
+            "/connect_p2p",
+            data=dict(user_id=self.client.uuid, other_user_id=self.peer.uuid),
+        )
+        self.p2p_chat_id = json.loads(response)["chat_id"]
+        response = await self.client.get(
+            "/status", data=dict(user_id=self.client.uuid)
+        )
+        self.default_chat_id = json.loads(response)["chat_default"]
+
+    async def request(self, operation: str) -> None:
+        client = self.client
+        if operation == "read_default":
+            await client.get(
+                "/chats",
+                data=dict(user_id=client.uuid, chat_id=self.default_chat_id),
+            )
+        elif operation == "read_p2p":
+            await client.get(
+                "/chats",
+                data=dict(user_id=client.uuid, chat_id=self.p2p_chat_id),
+            )
+        elif operation == "list_chats":
+            await client.get("/chats", data=dict(user_id=client.uuid))
+        elif operation == "status":
+            await client.get("/status", data=dict(user_id=client.uuid))
+        elif operation == "send_default":
+            await client.post_send(message="benchmark message")
+        elif operation == "send_p2p":
+            await client.post_send(
+                chat_id=self.p2p_chat_id, message="benchmark message"
+            )
+
+
+async def drive(
+    port: int, concurrency: int, duration: float, workload: str, seed: int
+) -> dict[str, list[float]]:
+    operations = list(WORKLOADS[workload])
+    weights = list(WORKLOADS[workload].values())
+    latencies = defaultdict(list)
+
+    async def run_user(number: int) -> None:
+        user = User(port)
+        await user.setup()
+        rng = random.Random(seed * 10**6 + number)
+        while time.monotonic() < deadline:
+            (operation,) = rng.choices(operations, weights)
+            started = time.perf_counter()
+            await user.request(operation)
+            latencies[operation].append(time.perf_counter() - started)
+
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*(run_user(number) for number in range(concurrency)))
+    return dict(latencies)
+
+
+def load_process(args: tuple) -> dict[str, list[float]]:
+    return asyncio.run(drive(*args))
+
+
+def run(
+    workload: str,
+    port: int,
+    duration: float,
+    load_processes: int,
+    concurrency: int,
+) -> dict[str, dict]:
+    server = subprocess.Popen(
+        [sys.executable, "server.py", "--port", str(port)]
+        + ["--log-level", "WARNING"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port)
+        time.sleep(0.5)
+        with multiprocessing.Pool(load_processes) as pool:
+            parts = pool.map(
+                load_process,
+                [
+                    (port, concurrency, duration, workload, seed)
+                    for seed in range(load_processes)
+                ],
+            )
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = defaultdict(list)
+    for part in parts:
+        for operation, values in part.items():
+            latencies[operation].extend(values)
+            latencies["all"].extend(values)
+    return {
+        f"server/{workload}/{operation}": harness.summarize(
+            values, duration
+        )
+        for operation, values in sorted(latencies.items())
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workload", choices=WORKLOADS, default="mixed")
+    parser.add_argument("--port", type=int, default=8990)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--load-processes", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--output", help="write results to a JSON file")
+    args = parser.parse_args()
+
+    results = run(
+        args.workload,
+        args.port,
+        args.duration,
+        args.load_processes,
+        args.concurrency,
+    )
+    harness.report(results)
+    if args.output:
+        harness.save(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Storage micro-benchmarks at growing history sizes.
+
+For every scale the default chat gets that many messages, and there are
+scale / 100 users plus private chats. Operations scanning the history
+(`Chat.dump`, `get_message`) are expected to grow with the scale. Lookups,
+`Chat.serialize`, `get_chats` and `get_inbox` read the newest messages of
+the timeline and should not, nor should `check_msg_limit_exceeded` past
+the messages of its period.
+
+Usage:
+    python -m benchmarks.bench_storage --scales 1000 100000 \\
+        --output storage.json
+"""
+import argparse
+import asyncio
+import uuid
+from datetime import timedelta
+
+import utils
+from benchmarks import harness
+from db import ChatStorage, ChatStorageCursor, Message
+from server import Server
+
+USERS_PER_MESSAGES = 100
+MAX_CHATS = 1000
+
+
+def populate(cursor: ChatStorageCursor, messages: int) -> dict:
+    user_ids = [
+        cursor.create_user()
+        for _ in range(max(messages // USERS_PER_MESSAGES, 2))
+    ]
+    users = [cursor.get_user(user_id) for user_id in user_ids]
+    default_chat = cursor.get_chat(cursor.get_default_chat_id())
+    for user in users:
+        default_chat.enter(user)
+
+    created = utils.now() - timedelta(hours=2)
+    for number in range(messages):
+        default_chat.add_message(
+            Message(
+                uuid.uuid4(),
+                created + timedelta(microseconds=number),
+                users[number % len(users)].id,
+                f"message {number}",
+            )
+        )
+
+    for user, other_user in zip(users, users[1:MAX_CHATS]):
+        chat = cursor.get_chat(cursor.create_p2p_chat(name="p2p"))
+        chat.enter(user)
+        chat.enter(other_user)
+    return dict(
+        user=users[0],
+        user_id=user_ids[0],
+        default_chat=default_chat,
+        last_message_id=str(next(reversed(default_chat.messages))),
+    )
+
+
+async def run_scale(messages: int, budget: float) -> dict[str, dict]:
+    storage = ChatStorage()
+    server = Server()
+    server.database = storage
+    cursor = await storage.connect()
+    data = populate(cursor, messages)
+    cursor.disconnect()
+
+    async def connect_disconnect() -> None:
+        (await storage.connect()).disconnect()
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    latencies = []
+    while loop.time() - started < budget:
+        call_started = loop.time()
+        await connect_disconnect()
+        latencies.append(loop.time() - call_started)
+    results = {
+        "cursor.connect": harness.summarize(
+            latencies, loop.time() - started
+        )
+    }
+
+    cursor = await storage.connect()
+    chat, user = data["default_chat"], data["user"]
+    operations = {
+        "cursor.get_user": lambda: cursor.get_user(data["user_id"]),
+        "cursor.get_chat": lambda: cursor.get_chat(str(chat.id)),
+        "cursor.get_chat_list": cursor.get_chat_list,
+        "cursor.get_message": lambda: cursor.get_message(
+            data["last_message_id"]
+        ),
+        "cursor.create_user": cursor.create_user,
+        "chat.serialize": lambda: chat.serialize(),
+        "chat.dump": chat.dump,
+        "server.get_status": lambda: Server.get_status.__wrapped__(
+            server, cursor, {"user_id": data["user_id"]}
+        ),
+        "server.get_chats": lambda: Server.get_chats.__wrapped__(
+            server, cursor, {"user_id": data["user_id"]}
+        ),
+        "server.get_inbox": lambda: Server.get_inbox.__wrapped__(
+            server, cursor, {"user_id": data["user_id"]}
+        ),
+        "server.check_msg_limit_exceeded": (
+            lambda: server.check_msg_limit_exceeded(cursor, user, chat)
+        ),
+        "clock.now": utils.now,
+        "server.message_ids": server.message_ids,
+    }
+    for name, operation in operations.items():
+        results[name] = harness.measure(operation, budget)
+    cursor.disconnect()
+    return results
+
+
+async def run(scales: list[int], budget: float) -> dict[str, dict]:
+    results = {}
+    for messages in scales:
+        for name, stats in (await run_scale(messages, budget)).items():
+            results[f"storage/{name}[{messages}]"] = stats
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--scales",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="messages in the default chat, up to 10**7 with enough RAM",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=harness.DEFAULT_BUDGET_SECS,
+        help="seconds spent on each operation",
+    )
+    parser.add_argument("--output", help="write results to a JSON file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.scales, args.budget))
+    harness.report(results)
+    if args.output:
+        harness.save(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Requests/sec scaling of the multi-process server mode.
+
+Starts `server.py --workers N` for every N and drives it from several
+load processes, each running many concurrent clients. Scaling is only
+meaningful with at least as many free cores as workers plus load
+processes.
+
+Usage:
+    python -m benchmarks.bench_workers --workers 1 2 4 8 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import socket
+import subprocess
+import sys
+import time
+
+from client import ChatClient
+
+SERVER_START_TIMEOUT_SECS = 10
+
+
+def wait_for_port(port: int) -> None:
+    deadline = time.monotonic() + SERVER_START_TIMEOUT_SECS
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.05)
+    raise TimeoutError(f"Server did not start on port {port}")
+
+
+async def drive(
+    port: int, concurrency: int, duration: float, scenario: str
+) -> int:
+    async def user() -> int:
+        client = ChatClient(server_port=port)
+        await client.signup()
+        url, body = "/status", dict(user_id=client.uuid)
+        if scenario == "p2p":
+            peer = ChatClient(server_port=port)
+            await peer.signup()
+            response = await client.post(
+                "/connect_p2p",
+                data=dict(user_id=client.uuid, other_user_id=peer.uuid),
+            )
+            url = "/chats"
+            body["chat_id"] = json.loads(response)["chat_id"]
+        done = 0
+        while time.monotonic() < deadline:
+            await client.get(url, data=body)
+            done += 1
+        return done
+
+    deadline = time.monotonic() + duration
+    return sum(await asyncio.gather(*(user() for _ in range(concurrency))))
+
+
+def load_process(args: tuple[int, int, float, str]) -> int:
+    return asyncio.run(drive(*args))
+
+
+def run(workers: int, port: int, args: argparse.Namespace) -> float:
+    server = subprocess.Popen(
+        [sys.executable, "server.py", "--workers", str(workers)]
+        + ["--port", str(port), "--log-level", "WARNING"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port)
+        time.sleep(0.5)
+        with multiprocessing.Pool(args.load_processes) as pool:
+            done = pool.map(
+                load_process,
+                [(port, args.concurrency, args.duration, args.scenario)]
+                * args.load_processes,
+            )
+        return sum(done) / args.duration
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--load-processes", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument(
+        "--scenario",
+        choices=["p2p", "status"],
+        default="p2p",
+        help="p2p reads a private chat (owner-local or one forward hop), "
+        "status gathers counters from every worker",
+    )
+    args = parser.parse_args()
+
+    print(f"cpus: {multiprocessing.cpu_count()}")
+    print("workers | req/s | speedup | efficiency")
+    baseline = None
+    for offset, workers in enumerate(args.workers):
+        rate = run(workers, args.port + offset, args)
+        baseline = baseline or rate
+        speedup = rate / baseline
+        print(
+            f"{workers} | {rate:.0f} | {speedup:.2f}x"
+            f" | {speedup / workers * args.workers[0]:.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Compares benchmark results with a saved baseline.
+
+Latency percentiles higher or throughput lower than the baseline by more
+than the threshold are reported as regressions, and the command exits
+with status 1 if there are any.
+
+Usage:
+    python -m benchmarks.compare baseline.json current.json --threshold 0.1
+"""
+import argparse
+import sys
+
+from benchmarks import harness
+
+# metric -> True if higher values are better
+METRICS = {"p50": False, "p95": False, "p99": False, "throughput": True}
+
+
+def compare(
+    baseline: dict[str, dict], current: dict[str, dict], threshold: float
+) -> list[tuple[str, str, float, float, float]]:
+    """Returns (benchmark, metric, baseline, current, change) rows"""
+    rows = []
+    for name in sorted(baseline.keys() & current.keys()):
+        for metric, higher_is_better in METRICS.items():
+            old, new = baseline[name][metric], current[name][metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            if worse > threshold:
+                rows.append((name, metric, old, new, change))
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative change treated as a regression",
+    )
+    args = parser.parse_args()
+
+    baseline, current = harness.load(args.baseline), harness.load(args.current)
+    for name in sorted(baseline.keys() ^ current.keys()):
+        side = "baseline" if name in baseline else "current results"
+        print(f"only in {side}: {name}")
+    regressions = compare(baseline, current, args.threshold)
+    for name, metric, old, new, change in regressions:
+        print(
+            f"REGRESSION {name} {metric}: {old:.6g} -> {new:.6g}"
+            f" ({change:+.1%})"
+        )
+    if regressions:
+        sys.exit(1)
+    print(f"no regressions over {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""Timing and result helpers shared by the benchmark suite.
+
+Results are JSON files mapping benchmark names to latency percentiles
+(seconds) and throughput (operations per second), plus the environment
+they were measured in.
+"""
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Awaitable, Callable
+
+DEFAULT_BUDGET_SECS = 0.5
+DEFAULT_MIN_ROUNDS = 3
+DEFAULT_MAX_ROUNDS = 10**5
+
+
+def percentile(ordered: list[float], q: float) -> float:
+    """Nearest-rank percentile of sorted values"""
+    if not ordered:
+        return 0.0
+    rank = max(math.ceil(q * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(latencies: list[float], elapsed: float) -> dict:
+    ordered = sorted(latencies)
+    return dict(
+        count=len(ordered),
+        mean=sum(ordered) / len(ordered) if ordered else 0.0,
+        p50=percentile(ordered, 0.50),
+        p95=percentile(ordered, 0.95),
+        p99=percentile(ordered, 0.99),
+        max=ordered[-1] if ordered else 0.0,
+        throughput=len(ordered) / elapsed if elapsed else 0.0,
+    )
+
+
+def measure(
+    func: Callable[[], object],
+    budget: float = DEFAULT_BUDGET_SECS,
+    min_rounds: int = DEFAULT_MIN_ROUNDS,
+    max_rounds: int = DEFAULT_MAX_ROUNDS,
+) -> dict:
+    """Times calls of func until the budget or max_rounds is spent"""
+    func()
+    latencies = []
+    started = time.perf_counter()
+    deadline = started + budget
+    clock = time.perf_counter
+    while len(latencies) < min_rounds or (
+        len(latencies) < max_rounds and clock() < deadline
+    ):
+        call_started = clock()
+        func()
+        latencies.append(clock() - call_started)
+    return summarize(latencies, clock() - started)
+
+
+async def measure_async(
+    func: Callable[[], Awaitable[object]],
+    budget: float = DEFAULT_BUDGET_SECS,
+    min_rounds: int = DEFAULT_MIN_ROUNDS,
+    max_rounds: int = DEFAULT_MAX_ROUNDS,
+) -> dict:
+    """`measure` for coroutine functions, awaited in the running loop"""
+    await func()
+    latencies = []
+    started = time.perf_counter()
+    deadline = started + budget
+    clock = time.perf_counter
+    while len(latencies) < min_rounds or (
+        len(latencies) < max_rounds and clock() < deadline
+    ):
+        call_started = clock()
+        await func()
+        latencies.append(clock() - call_started)
+    return summarize(latencies, clock() - started)
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(
+        python=sys.version.split()[0],
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+        commit=commit,
+        created=time.strftime("%Y-%m-%dT%H:%M:%S"),
+    )
+
+
+def save(path: str, results: dict[str, dict]) -> None:
+    with open(path, "w") as file:
+        json.dump(
+            dict(environment=environment(), results=results), file, indent=2
+        )
+        file.write("\n")
+
+
+def load(path: str) -> dict[str, dict]:
+    with open(path) as file:
+        return json.load(file)["results"]
+
+
+def report(results: dict[str, dict]) -> None:
+    print("benchmark | p50 ms | p95 ms | p99 ms | ops/s")
+    for name, stats in results.items():
+        print(
+            f"{name} | {stats['p50'] * 1000:.3f} | {stats['p95'] * 1000:.3f}"
+            f" | {stats['p99'] * 1000:.3f} | {stats['throughput']:.0f}"
+        )
@@ -0,0 +1,430 @@
+"""Load generator replaying scenario files with simulated chat users.
+
+A scenario file declares the steps of one user session (see
+`benchmarks/scenarios`), or a weighted mix of other scenario files.
+Every session is a fresh `ChatClient` user walking through the steps:
+
+    signup                        POST /connect
+    send    chat=default|p2p      POST /send
+    read    chat=default|p2p|all  GET /chats
+    status                        GET /status
+    connect_p2p                   POST /connect_p2p with a known user
+    leave   chat=p2p              POST /chats/exit
+    report  reason=...            POST /report_user on a known user
+
+A step may set `repeat`, `think_ms` (pause before each request) and
+`probability` (chance the step runs at all).
+
+In the closed-loop mode `--users` sessions run back to back, so a slow
+server slows the arrivals down and hides its own latency. The reported
+latencies are therefore corrected for coordinated omission the way
+HdrHistogram does it: a request slower than `--expected-interval-ms`
+stands for the requests that would have been sent meanwhile.
+
+In the open-loop mode sessions arrive at a fixed `--rate` whatever the
+server does. The first request of a session is timed from its scheduled
+arrival, so time spent waiting behind a stalled generator is counted.
+
+Usage:
+    python -m benchmarks.loadgen benchmarks/scenarios/production.json \\
+        --mode open --rate 200 --duration 30 --port 8001
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from collections import Counter, defaultdict, deque
+from dataclasses import dataclass, field
+from typing import Iterator
+
+from benchmarks import harness
+from client import ChatClient
+
+ACTIONS = (
+    "signup",
+    "send",
+    "read",
+    "status",
+    "connect_p2p",
+    "leave",
+    "report",
+)
+KNOWN_USERS = 10000
+DEFAULT_MESSAGE = "load generator message"
+
+
+@dataclass
+class Step:
+    action: str
+    chat: str = "default"
+    repeat: int = 1
+    think_ms: float = 0
+    probability: float = 1.0
+    reason: str = "spam"
+    message: str = DEFAULT_MESSAGE
+
+
+@dataclass
+class Scenario:
+    name: str
+    steps: list[Step]
+    weight: float = 1
+
+
+def load_scenarios(path: str, weight: float = 1) -> list[Scenario]:
+    """Reads a scenario file, following includes of weighted mixes"""
+    with open(path) as file:
+        data = json.load(file)
+    if "scenarios" in data:
+        scenarios = []
+        directory = os.path.dirname(path)
+        for entry in data["scenarios"]:
+            total = weight * entry.get("weight", 1)
+            scenarios.extend(
+                load_scenarios(
+                    os.path.join(directory, entry["include"]), total
+                )
+            )
+        return scenarios
+
+    steps = [Step(**step) for step in data["steps"]]
+    for step in steps:
+        if step.action not in ACTIONS:
+            raise ValueError(f"{path}: unknown action {step.action!r}")
+    return [Scenario(data["name"], steps, weight)]
+
+
+def corrected(latency: float, expected_interval: float) -> Iterator[float]:
+    """The latency and the ones of requests it held back"""
+    yield latency
+    if expected_interval <= 0:
+        return
+    missed = latency - expected_interval
+    while missed >= expected_interval:
+        yield missed
+        missed -= expected_interval
+
+
+@dataclass
+class Recorder:
+    expected_interval: float = 0
+    raw: dict[str, list[float]] = field(
+        default_factory=lambda: defaultdict(list)
+    )
+    corrected: dict[str, list[float]] = field(
+        default_factory=lambda: defaultdict(list)
+    )
+    errors: Counter = field(default_factory=Counter)
+    sessions: int = 0
+    dropped: int = 0
+
+    def record(
+        self, action: str, started: float, scheduled: float | None = None
+    ) -> None:
+        finished = time.perf_counter()
+        self.raw[action].append(finished - started)
+        if scheduled is not None:
+            self.corrected[action].append(finished - scheduled)
+        else:
+            self.corrected[action].extend(
+                corrected(finished - started, self.expected_interval)
+            )
+
+    def results(self, name: str, elapsed: float) -> dict[str, dict]:
+        results = {}
+        for action in sorted(self.raw):
+            stats = harness.summarize(self.corrected[action], elapsed)
+            stats.update(
+                throughput=len(self.raw[action]) / elapsed,
+                errors=self.errors[action],
+            )
+            results[f"loadgen/{name}/{action}"] = stats
+            results[f"loadgen/{name}/{action} (uncorrected)"] = (
+                harness.summarize(self.raw[action], elapsed)
+            )
+        return results
+
+
+class Population:
+    """State shared by the sessions of a run"""
+
+    def __init__(
+        self, host: str, port: int, timeout: float, seed: int
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.user_ids = deque(maxlen=KNOWN_USERS)
+        self.default_chat_id = None
+
+    def known_user(self, exclude: str | None) -> str | None:
+        for _ in range(3):
+            if not self.user_ids:
+                return None
+            user_id = self.rng.choice(self.user_ids)
+            if user_id != exclude:
+                return user_id
+        return None
+
+
+class Session:
+    def __init__(
+        self,
+        population: Population,
+        recorder: Recorder,
+        scheduled: float | None = None,
+    ) -> None:
+        self.population = population
+        self.recorder = recorder
+        self.scheduled = scheduled
+        self.client = ChatClient(
+            server_host=population.host, server_port=population.port
+        )
+        self.p2p_chat_id = None
+
+    async def request(self, action: str, method: str, url: str, **data):
+        """Sends a timed request, returns the decoded response or None"""
+        started = time.perf_counter()
+        scheduled, self.scheduled = self.scheduled, None
+        try:
+            response = await asyncio.wait_for(
+                self.client.send(f"{method} {url} {json.dumps(data)}"),
+                self.population.timeout,
+            )
+            response = json.loads(response)
+        except (OSError, EOFError, asyncio.TimeoutError, ValueError):
+            self.recorder.errors[action] += 1
+            response = None
+        self.recorder.record(action, started, scheduled)
+        if isinstance(response, dict) and "fail" in response:
+            self.recorder.errors[action] += 1
+            return None
+        return response
+
+    def chat_id(self, chat: str) -> str | None:
+        if chat == "p2p":
+            return self.p2p_chat_id
+        return self.population.default_chat_id
+
+    async def signup(self, step: Step) -> None:
+        if response := await self.request("signup", "POST", "/connect"):
+            self.client.uuid = response["token"]
+            self.population.user_ids.append(self.client.uuid)
+
+    async def send(self, step: Step) -> None:
+        await self.request(
+            "send",
+            "POST",
+            "/send",
+            author_id=self.client.uuid,
+            chat_id=self.chat_id(step.chat),
+            message=step.message,
+        )
+
+    async def read(self, step: Step) -> None:
+        data = dict(user_id=self.client.uuid)
+        if step.chat != "all":
+            if (chat_id := self.chat_id(step.chat)) is None:
+                await self.status(step)
+                chat_id = self.chat_id(step.chat)
+            data.update(chat_id=chat_id)
+        await self.request("read", "GET", "/chats", **data)
+
+    async def status(self, step: Step) -> None:
+        response = await self.request(
+            "status", "GET", "/status", user_id=self.client.uuid
+        )
+        if response:
+            self.population.default_chat_id = response["chat_default"]
+
+    async def connect_p2p(self, step: Step) -> None:
+        other_user_id = self.population.known_user(self.client.uuid)
+        if other_user_id is None:
+            return
+        response = await self.request(
+            "connect_p2p",
+            "POST",
+            "/connect_p2p",
+            user_id=self.client.uuid,
+            other_user_id=other_user_id,
+        )
+        if response:
+            self.p2p_chat_id = response["chat_id"]
+
+    async def leave(self, step: Step) -> None:
+        if chat_id := self.chat_id(step.chat):
+            await self.request(
+                "leave",
+                "POST",
+                "/chats/exit",
+                user_id=self.client.uuid,
+                chat_id=chat_id,
+            )
+
+    async def report(self, step: Step) -> None:
+        reported_user_id = self.population.known_user(self.client.uuid)
+        if reported_user_id is not None:
+            await self.request(
+                "report",
+                "POST",
+                "/report_user",
+                user_id=self.client.uuid,
+                reported_user_id=reported_user_id,
+                reason=step.reason,
+            )
+
+    async def run(self, scenario: Scenario) -> None:
+        rng = self.population.rng
+        try:
+            for step in scenario.steps:
+                if rng.random() >= step.probability:
+                    continue
+                for _ in range(step.repeat):
+                    if step.think_ms:
+                        await asyncio.sleep(step.think_ms / 1000)
+                    await getattr(self, step.action)(step)
+        finally:
+            await self.client.close()
+        self.recorder.sessions += 1
+
+
+def pick(population: Population, scenarios: list[Scenario]) -> Scenario:
+    weights = [scenario.weight for scenario in scenarios]
+    return population.rng.choices(scenarios, weights)[0]
+
+
+async def closed_loop(
+    population: Population,
+    recorder: Recorder,
+    scenarios: list[Scenario],
+    users: int,
+    duration: float,
+) -> None:
+    deadline = time.monotonic() + duration
+
+    async def user() -> None:
+        while time.monotonic() < deadline:
+            await Session(population, recorder).run(
+                pick(population, scenarios)
+            )
+
+    await asyncio.gather(*(user() for _ in range(users)))
+
+
+async def open_loop(
+    population: Population,
+    recorder: Recorder,
+    scenarios: list[Scenario],
+    rate: float,
+    duration: float,
+    max_in_flight: int,
+) -> None:
+    sessions = set()
+    started = time.perf_counter()
+    for number in range(int(rate * duration)):
+        scheduled = started + number / rate
+        if (delay := scheduled - time.perf_counter()) > 0:
+            await asyncio.sleep(delay)
+        if len(sessions) >= max_in_flight:
+            recorder.dropped += 1
+            continue
+        session = Session(population, recorder, scheduled)
+        task = asyncio.create_task(session.run(pick(population, scenarios)))
+        sessions.add(task)
+        task.add_done_callback(sessions.discard)
+    await asyncio.gather(*sessions)
+
+
+async def run(
+    scenarios: list[Scenario],
+    port: int,
+    host: str = "127.0.0.1",
+    mode: str = "closed",
+    duration: float = 10,
+    users: int = 100,
+    rate: float = 100,
+    max_in_flight: int = 10000,
+    expected_interval: float = 0.1,
+    timeout: float = 10,
+    seed: int = 0,
+) -> tuple[Recorder, float]:
+    population = Population(host, port, timeout, seed)
+    recorder = Recorder(expected_interval if mode == "closed" else 0)
+    started = time.perf_counter()
+    if mode == "closed":
+        await closed_loop(population, recorder, scenarios, users, duration)
+    else:
+        await open_loop(
+            population, recorder, scenarios, rate, duration, max_in_flight
+        )
+    return recorder, time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("scenario", help="path to a scenario file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--mode", choices=["closed", "open"], default="open")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument(
+        "--users", type=int, default=100, help="closed loop: sessions at once"
+    )
+    parser.add_argument(
+        "--rate", type=float, default=100, help="open loop: sessions per sec"
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=10000,
+        help="open loop: arrivals beyond it are dropped and counted",
+    )
+    parser.add_argument(
+        "--expected-interval-ms",
+        type=float,
+        default=100,
+        help="closed loop: request interval a user would keep",
+    )
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results to a JSON file")
+    args = parser.parse_args()
+
+    scenarios = load_scenarios(args.scenario)
+    name = os.path.splitext(os.path.basename(args.scenario))[0]
+    recorder, elapsed = asyncio.run(
+        run(
+            scenarios,
+            args.port,
+            host=args.host,
+            mode=args.mode,
+            duration=args.duration,
+            users=args.users,
+            rate=args.rate,
+            max_in_flight=args.max_in_flight,
+            expected_interval=args.expected_interval_ms / 1000,
+            timeout=args.timeout,
+            seed=args.seed,
+        )
+    )
+    results = recorder.results(f"{name}/{args.mode}", elapsed)
+    harness.report(results)
+    errors = ", ".join(
+        f"{action} {count}" for action, count in recorder.errors.items()
+    )
+    print(
+        f"sessions {recorder.sessions}, dropped {recorder.dropped},"
+        f" errors: {errors or 'none'}"
+    )
+    if args.output:
+        harness.save(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
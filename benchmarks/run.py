@@ -0,0 +1,52 @@
+"""Runs the storage and server benchmarks into one results file.
+
+Usage:
+    python -m benchmarks.run --output baseline.json
+    # after a change
+    python -m benchmarks.run --output current.json
+    python -m benchmarks.compare baseline.json current.json
+"""
+import argparse
+import asyncio
+
+from benchmarks import bench_server, bench_storage, harness
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--scales", type=int, nargs="+", default=[1000, 10000, 100000]
+    )
+    parser.add_argument(
+        "--budget", type=float, default=harness.DEFAULT_BUDGET_SECS
+    )
+    parser.add_argument(
+        "--workloads",
+        nargs="+",
+        choices=bench_server.WORKLOADS,
+        default=list(bench_server.WORKLOADS),
+    )
+    parser.add_argument("--port", type=int, default=8990)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--load-processes", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+
+    results = asyncio.run(bench_storage.run(args.scales, args.budget))
+    for offset, workload in enumerate(args.workloads):
+        results.update(
+            bench_server.run(
+                workload,
+                args.port + offset,
+                args.duration,
+                args.load_processes,
+                args.concurrency,
+            )
+        )
+    harness.report(results)
+    harness.save(args.output, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,80 +1,457 @@
 import asyncio
+import codecs
 import json
 import logging
+import random
 import sys
 import uuid
+from collections import deque
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, Sequence
 
+import compression
+import protocol
 from db import User
+from settings import (
+    DEFAULT_CLIENT_BACKOFF_SECS,
+    DEFAULT_CLIENT_POOL_IDLE_SECS,
+    DEFAULT_CLIENT_POOL_SIZE,
+    DEFAULT_CLIENT_RETRIES,
+    DEFAULT_CLIENT_TIMEOUT_SECS,
+    DEFAULT_MSG_COUNT,
+)
 
 logger = logging.getLogger(__name__)
 
+Connection = tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+def time_left(deadline: float | None) -> float | None:
+    """Returns the wait_for timeout that runs out at the loop deadline"""
+    if deadline is None:
+        return None
+    return max(deadline - asyncio.get_running_loop().time(), 0)
+
+
+@dataclass
+class PoolStats:
+    connects: int = 0
+    hits: int = 0
+    waits: int = 0
+    reconnects: int = 0
+    evictions: int = 0
+    retries: int = 0
+    timeouts: int = 0
+
+
+class ConnectionPool:
+    """Keep-alive connections to one server, at most `size` in use
+
+    Idle connections are reused most recent first and closed once they
+    stayed idle for `idle_timeout`, which should be shorter than the
+    keep-alive timeout of the server. A zero `idle_timeout` turns reuse
+    off and only limits concurrency.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Awaitable[Connection]],
+        size: int = DEFAULT_CLIENT_POOL_SIZE,
+        idle_timeout: float = DEFAULT_CLIENT_POOL_IDLE_SECS,
+    ) -> None:
+        self.connect = connect
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.stats = PoolStats()
+        self.loop = None
+        self.idle = deque()
+        self.semaphore = None
+
+    def bind(self) -> None:
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            # connections of another event loop cannot be reused
+            self.loop = loop
+            self.idle = deque()
+            self.semaphore = asyncio.Semaphore(self.size)
+
+    def evict(self, stale: bool) -> None:
+        reader, writer, _ = self.idle.popleft() if stale else self.idle.pop()
+        self.stats.evictions += 1
+        writer.close()
+
+    async def acquire(self) -> tuple[Connection, bool]:
+        """Waits for a free slot, returns a connection and if it is reused"""
+        self.bind()
+        if self.semaphore.locked():
+            self.stats.waits += 1
+        await self.semaphore.acquire()
+        try:
+            while self.idle:
+                reader, writer, released = self.idle[-1]
+                if (
+                    self.loop.time() - released < self.idle_timeout
+                    and not reader.at_eof()
+                    and not writer.is_closing()
+                ):
+                    self.idle.pop()
+                    self.stats.hits += 1
+                    return (reader, writer), True
+                self.evict(stale=False)
+            self.stats.connects += 1
+            return await self.connect(), False
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+    def release(self, connection: Connection, reusable: bool) -> None:
+        reader, writer = connection
+        if reusable and self.idle_timeout and not writer.is_closing():
+            now = self.loop.time()
+            while self.idle and now - self.idle[0][2] >= self.idle_timeout:
+                self.evict(stale=True)
+            self.idle.append((reader, writer, now))
+        else:
+            writer.close()
+        self.semaphore.release()
+
+    async def close(self) -> None:
+        while self.idle:
+            _, writer, _ = self.idle.pop()
+            writer.close()
+            await writer.wait_closed()
+
 
 class AsyncClient:
+    """Client of the chat protocol
+
+    Requests share a `ConnectionPool`, every request must complete within
+    `timeout` seconds. GET requests, and POST requests with an idempotency
+    key, failing on connection errors are retried up to `retries` times
+    after a jittered exponential backoff.
+    """
+
     def __init__(
         self,
         server_host: str = "127.0.0.1",
         server_port: int = 8001,
         limit: int = 64000,
+        encodings: Sequence[str] = (),
+        unix_path: str | None = None,
+        pool_size: int = DEFAULT_CLIENT_POOL_SIZE,
+        pool_idle_secs: float = DEFAULT_CLIENT_POOL_IDLE_SECS,
+        timeout: float | None = DEFAULT_CLIENT_TIMEOUT_SECS,
+        retries: int = DEFAULT_CLIENT_RETRIES,
+        backoff_secs: float = DEFAULT_CLIENT_BACKOFF_SECS,
     ):
         self.host = server_host
         self.port = server_port
         self.limit = limit
+        self.encodings = encodings
+        self.unix_path = unix_path
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_secs = backoff_secs
+        self.pool = ConnectionPool(
+            self.open_connection, pool_size, pool_idle_secs
+        )
+
+    @property
+    def stats(self) -> PoolStats:
+        return self.pool.stats
+
+    async def close(self) -> None:
+        await self.pool.close()
+
+    async def __aenter__(self) -> "AsyncClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
 
     async def get(self, url: str, *, data: dict | None = None) -> str:
         body = json.dumps(data) if data else ""
         return await self.send(f"GET {url} {body}")
 
-    async def post(self, url: str, *, data: dict | None = None) -> str:
+    async def post(
+        self,
+        url: str,
+        *,
+        data: dict | None = None,
+        idempotency_key: str | None = None,
+    ) -> str:
+        """Posts data, retrying like a GET when an idempotency key is set"""
         body = json.dumps(data) if data else ""
-        return await self.send(f"POST {url} {body}")
+        headers = {}
+        if idempotency_key is not None:
+            headers[protocol.IDEMPOTENCY_KEY] = idempotency_key
+        return await self.send(f"POST {url} {body}", headers)
 
-    async def send(self, message: str = "") -> str:
-        reader, writer = await asyncio.open_connection(
+    async def open_connection(self) -> Connection:
+        if self.unix_path is not None:
+            return await asyncio.open_unix_connection(
+                self.unix_path, limit=self.limit
+            )
+        return await asyncio.open_connection(
             self.host, self.port, limit=self.limit
         )
-        logger.debug(f"Connected {writer.get_extra_info('peername')}")
-        logger.debug(f"Sending `{message}`")
-        writer.write(message.encode())
-        await writer.drain()
 
-        response = await reader.read(self.limit)
-        data = response.decode()
-        logger.debug(f"Received: {data}")
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, self.backoff_secs * 2**attempt)
 
-        logger.debug("Closing the connection")
-        writer.close()
-        await writer.wait_closed()
+    async def stream(
+        self, message: str = "", headers: dict[str, str] | None = None
+    ) -> AsyncIterator[str]:
+        """Yields the response text frame by frame as it arrives"""
+        method, url, *body = message.split(" ", maxsplit=2)
+        headers = dict(headers or {})
+        if self.encodings:
+            headers.setdefault(
+                protocol.ACCEPT_ENCODING, ", ".join(self.encodings)
+            )
+        if self.pool.idle_timeout:
+            headers[protocol.CONNECTION] = protocol.KEEP_ALIVE
+        request = protocol.encode_request(method, url, "".join(body), headers)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout if self.timeout else None
+        retried = method == "GET" or protocol.IDEMPOTENCY_KEY in headers
+        attempts = self.retries + 1 if retried else 1
+        for attempt in range(attempts):
+            received = False
+            try:
+                logger.debug("Sending `%s`", message)
+                async for text in self.exchange(request, deadline):
+                    received = True
+                    yield text
+                return
+            except asyncio.TimeoutError:
+                self.stats.timeouts += 1
+                raise
+            except (OSError, EOFError):
+                if received or attempt + 1 == attempts:
+                    raise
+                delay = self.backoff(attempt)
+                if deadline is not None and loop.time() + delay >= deadline:
+                    raise
+                logger.warning("Retrying %s %s", method, url, exc_info=True)
+                self.stats.retries += 1
+                await asyncio.sleep(delay)
+
+    async def exchange(
+        self, request: bytes, deadline: float | None
+    ) -> AsyncIterator[str]:
+        """Sends the request over a pooled connection, yields the response"""
+        connection, reused = await asyncio.wait_for(
+            self.pool.acquire(), time_left(deadline)
+        )
+        reusable = False
+        try:
+            try:
+                response_headers = await self.request(
+                    connection, request, deadline
+                )
+            except (OSError, EOFError):
+                if not reused:
+                    raise
+                # the server closed the idle connection meanwhile
+                logger.debug("Reconnecting a stale pooled connection")
+                self.stats.reconnects += 1
+                connection[1].close()
+                connection = await asyncio.wait_for(
+                    self.open_connection(), time_left(deadline)
+                )
+                response_headers = await self.request(
+                    connection, request, deadline
+                )
+
+            codec = compression.decompressor(
+                response_headers.get(protocol.CONTENT_ENCODING)
+            )
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            chunks = protocol.read_chunks(connection[0])
+            while True:
+                frame = await asyncio.wait_for(
+                    anext(chunks, None), time_left(deadline)
+                )
+                if frame is None:
+                    break
+                if text := decoder.decode(codec.decompress(frame)):
+                    yield text
+            if text := decoder.decode(codec.flush(), final=True):
+                yield text
+            reusable = (
+                response_headers.get(protocol.CONNECTION)
+                == protocol.KEEP_ALIVE
+            )
+        finally:
+            self.pool.release(connection, reusable)
+
+    async def request(
+        self, connection: Connection, request: bytes, deadline: float | None
+    ) -> dict[str, str]:
+        reader, writer = connection
+
+        async def send() -> dict[str, str]:
+            writer.write(request)
+            await writer.drain()
+            return await protocol.read_headers(reader)
+
+        headers = await asyncio.wait_for(send(), time_left(deadline))
+        if not headers:
+            raise asyncio.IncompleteReadError(b"", None)
+        return headers
+
+    async def stream_lines(self, message: str = "") -> AsyncIterator[dict]:
+        """Yields the documents of a response streamed as JSON lines"""
+        tail = ""
+        async for text in self.stream(message):
+            *lines, tail = (tail + text).split("\n")
+            for line in filter(None, lines):
+                yield json.loads(line)
+        if tail.strip():
+            yield json.loads(tail)
+
+    async def send(
+        self, message: str = "", headers: dict[str, str] | None = None
+    ) -> str:
+        data = "".join(
+            [text async for text in self.stream(message, headers)]
+        )
+        logger.debug("Received: %s", data)
         return data
 
 
 class ChatClient(AsyncClient):
+    """Chat user keeping the fetched chat histories
+
+    `get_history` and `get_chats` send the versions of cached chats, so
+    the server answers with only what changed since they were fetched.
+    """
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.uuid = None
+        self.history: dict[str, dict] = {}
+
+    def cached_version(self, chat_id: str, msg_count: int) -> str | None:
+        cached = self.history.get(str(chat_id))
+        if cached is None or cached["msg_count"] < msg_count:
+            return None
+        return cached["version"]
+
+    def merge_history(self, history: dict, msg_count: int) -> dict:
+        """Applies a full, delta or not modified history to the cache"""
+        chat_id = history["id"]
+        cached = self.history.get(chat_id)
+        if history.get("not_modified"):
+            cached.update(online=history.get("online", 0))
+            return cached
+        if history.get("delta"):
+            deleted = set(history.get("deleted", ()))
+            kept = [
+                message
+                for message in cached["messages"]
+                if message["id"] not in deleted
+            ]
+            window = cached["msg_count"]
+            if len(cached["messages"]) >= window:
+                # older messages would now fill the window, refetch them
+                window -= len(cached["messages"]) - len(kept)
+            messages = history["messages"] + kept
+            authors = set(cached["authors"]).union(history["entered"])
+            history = dict(
+                cached,
+                msg_count=window,
+                messages=messages[:window],
+                authors=sorted(authors.difference(history["left"])),
+                size=history["size"],
+                online=history.get("online", 0),
+                version=history["version"],
+            )
+        else:
+            history = dict(history, msg_count=msg_count)
+        self.history[chat_id] = history
+        return history
+
+    async def get_history(
+        self, chat_id: str, msg_count: int = DEFAULT_MSG_COUNT
+    ) -> dict:
+        body = dict(user_id=self.uuid, chat_id=chat_id, msg_count=msg_count)
+        if version := self.cached_version(chat_id, msg_count):
+            body.update(version=version)
+        response = json.loads(await self.get("/chats", data=body))
+        if "fail" in response:
+            return response
+        return self.merge_history(response["history"], msg_count)
+
+    async def get_chats(
+        self, msg_count: int = DEFAULT_MSG_COUNT
+    ) -> list[dict] | dict:
+        versions = {
+            chat_id: version
+            for chat_id in self.history
+            if (version := self.cached_version(chat_id, msg_count))
+        }
+        body = dict(user_id=self.uuid, msg_count=msg_count, versions=versions)
+        response = json.loads(await self.get("/chats", data=body))
+        if "fail" in response:
+            return response
+        chats = [
+            self.merge_history(chat, msg_count) for chat in response["chats"]
+        ]
+        # chats the user left are not listed any more
+        self.history = {chat["id"]: chat for chat in chats}
+        return chats
+
+    async def get_inbox(
+        self, msg_count: int = DEFAULT_MSG_COUNT, before: str | None = None
+    ) -> dict:
+        """Newest messages of all chats, older ones from the `next` cursor"""
+        body = dict(user_id=self.uuid, msg_count=msg_count)
+        if before is not None:
+            body.update(before=before)
+        return json.loads(await self.get("/inbox", data=body))
 
     def force_login(self, user: User) -> None:
         self.uuid = user.id
 
     async def signup(self) -> None:
-        response = await self.post("/connect")
+        response = await self.post(
+            "/connect", idempotency_key=str(uuid.uuid4())
+        )
         response_json = json.loads(response)
-        uuid = response_json["token"]
-        logger.info(f"My uuid: {uuid}")
-        self.uuid = uuid
+        token = response_json["token"]
+        logger.info("My uuid: %s", token)
+        self.uuid = token
 
     async def get_status(self) -> None:
         if self.uuid:
             body = dict(user_id=self.uuid)
             data = await self.get("/status", data=body)
-            logger.info(f"Current status: {data}")
+            logger.info("Current status: %s", data)
+
+    async def heartbeat(self) -> dict | None:
+        """Keeps the user online for the timeout the server answers"""
+        if self.uuid:
+            body = dict(user_id=self.uuid)
+            return json.loads(await self.post("/heartbeat", data=body))
 
     async def post_send(
-        self, *, chat_id: uuid.UUID | None = None, message: str | None = None
+        self,
+        *,
+        chat_id: uuid.UUID | None = None,
+        message: str | None = None,
+        ttl: float | None = None,
     ) -> None:
         if self.uuid:
             body = dict(author_id=self.uuid, chat_id=chat_id, message=message)
-            data = await self.post("/send", data=body)
-            logger.info(f"Server responsed: {data}")
+            if ttl is not None:
+                body.update(ttl=ttl)
+            data = await self.post(
+                "/send", data=body, idempotency_key=str(uuid.uuid4())
+            )
+            logger.info("Server responsed: %s", data)
 
 
 async def test_common_chat() -> None:
@@ -0,0 +1,83 @@
+"""Wall clock of the server and time-ordered message ids.
+
+`Clock` looks its timezone up once instead of on every reading and never
+goes back: after the system clock is set back it repeats its latest
+reading until the system clock catches up. Message ids are UUIDv7 minted
+by `MessageIds` from the same clock, each greater than the one before.
+Messages of a chat sorted by creation time and id are thus in the order
+they were written, batches sharing one timestamp included.
+"""
+import random
+import time
+import uuid
+from datetime import datetime
+from typing import Callable
+
+import pytz
+
+from settings import DEFAULT_TZ
+
+UUID_VERSION_7 = 0x7 << 76
+UUID_VARIANT = 0b10 << 62
+RANDOM_BITS = 74
+RANDOM_LOW_BITS = 62
+
+
+class Clock:
+    """Readings in DEFAULT_TZ that never decrease"""
+
+    def __init__(
+        self,
+        tz: str = DEFAULT_TZ,
+        source: Callable[[], int] = time.time_ns,
+    ) -> None:
+        self.tz = pytz.timezone(tz)
+        self.source = source
+        self.last_ns = 0
+
+    def time_ns(self) -> int:
+        """Nanoseconds since the epoch"""
+        if (now := self.source()) > self.last_ns:
+            self.last_ns = now
+        return self.last_ns
+
+    def timestamp(self) -> float:
+        return self.time_ns() / 1e9
+
+    def now(self) -> datetime:
+        return datetime.fromtimestamp(self.timestamp(), self.tz)
+
+
+class MessageIds:
+    """UUIDv7 ids, 48 bits of epoch milliseconds and 74 random bits
+
+    An id minted within the millisecond of the previous one, or before
+    it, follows it instead. Ids are not secrets, unlike user ids, so the
+    random bits are not drawn from the OS.
+    """
+
+    def __init__(self, clock: Clock | None = None) -> None:
+        self.clock = clock or default_clock
+        # milliseconds and random bits of the last id
+        self.last = 0
+
+    def __call__(self) -> uuid.UUID:
+        millis = self.clock.time_ns() // 1_000_000
+        value = millis << RANDOM_BITS | random.getrandbits(RANDOM_BITS)
+        if value <= self.last:
+            value = self.last + 1
+        self.last = value
+        # milliseconds and 12 random bits go before the version,
+        # the other random bits after the variant
+        high, low = divmod(value, 1 << RANDOM_LOW_BITS)
+        millis, random_high = divmod(high, 1 << 12)
+        return uuid.UUID(
+            int=millis << 80
+            | UUID_VERSION_7
+            | random_high << 64
+            | UUID_VARIANT
+            | low
+        )
+
+
+default_clock = Clock()
@@ -0,0 +1,397 @@
+"""Multi-node server mode.
+
+Nodes are placed on a consistent-hash ring keyed by the address of their
+internal listener; the node following a chat id on the ring owns the chat.
+Changes of users and the default chat are published to every other node
+through a message bus. A joining node pulls the chats it takes over from
+every member, a leaving node lets the members pull its chats back, so only
+the chats between the moved ring points change hands.
+
+Requests touching a moving chat may fail with NotExistError until the
+handoff stream reaches its new owner. The old owner keeps its copy of the
+moved records until the new owner confirms it restored them.
+"""
+import abc
+import argparse
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import uuid
+from typing import Awaitable, Callable, Iterable
+
+import logs
+import protocol
+from client import AsyncClient
+from db import Chat, ChatStorageCursor, Complaint, DbEncoder, User
+from partition import INTERNAL_PREFIX, PARTITION, PartitionedServer
+from server import Server
+from settings import DEFAULT_HOST, DEFAULT_PORT
+from utils import JsonLines
+
+DEFAULT_VNODES = 64
+DEFAULT_CLUSTER_PORT_OFFSET = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(key.encode(), digest_size=8).digest(), "big"
+    )
+
+
+class ConsistentHashRing:
+    def __init__(
+        self, nodes: Iterable[str] = (), vnodes: int = DEFAULT_VNODES
+    ) -> None:
+        self.vnodes = vnodes
+        self.points: list[tuple[int, str]] = []
+        for node in nodes:
+            self.add(node)
+
+    def __contains__(self, node: str) -> bool:
+        return node in self.nodes
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def nodes(self) -> list[str]:
+        return sorted({node for _, node in self.points})
+
+    def add(self, node: str) -> None:
+        if node in self:
+            return
+        for vnode in range(self.vnodes):
+            bisect.insort(self.points, (ring_hash(f"{node}#{vnode}"), node))
+
+    def remove(self, node: str) -> None:
+        self.points = [point for point in self.points if point[1] != node]
+
+    def owner(self, key: str) -> str:
+        if not self.points:
+            raise LookupError("Hash ring is empty")
+        index = bisect.bisect(self.points, (ring_hash(key),))
+        return self.points[index % len(self.points)][1]
+
+
+class MessageBus(abc.ABC):
+    """Publishes replicated changes to the other nodes of a cluster"""
+
+    def subscribe(
+        self, node: str, handler: Callable[[str, dict], Awaitable]
+    ) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def publish(
+        self, sender: str, topic: str, data: dict, nodes: Iterable[str]
+    ) -> None:
+        pass
+
+
+class LocalMessageBus(MessageBus):
+    """In-process bus shared by the nodes of one event loop"""
+
+    def __init__(self) -> None:
+        self.handlers: dict[str, Callable[[str, dict], Awaitable]] = {}
+
+    def subscribe(
+        self, node: str, handler: Callable[[str, dict], Awaitable]
+    ) -> None:
+        self.handlers[node] = handler
+
+    async def publish(
+        self, sender: str, topic: str, data: dict, nodes: Iterable[str]
+    ) -> None:
+        # round trip through JSON so that subscribers never share objects
+        data = json.loads(json.dumps(data, cls=DbEncoder))
+        await asyncio.gather(
+            *(
+                self.handlers[node](topic, data)
+                for node in nodes
+                if node != sender and node in self.handlers
+            )
+        )
+
+
+class TcpMessageBus(MessageBus):
+    """Posts every change to the internal listener of each node"""
+
+    def __init__(self, limit: int = 64000) -> None:
+        self.limit = limit
+        self.clients: dict[str, AsyncClient] = {}
+
+    def client(self, node: str) -> AsyncClient:
+        if node not in self.clients:
+            host, port = node.rsplit(":", maxsplit=1)
+            self.clients[node] = AsyncClient(host, int(port), self.limit)
+        return self.clients[node]
+
+    async def publish(
+        self, sender: str, topic: str, data: dict, nodes: Iterable[str]
+    ) -> None:
+        message = f"POST {INTERNAL_PREFIX}{topic} " + json.dumps(
+            data, cls=DbEncoder
+        )
+        await asyncio.gather(
+            *(
+                self.client(node).send(message)
+                for node in nodes
+                if node != sender
+            )
+        )
+
+
+class ClusterServer(PartitionedServer):
+    def __init__(
+        self,
+        *args,
+        cluster_port: int,
+        seeds: Iterable[str] = (),
+        bus: MessageBus | None = None,
+        vnodes: int = DEFAULT_VNODES,
+        **kwargs,
+    ):
+        self.seeds = list(seeds)
+        # the first node of a cluster creates the default chat
+        default_chat_id = None if self.seeds else str(uuid.uuid4())
+        super().__init__(
+            *args, node=None, default_chat_id=default_chat_id, **kwargs
+        )
+        self.node = f"{self.host}:{cluster_port}"
+        self.cluster_port = cluster_port
+        self.ring = ConsistentHashRing([self.node], vnodes)
+        # ids of the chats and complaints streamed to each taking node
+        self.handed_over: dict[str, tuple[list[str], list[str]]] = {}
+        self.transport = TcpMessageBus(self.limit)
+        self.bus = bus or self.transport
+        self.bus.subscribe(self.node, self.deliver)
+
+    def create_url_method_action_map(self):
+        return {
+            **super().create_url_method_action_map(),
+            f"{INTERNAL_PREFIX}members": {"GET": self.get_members},
+            f"{INTERNAL_PREFIX}snapshot": {"GET": self.get_snapshot},
+            f"{INTERNAL_PREFIX}handoff": {"POST": self.handoff},
+            f"{INTERNAL_PREFIX}release": {"POST": self.release},
+            f"{INTERNAL_PREFIX}depart": {"POST": self.depart},
+        }
+
+    def owner_of(self, pk: str | uuid.UUID) -> str:
+        return self.ring.owner(str(uuid.UUID(str(pk))))
+
+    def peer_nodes(self) -> list[str]:
+        return [node for node in self.ring.nodes if node != self.node]
+
+    async def call(
+        self, node: str, method: str, url: str, body: str = ""
+    ) -> dict:
+        client = self.transport.client(node)
+        return json.loads(await client.send(f"{method} {url} {body}"))
+
+    async def replicate(self, topic: str, data: dict) -> None:
+        await self.bus.publish(self.node, topic, data, self.peer_nodes())
+
+    async def deliver(self, topic: str, data: dict) -> dict:
+        """Applies a change published by another node"""
+        url = f"{INTERNAL_PREFIX}{topic}"
+        return await self.parse("POST", url, json.dumps(data))
+
+    async def start_internal_server(self) -> asyncio.AbstractServer:
+        return await protocol.start_server(
+            self.internal_connected_callback,
+            self.host,
+            self.cluster_port,
+            limit=self.limit,
+        )
+
+    # Membership
+
+    async def pull(
+        self, node: str, url: str, data: dict, method: str = "GET"
+    ) -> int:
+        """Restores the records streamed by a node, returns their count"""
+        client = self.transport.client(node)
+        count = 0
+        async for record in client.stream_lines(
+            f"{method} {url} {json.dumps(data)}"
+        ):
+            await self.restore(record)
+            count += 1
+        return count
+
+    async def take_over(self, node: str) -> int:
+        """Pulls the records the node hands over, then lets it drop them"""
+        data = {"node": self.node}
+        count = await self.pull(
+            node, f"{INTERNAL_PREFIX}handoff", data, method="POST"
+        )
+        await self.call(
+            node, "POST", f"{INTERNAL_PREFIX}release", json.dumps(data)
+        )
+        return count
+
+    async def join(self, seed: str) -> None:
+        snapshot_url = f"{INTERNAL_PREFIX}snapshot"
+        await self.pull(seed, snapshot_url, {})
+        response = await self.call(seed, "GET", f"{INTERNAL_PREFIX}members")
+        for member in response["members"]:
+            self.ring.add(member)
+        for member in response["members"]:
+            count = await self.take_over(member)
+            logger.info("Took over %d records from %s", count, member)
+        # members publish to the node only once it is on their rings,
+        # catch up on the changes made in between
+        await self.pull(seed, snapshot_url, {})
+
+    async def leave_cluster(self) -> None:
+        """Hands every owned chat over to the remaining members"""
+        peers = self.peer_nodes()
+        self.ring.remove(self.node)
+        await asyncio.gather(
+            *(
+                self.call(
+                    peer,
+                    "POST",
+                    f"{INTERNAL_PREFIX}depart",
+                    json.dumps({"node": self.node}),
+                )
+                for peer in peers
+            )
+        )
+
+    async def stop(self) -> None:
+        # members pull the chats of the node while it still serves
+        try:
+            await self.leave_cluster()
+        except Exception:
+            logger.exception("Could not hand chats over on leaving")
+        await super().stop()
+
+    async def before_serving(self) -> None:
+        if self.seeds:
+            await self.join(self.seeds[0])
+
+    async def get_members(self, body: dict) -> dict:
+        return {"members": self.ring.nodes}
+
+    async def depart(self, body: dict) -> dict:
+        node = body["node"]
+        self.ring.remove(node)
+        count = await self.take_over(node)
+        logger.info(
+            "Took over %d records from departed %s", count, node
+        )
+        return {}
+
+    @Server.connect_db(user=PARTITION)
+    def get_snapshot(
+        self, cursor: ChatStorageCursor, body: dict
+    ) -> JsonLines:
+        default_chat = cursor.get_chat(cursor.get_default_chat_id())
+        # users go first, restoring the default chat enters its authors
+        records: list[dict] = [
+            {"user": user} for user in cursor.get_user_list()
+        ]
+        records.append({"default_chat": default_chat.dump()})
+        return JsonLines(records)
+
+    @Server.connect_db(user=PARTITION)
+    def handoff(self, cursor: ChatStorageCursor, body: dict) -> JsonLines:
+        """Streams the records owned by the requesting node
+
+        The ring is updated under the same lock, so that requests for
+        the moved chats are forwarded to the new owner from now on. The
+        records stay here until the node releases them, a failed stream
+        loses nothing.
+        """
+        node = body["node"]
+        self.ring.add(node)
+        default_chat_id = cursor.get_default_chat_id()
+        chats = [
+            chat
+            for chat in cursor.get_chat_list()
+            if str(chat.id) != default_chat_id
+            and self.owner_of(chat.id) == node
+        ]
+        complaints = [
+            complaint
+            for complaint in cursor.get_complaint_list()
+            if self.owner_of(complaint.reported_user) == node
+        ]
+        self.handed_over[node] = (
+            [str(chat.id) for chat in chats],
+            [str(complaint.id) for complaint in complaints],
+        )
+        return JsonLines(
+            [{"chat": chat.dump()} for chat in chats]
+            + [{"complaint": complaint} for complaint in complaints]
+        )
+
+    @Server.connect_db(user=PARTITION)
+    def release(self, cursor: ChatStorageCursor, body: dict) -> dict:
+        """Removes the records the node confirmed to have restored"""
+        chat_ids, complaint_ids = self.handed_over.pop(body["node"], ([], []))
+        for chat_id in chat_ids:
+            cursor.delete_chat(chat_id)
+        for complaint_id in complaint_ids:
+            cursor.delete_complaint(complaint_id)
+        return {"chats": len(chat_ids), "complaints": len(complaint_ids)}
+
+    @Server.connect_db(user=PARTITION)
+    def restore(self, cursor: ChatStorageCursor, record: dict) -> None:
+        if "user" in record:
+            cursor.add_user(User.load(record["user"]))
+        elif "chat" in record:
+            cursor.add_chat(Chat.load(record["chat"]))
+        elif "complaint" in record:
+            cursor.add_complaint(Complaint.load(record["complaint"]))
+        elif "default_chat" in record:
+            chat = Chat.load(record["default_chat"])
+            if (default_chat := cursor.get_chat(str(chat.id))) is None:
+                cursor.db.default_chat_id = cursor.add_chat(chat)
+            else:
+                # merge through the chat, so counters, presence and
+                # retention see the authors and messages it missed
+                for author_id in chat.authors:
+                    if (author := cursor.get_user(author_id)) is not None:
+                        default_chat.enter(author)
+                for message in chat.messages.values():
+                    if default_chat.messages.get(message.id) != message:
+                        default_chat.add_message(message)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="yachat cluster node")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--cluster-port",
+        type=int,
+        help="internal port, defaults to port + 1000",
+    )
+    parser.add_argument(
+        "--seed",
+        action="append",
+        default=[],
+        help="host:cluster_port of a running node to join",
+    )
+    logs.add_arguments(parser)
+    args = parser.parse_args()
+
+    logs.setup_from_args(args)
+
+    node = ClusterServer(
+        host=args.host,
+        port=args.port,
+        cluster_port=args.cluster_port
+        or args.port + DEFAULT_CLUSTER_PORT_OFFSET,
+        seeds=args.seed,
+    )
+    try:
+        asyncio.run(node.startup())
+    except KeyboardInterrupt:
+        pass
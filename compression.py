@@ -0,0 +1,91 @@
+import zlib
+from typing import Iterable, Iterator
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+IDENTITY = "identity"
+DEFLATE = "deflate"
+ZLIB = "zlib"
+ZSTD = "zstd"
+
+DEFAULT_LEVELS = {DEFLATE: 6, ZSTD: 3}
+ALIASES = {ZLIB: DEFLATE}
+
+
+class IdentityCodec:
+    """Pass-through codec mimicking zlib compress/decompress objects"""
+
+    def compress(self, data: bytes) -> bytes:
+        return bytes(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return bytes(data)
+
+    def flush(self) -> bytes:
+        return b""
+
+
+def available_encodings() -> list[str]:
+    encodings = [DEFLATE]
+    if zstandard is not None:
+        encodings.insert(0, ZSTD)
+    return encodings
+
+
+def normalize(encoding: str | None) -> str:
+    encoding = (encoding or IDENTITY).strip().lower()
+    return ALIASES.get(encoding, encoding)
+
+
+def negotiate(accept_encoding: str | None) -> str:
+    """Picks the first client-preferred encoding supported by the server"""
+    supported = available_encodings()
+    for option in (accept_encoding or "").split(","):
+        encoding = normalize(option.split(";", maxsplit=1)[0])
+        if encoding in supported:
+            return encoding
+    return IDENTITY
+
+
+def compressor(encoding: str, level: int | None = None):
+    encoding = normalize(encoding)
+    level = DEFAULT_LEVELS.get(encoding) if level is None else level
+    if encoding == DEFLATE:
+        return zlib.compressobj(level)
+    if encoding == ZSTD and zstandard is not None:
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    if encoding == IDENTITY:
+        return IdentityCodec()
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+
+def decompressor(encoding: str | None):
+    encoding = normalize(encoding)
+    if encoding == DEFLATE:
+        return zlib.decompressobj()
+    if encoding == ZSTD and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    if encoding == IDENTITY:
+        return IdentityCodec()
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+
+def compress_stream(
+    chunks: Iterable[bytes], encoding: str, level: int | None = None
+) -> Iterator[bytes]:
+    """Compresses chunks one by one without joining the whole payload"""
+    codec = compressor(encoding, level)
+    for chunk in chunks:
+        if compressed := codec.compress(chunk):
+            yield compressed
+    if tail := codec.flush():
+        yield tail
+
+
+def split(payload: bytes, chunk_size: int) -> Iterator[memoryview]:
+    view = memoryview(payload)
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
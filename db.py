@@ -1,19 +1,30 @@
 import asyncio
+import bisect
+import heapq
+import itertools
+import operator
 import uuid
+from collections import deque
+from collections.abc import MutableMapping
 from dataclasses import asdict, dataclass, field, is_dataclass
 from datetime import date, datetime
 from functools import wraps
 from json import JSONEncoder
-from typing import Any, ClassVar, Iterable
+from operator import attrgetter
+from typing import Any, Callable, ClassVar, Iterable, Iterator
 
 import funcy
 
 from constants import ChatType
 from errors import MaxMembersError, NotConnectedError
+from presence import Presence
+from retention import Retention
 from settings import (
+    DEFAULT_CHAT_CHANGES_KEPT,
     DEFAULT_DB_CONNECTION_WAIT_SECS,
     DEFAULT_MAX_CONNECTIONS,
     DEFAULT_MSG_COUNT,
+    DEFAULT_STORAGE_SHARDS,
 )
 
 
@@ -32,60 +43,363 @@ class DbEncoder(JSONEncoder):
         return super().default(obj)
 
 
+def as_uuid(pk: str | uuid.UUID) -> uuid.UUID:
+    """Id as a UUID, parsing it unless a request schema already did"""
+    return pk if isinstance(pk, uuid.UUID) else uuid.UUID(pk)
+
+
+def load_uuid(value: str | None) -> uuid.UUID | None:
+    return None if value is None else uuid.UUID(value)
+
+
+def load_datetime(value: str | None) -> datetime | None:
+    return None if value is None else datetime.fromisoformat(value)
+
+
 @dataclass
 class User:
     id: uuid.UUID
     banned_when: datetime | None = None
     is_banned: bool = False
     reported_times: int = 0
+    # set on the instance while the user is stored
+    counters: ClassVar["StorageCounters | None"] = None
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if (
+            name == "is_banned"
+            and self.counters is not None
+            and value != self.is_banned
+        ):
+            self.counters.banned(value)
+        super().__setattr__(name, value)
+
+    def __getstate__(self) -> dict:
+        # a pickled user leaves the storage behind
+        return {
+            name: value
+            for name, value in self.__dict__.items()
+            if name != "counters"
+        }
+
+    @classmethod
+    def load(cls, data: dict) -> "User":
+        return cls(
+            id=uuid.UUID(data["id"]),
+            banned_when=load_datetime(data.get("banned_when")),
+            is_banned=data.get("is_banned", False),
+            reported_times=data.get("reported_times", 0),
+        )
 
 
-@dataclass(eq=True, frozen=True)
+# slots keep a storage of millions of messages gigabytes smaller
+@dataclass(eq=True, frozen=True, slots=True)
 class Message:
     id: uuid.UUID
     created: datetime
     author: uuid.UUID
     text: str
     is_comment_on: uuid.UUID | None = None
+    expires: datetime | None = None
+
+    def serialize(self) -> dict:
+        return dict(
+            id=self.id,
+            created=self.created,
+            author=self.author,
+            text=self.text,
+            is_comment_on=self.is_comment_on,
+            expires=self.expires,
+        )
+
+    def __reduce__(self) -> tuple:
+        # pickled as a row, ids as ints, for the offload pool
+        return self.from_row, (
+            self.id.int,
+            self.created,
+            self.author.int,
+            self.text,
+            self.is_comment_on and self.is_comment_on.int,
+            self.expires,
+        )
+
+    @classmethod
+    def from_row(
+        cls,
+        pk: int,
+        created: datetime,
+        author: int,
+        text: str,
+        is_comment_on: int | None,
+        expires: datetime | None,
+    ) -> "Message":
+        return cls(
+            uuid.UUID(int=pk),
+            created,
+            uuid.UUID(int=author),
+            text,
+            None if is_comment_on is None else uuid.UUID(int=is_comment_on),
+            expires,
+        )
+
+    @classmethod
+    def load(cls, data: dict) -> "Message":
+        return cls(
+            id=uuid.UUID(data["id"]),
+            created=datetime.fromisoformat(data["created"]),
+            author=uuid.UUID(data["author"]),
+            text=data["text"],
+            is_comment_on=load_uuid(data.get("is_comment_on")),
+            expires=load_datetime(data.get("expires")),
+        )
+
+
+# (created, id) of a message; ids minted by the server grow with time,
+# so they keep the order of messages written at the same moment
+timeline_key: Callable[[Message], tuple[datetime, uuid.UUID]] = attrgetter(
+    "created", "id"
+)
+
+
+def created_in_order(messages: list[Message]) -> bool:
+    """Whether every message was created after the one before
+
+    Checks far faster than sorting builds keys, and chats loaded in bulk
+    hold their messages in this order already.
+    """
+    times = list(map(attrgetter("created"), messages))
+    return all(map(operator.lt, times, itertools.islice(times, 1, None)))
+
+
+def new_incarnation() -> str:
+    return uuid.uuid4().hex[:8]
+
+
+def new_changes() -> deque:
+    return deque(maxlen=DEFAULT_CHAT_CHANGES_KEPT)
 
 
 @dataclass
 class Chat:
+    """Chat with a version counting its changes
+
+    Versions are sent as `<incarnation>-<version>` tags. Changes since a
+    recent version are kept, so that a client holding it gets only new
+    messages and membership changes. A chat restored from elsewhere
+    starts a new incarnation, so older tags always mean a full resend.
+
+    Messages are also kept in a timeline ordered by `timeline_key`, so
+    the newest ones before any point are found by bisection. Deleted
+    messages are skipped and dropped from it once they make up half.
+    """
+
+    MESSAGE: ClassVar[str] = "message"
+    ENTER: ClassVar[str] = "enter"
+    LEAVE: ClassVar[str] = "leave"
+    DELETE: ClassVar[str] = "delete"
+
     id: uuid.UUID
     name: str
     type: ClassVar[ChatType] = ChatType.COMMON
+    # set on the instance while the chat is stored
+    counters: ClassVar["StorageCounters | None"] = None
+    retention: ClassVar["Retention | None"] = None
+    presence: ClassVar["Presence | None"] = None
     messages: dict[Message] = field(default_factory=dict)
     authors: set[uuid.UUID] = field(default_factory=set)
+    # storage-wide creation order, kept across shards
+    sequence: int = field(default=0, compare=False)
+    version: int = field(default=0, compare=False)
+    incarnation: str = field(default_factory=new_incarnation, compare=False)
+    changes: deque = field(
+        default_factory=new_changes, compare=False, repr=False
+    )
+    timeline: list[Message] = field(
+        default_factory=list, compare=False, repr=False
+    )
+    # messages of the timeline deleted since it was compacted
+    stale: int = field(default=0, compare=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self.timeline = sorted(self.messages.values(), key=timeline_key)
 
     @property
     def size(self) -> int:
         return len(self.authors)
 
+    @property
+    def online(self) -> int:
+        if self.presence is None:
+            return 0
+        return self.presence.online_in(self.id)
+
+    @property
+    def etag(self) -> str:
+        return f"{self.incarnation}-{self.version}"
+
+    def changed(self, kind: str, key: uuid.UUID) -> None:
+        self.version += 1
+        self.changes.append((kind, key))
+
+    def invalidate(self) -> None:
+        """Forces a full resend after the chat was changed in place"""
+        self.incarnation = new_incarnation()
+        self.version = 0
+        self.changes.clear()
+        self.timeline = list(self.messages.values())
+        if not created_in_order(self.timeline):
+            self.timeline.sort(key=timeline_key)
+        self.stale = 0
+
+    def changes_since(self, etag: str) -> list[tuple] | None:
+        """Changes after the tagged version, None if they are not kept"""
+        incarnation, _, version = etag.partition("-")
+        if incarnation != self.incarnation or not version.isdigit():
+            return None
+        behind = self.version - int(version)
+        if not 0 <= behind <= len(self.changes):
+            return None
+        return list(
+            itertools.islice(
+                self.changes, len(self.changes) - behind, None
+            )
+        )
+
     def add_message(self, message: Message) -> None:
+        if message.id in self.messages:
+            self.stale += 1
         self.messages[message.id] = message
+        if self.timeline and timeline_key(message) < timeline_key(
+            self.timeline[-1]
+        ):
+            bisect.insort(self.timeline, message, key=timeline_key)
+        else:
+            self.timeline.append(message)
+        self.changed(self.MESSAGE, message.id)
+        if self.retention is not None:
+            self.retention.added(self, message)
+
+    def delete_message(self, pk: uuid.UUID) -> Message | None:
+        if (message := self.messages.pop(pk, None)) is not None:
+            self.changed(self.DELETE, pk)
+            self.stale += 1
+            if self.stale * 2 > len(self.timeline):
+                self.timeline = [
+                    kept
+                    for kept in self.timeline
+                    if self.messages.get(kept.id) is kept
+                ]
+                self.stale = 0
+        return message
+
+    def history_before(self, key: tuple | None = None) -> Iterator[Message]:
+        """Messages newest first, only those before `key` if it is given"""
+        end = len(self.timeline)
+        if key is not None:
+            end = bisect.bisect_left(self.timeline, key, key=timeline_key)
+        for index in range(end - 1, -1, -1):
+            message = self.timeline[index]
+            if self.messages.get(message.id) is message:
+                yield message
+
+    def newest(self, count: int) -> list[Message]:
+        """The newest `count` messages, newest first"""
+        if not self.stale:
+            return self.timeline[:-count - 1:-1]
+        return list(itertools.islice(self.history_before(), count))
 
     def enter(self, author: User) -> None:
         if author.id not in self.authors:
             self.authors.add(author.id)
+            self.changed(self.ENTER, author.id)
+            if self.counters is not None:
+                self.counters.entered(self.id, author.id)
+            if self.presence is not None:
+                self.presence.entered(self.id, author.id)
 
     def leave(self, author: User) -> None:
         if author.id in self.authors:
             self.authors.remove(author.id)
+            self.changed(self.LEAVE, author.id)
+            if self.counters is not None:
+                self.counters.left(self.id, author.id)
+            if self.presence is not None:
+                self.presence.left(self.id, author.id)
 
     def serialize(self, count: int = DEFAULT_MSG_COUNT) -> dict:
         obj = dict(
             id=self.id,
             name=self.name,
-            messages=sorted(
-                self.messages.values(),
-                key=lambda obj: obj.created,
-                reverse=True,
-            )[:count],
+            messages=self.newest(count),
             authors=self.authors,
             size=self.size,
+            online=self.online,
+            version=self.etag,
         )
         return obj
 
+    def serialize_since(
+        self, etag: str | None, count: int = DEFAULT_MSG_COUNT
+    ) -> dict:
+        """Serializes only what changed since the tagged version
+
+        Answers `not_modified` when nothing changed and a `delta` with the
+        new and deleted messages and members who entered or left when the
+        changes are kept and there are at most `count` new messages.
+        Otherwise the chat is serialized in full. Presence is not versioned,
+        so the online count is sent in every answer.
+        """
+        changes = self.changes_since(etag) if etag else None
+        if changes is None:
+            return self.serialize(count)
+        if not changes:
+            return dict(
+                id=self.id,
+                version=self.etag,
+                not_modified=True,
+                online=self.online,
+            )
+        message_ids = [key for kind, key in changes if kind == self.MESSAGE]
+        if len(message_ids) > count:
+            return self.serialize(count)
+        members = {
+            key for kind, key in changes if kind in (self.ENTER, self.LEAVE)
+        }
+        messages = [
+            self.messages[pk] for pk in message_ids if pk in self.messages
+        ]
+        return dict(
+            id=self.id,
+            version=self.etag,
+            delta=True,
+            messages=sorted(messages, key=timeline_key, reverse=True),
+            deleted=[pk for kind, pk in changes if kind == self.DELETE],
+            entered=[pk for pk in members if pk in self.authors],
+            left=[pk for pk in members if pk not in self.authors],
+            size=self.size,
+            online=self.online,
+        )
+
+    def dump(self) -> dict:
+        """Serializes the whole chat, so that load() can restore it"""
+        data = dict(self.serialize(len(self.messages)), type=self.type)
+        del data["online"]
+        return data
+
+    @classmethod
+    def load(cls, data: dict) -> "Chat":
+        chat_class = (
+            PeerToPeerChat if data.get("type") == ChatType.PRIVATE else Chat
+        )
+        chat = chat_class(
+            id=uuid.UUID(data["id"]),
+            name=data["name"],
+            authors=set(map(uuid.UUID, data.get("authors", ()))),
+        )
+        for message in reversed(data.get("messages", ())):
+            chat.add_message(Message.load(message))
+        return chat
+
 
 @dataclass
 class PeerToPeerChat(Chat):
@@ -106,33 +420,291 @@ class Complaint:
     reason: str
     reviewed: bool = False
 
+    @classmethod
+    def load(cls, data: dict) -> "Complaint":
+        return cls(
+            id=uuid.UUID(data["id"]),
+            author=uuid.UUID(data["author"]),
+            created=datetime.fromisoformat(data["created"]),
+            reported_user=uuid.UUID(data["reported_user"]),
+            reason=data["reason"],
+            reviewed=data.get("reviewed", False),
+        )
 
-class ChatStorage:
-    def __init__(self, max_connections: int = DEFAULT_MAX_CONNECTIONS) -> None:
+
+class StorageCounters:
+    """Storage-wide totals updated on every change, so reading is O(1)
+
+    Stored chats and users point here and report entering, leaving and
+    ban transitions themselves. The chats of every user are kept too.
+    """
+
+    def __init__(self) -> None:
+        self.chats = 0
+        self.user_chats: dict[uuid.UUID, set[uuid.UUID]] = {}
+        self.banned_users = 0
+
+    def add_chat(self, chat: Chat) -> None:
+        chat.counters = self
+        self.chats += 1
+        for author in chat.authors:
+            self.entered(chat.id, author)
+
+    def remove_chat(self, chat: Chat) -> None:
+        chat.counters = None
+        self.chats -= 1
+        for author in chat.authors:
+            self.left(chat.id, author)
+
+    def chats_of(self, user_id: uuid.UUID) -> set[uuid.UUID]:
+        return self.user_chats.get(user_id, set())
+
+    def entered(self, chat_id: uuid.UUID, user_id: uuid.UUID) -> None:
+        self.user_chats.setdefault(user_id, set()).add(chat_id)
+
+    def left(self, chat_id: uuid.UUID, user_id: uuid.UUID) -> None:
+        if (chats := self.user_chats.get(user_id)) is not None:
+            chats.discard(chat_id)
+            if not chats:
+                del self.user_chats[user_id]
+
+    def add_user(self, user: User) -> None:
+        user.counters = self
+        self.banned_users += user.is_banned
+
+    def remove_user(self, user: User) -> None:
+        user.counters = None
+        self.banned_users -= user.is_banned
+
+    def banned(self, is_banned: bool) -> None:
+        self.banned_users += 1 if is_banned else -1
+
+
+class CountedDict(dict):
+    """Dict reporting the values stored in and removed from it"""
+
+    def __init__(
+        self,
+        on_add: Callable[[Any], None],
+        on_remove: Callable[[Any], None],
+    ) -> None:
+        super().__init__()
+        self.on_add = on_add
+        self.on_remove = on_remove
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        if (old := self.get(key)) is not None:
+            self.on_remove(old)
+        super().__setitem__(key, value)
+        self.on_add(value)
+
+    def __delitem__(self, key: Any) -> None:
+        self.on_remove(self[key])
+        super().__delitem__(key)
+
+    def pop(self, key: Any, *default: Any) -> Any:
+        if key in self:
+            self.on_remove(self[key])
+        return super().pop(key, *default)
+
+    def popitem(self) -> tuple:
+        key, value = super().popitem()
+        self.on_remove(value)
+        return key, value
+
+    def setdefault(self, key: Any, default: Any = None) -> Any:
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self) -> None:
+        for value in self.values():
+            self.on_remove(value)
+        super().clear()
+
+
+class ChatStorageShard:
+    def __init__(
+        self,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        chats: dict | None = None,
+        users: dict | None = None,
+    ) -> None:
         self.connections = set()
         self.max_connections = max_connections
         # db
-        self.chats: dict[uuid.UUID, Chat] = {}
-        self.users: dict[uuid.UUID, User] = {}
+        self.chats: dict[uuid.UUID, Chat] = {} if chats is None else chats
+        self.users: dict[uuid.UUID, User] = {} if users is None else users
         self.complaints: dict[uuid.UUID, Complaint] = {}
 
-    async def connect(self) -> "ChatStorageCursor":
-        while len(self.connections) > self.max_connections:
-            await asyncio.sleep(DEFAULT_DB_CONNECTION_WAIT_SECS)
-        connection = ChatStorageCursor(self)
-        self.connections.add(id(connection))
+
+class ShardedDict(MutableMapping):
+    """Dict-like view routing every key to the dict of its shard"""
+
+    def __init__(self, db: "ChatStorage", name: str) -> None:
+        self.db = db
+        self.name = name
+
+    def part(self, key: Any) -> dict:
+        return getattr(self.db.shards[self.db.shard_index(key)], self.name)
+
+    def parts(self) -> Iterator[dict]:
+        return (getattr(shard, self.name) for shard in self.db.shards)
+
+    def __getitem__(self, key: Any) -> Any:
+        return self.part(key)[key]
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        self.part(key)[key] = value
+
+    def __delitem__(self, key: Any) -> None:
+        del self.part(key)[key]
+
+    def __iter__(self) -> Iterator:
+        return itertools.chain.from_iterable(self.parts())
+
+    def __len__(self) -> int:
+        return sum(map(len, self.parts()))
+
+    def reset(self, data: dict) -> None:
+        for part in self.parts():
+            part.clear()
+        self.update(data)
+
+
+class ChatStorage:
+    def __init__(
+        self,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        shards: int = DEFAULT_STORAGE_SHARDS,
+        retention: Retention | None = None,
+        presence: Presence | None = None,
+    ) -> None:
+        self.max_connections = max_connections
+        self.counters = StorageCounters()
+        self.retention = Retention() if retention is None else retention
+        self.presence = Presence() if presence is None else presence
+        self.presence.counters = self.counters
+        self.shards = [
+            ChatStorageShard(
+                max_connections,
+                chats=CountedDict(self.chat_stored, self.chat_dropped),
+                users=CountedDict(
+                    self.counters.add_user, self.counters.remove_user
+                ),
+            )
+            for _ in range(shards)
+        ]
+        # connection -> indexes of the shards it holds
+        self.cursors: dict[int, tuple[int, ...]] = {}
+        # cursors waiting for a busy shard
+        self.waiting = 0
+        self.default_chat_id = None
+        self.chat_sequence = itertools.count(1)
+
+    def chat_stored(self, chat: Chat) -> None:
+        self.counters.add_chat(chat)
+        self.presence.add_chat(chat)
+        self.retention.track(chat)
+
+    def chat_dropped(self, chat: Chat) -> None:
+        self.counters.remove_chat(chat)
+        self.presence.remove_chat(chat)
+        self.retention.untrack(chat)
+
+    @property
+    def connections(self) -> set[int]:
+        return set(self.cursors)
+
+    @property
+    def chats(self) -> ShardedDict:
+        return ShardedDict(self, "chats")
+
+    @chats.setter
+    def chats(self, data: dict) -> None:
+        self.chats.reset(data)
+
+    @property
+    def users(self) -> ShardedDict:
+        return ShardedDict(self, "users")
+
+    @users.setter
+    def users(self, data: dict) -> None:
+        self.users.reset(data)
+
+    @property
+    def complaints(self) -> ShardedDict:
+        return ShardedDict(self, "complaints")
+
+    @complaints.setter
+    def complaints(self, data: dict) -> None:
+        self.complaints.reset(data)
+
+    def shard_index(self, key: Any) -> int:
+        if not isinstance(key, uuid.UUID):
+            key = uuid.UUID(str(key))
+        return hash(key) % len(self.shards)
+
+    def shard_indexes(self, keys: Iterable[Any]) -> tuple[int, ...]:
+        """Sorted shards of the keys, all of them if any key is unknown"""
+        if not keys or any(key is None for key in keys):
+            return tuple(range(len(self.shards)))
+        return tuple(sorted(set(map(self.shard_index, keys))))
+
+    async def connect(self, *keys: Any) -> "ChatStorageCursor":
+        """Opens a cursor holding the shards of the keys (all by default)
+
+        Shards are always acquired in ascending order, so cursors spanning
+        several shards cannot deadlock each other.
+        """
+        indexes = self.shard_indexes(keys)
+        connection = ChatStorageCursor(self, indexes)
+        self.cursors[id(connection)] = ()
+        try:
+            for index in indexes:
+                shard = self.shards[index]
+                if len(shard.connections) > shard.max_connections:
+                    await self.wait_for_shard(shard)
+                shard.connections.add(id(connection))
+                self.cursors[id(connection)] += (index,)
+        except BaseException:
+            self.disconnect(id(connection))
+            raise
         return connection
 
+    async def wait_for_shard(self, shard: ChatStorageShard) -> None:
+        self.waiting += 1
+        try:
+            while len(shard.connections) > shard.max_connections:
+                await asyncio.sleep(DEFAULT_DB_CONNECTION_WAIT_SECS)
+        finally:
+            self.waiting -= 1
+
     def disconnect(self, connection: int) -> None:
-        self.connections.discard(connection)
+        for index in self.cursors.pop(connection, ()):
+            self.shards[index].connections.discard(connection)
+
+    def new_chat_id(self) -> uuid.UUID:
+        return uuid.uuid4()
 
     def check_connected(self, connection: int) -> bool:
-        return connection in self.connections
+        return connection in self.cursors
 
 
 class ChatStorageCursor:
-    def __init__(self, db: ChatStorage | None = None) -> None:
+    def __init__(
+        self,
+        db: ChatStorage | None = None,
+        shards: Iterable[int] | None = None,
+    ) -> None:
         self.db = db
+        if shards is None and db is not None:
+            shards = range(len(db.shards))
+        self.shards = tuple(shards or ())
 
     def disconnect(self) -> None:
         self.db.disconnect(id(self))
@@ -147,6 +719,24 @@ class ChatStorageCursor:
 
         return inner
 
+    def route(self, key: Any) -> ChatStorageShard:
+        """Picks the shard of the key, which must be held by the cursor"""
+        if (index := self.db.shard_index(key)) not in self.shards:
+            raise NotConnectedError
+        return self.db.shards[index]
+
+    def held_shards(self) -> Iterator[ChatStorageShard]:
+        return (self.db.shards[index] for index in self.shards)
+
+    def new_id(
+        self, factory: Callable[[], uuid.UUID] = uuid.uuid4
+    ) -> uuid.UUID:
+        """Mints an id routed to one of the shards held by the cursor"""
+        new_id = factory()
+        while self.db.shard_index(new_id) not in self.shards:
+            new_id = factory()
+        return new_id
+
     @staticmethod
     def first_not_none(sequence: Iterable[Any]) -> Any:
         return funcy.first(filter(funcy.notnone, sequence))
@@ -154,29 +744,59 @@ class ChatStorageCursor:
     @check_connected
     def create_complaint(self, **kwargs) -> str:
         kwargs.pop("id", None)
-        new_complaint_id = uuid.uuid4()
-        self.db.complaints[new_complaint_id] = Complaint(
+        new_complaint_id = self.new_id()
+        self.route(new_complaint_id).complaints[new_complaint_id] = Complaint(
             id=new_complaint_id, **kwargs
         )
         return str(new_complaint_id)
 
+    @check_connected
+    def add_complaint(self, complaint: Complaint) -> str:
+        self.route(complaint.id).complaints[complaint.id] = complaint
+        return str(complaint.id)
+
+    @check_connected
+    def delete_complaint(self, pk: str | uuid.UUID) -> Complaint | None:
+        complaint_id = as_uuid(pk)
+        return self.route(complaint_id).complaints.pop(complaint_id, None)
+
     @check_connected
     def get_complaint_list(self) -> list[Complaint]:
-        return self.db.complaints.values()
+        return [
+            complaint
+            for shard in self.held_shards()
+            for complaint in shard.complaints.values()
+        ]
 
     @check_connected
     def create_user(self) -> str:
-        new_user_id = uuid.uuid4()
-        self.db.users[new_user_id] = User(new_user_id)
+        new_user_id = self.new_id()
+        self.route(new_user_id).users[new_user_id] = User(new_user_id)
         return str(new_user_id)
 
     @check_connected
-    def get_user(self, pk: str) -> User:
-        return self.db.users.get(uuid.UUID(pk))
+    def add_user(self, user: User) -> str:
+        """Stores a user built elsewhere, replacing the one with its id"""
+        self.route(user.id).users[user.id] = user
+        return str(user.id)
+
+    @check_connected
+    def get_user(self, pk: str | uuid.UUID) -> User:
+        user_id = as_uuid(pk)
+        return self.route(user_id).users.get(user_id)
 
     @check_connected
     def get_user_list(self) -> list[User]:
-        return self.db.users.values()
+        return [
+            user
+            for shard in self.held_shards()
+            for user in shard.users.values()
+        ]
+
+    @check_connected
+    def count_banned_users(self) -> int:
+        """Banned users in the whole storage, not only the held shards"""
+        return self.db.counters.banned_users
 
     @check_connected
     def get_default_chat_id(self) -> str:
@@ -187,27 +807,62 @@ class ChatStorageCursor:
     @check_connected
     def create_chat(self, **kwargs) -> str:
         kwargs.pop("id", None)
-        new_chat_id = uuid.uuid4()
-        self.db.chats[new_chat_id] = Chat(id=new_chat_id, **kwargs)
+        new_chat_id = self.new_id(self.db.new_chat_id)
+        self.route(new_chat_id).chats[new_chat_id] = Chat(
+            id=new_chat_id, sequence=next(self.db.chat_sequence), **kwargs
+        )
         return str(new_chat_id)
 
     @check_connected
     def create_p2p_chat(self, **kwargs) -> str:
         kwargs.pop("id", None)
-        new_chat_id = uuid.uuid4()
-        self.db.chats[new_chat_id] = PeerToPeerChat(id=new_chat_id, **kwargs)
+        new_chat_id = self.new_id(self.db.new_chat_id)
+        self.route(new_chat_id).chats[new_chat_id] = PeerToPeerChat(
+            id=new_chat_id, sequence=next(self.db.chat_sequence), **kwargs
+        )
         return str(new_chat_id)
 
     @check_connected
-    def get_chat(self, pk: str) -> Chat:
-        return self.db.chats.get(uuid.UUID(pk))
+    def add_chat(self, chat: Chat) -> str:
+        """Stores a chat built elsewhere, replacing the one with its id"""
+        if not chat.sequence:
+            chat.sequence = next(self.db.chat_sequence)
+        self.route(chat.id).chats[chat.id] = chat
+        return str(chat.id)
+
+    @check_connected
+    def delete_chat(self, pk: str | uuid.UUID) -> Chat | None:
+        chat_id = as_uuid(pk)
+        return self.route(chat_id).chats.pop(chat_id, None)
+
+    @check_connected
+    def get_chat(self, pk: str | uuid.UUID) -> Chat:
+        chat_id = as_uuid(pk)
+        return self.route(chat_id).chats.get(chat_id)
+
+    @check_connected
+    def count_chats(self) -> int:
+        """Chats in the whole storage, not only the held shards"""
+        return self.db.counters.chats
+
+    @check_connected
+    def count_chats_with_user(self, pk: str | uuid.UUID) -> int:
+        return len(self.db.counters.chats_of(as_uuid(pk)))
 
     @check_connected
     def get_chat_list(self) -> list[Chat]:
-        return self.db.chats.values()
+        return list(
+            heapq.merge(
+                *(shard.chats.values() for shard in self.held_shards()),
+                key=attrgetter("sequence"),
+            )
+        )
 
     @check_connected
-    def get_message(self, pk: str) -> Message:
+    def get_message(self, pk: str | uuid.UUID) -> Message:
+        message_id = as_uuid(pk)
         return self.first_not_none(
-            chat.messages.get(uuid.UUID(pk)) for chat in self.db.chats.values()
+            chat.messages.get(message_id)
+            for shard in self.held_shards()
+            for chat in shard.chats.values()
         )
@@ -0,0 +1,80 @@
+"""Deduplication of retried requests by a client-supplied key.
+
+A client sends the same `idempotency-key` header with every attempt of a
+request. The first attempt runs, later ones get its response without
+touching storage, and attempts arriving while it runs wait for it.
+Failed responses are not kept, so a retry after a failure runs again.
+
+Keys live for `ttl_secs` and at most `max_entries` are kept, the oldest
+are dropped first.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable
+
+from settings import (
+    DEFAULT_IDEMPOTENCY_CACHE_SIZE,
+    DEFAULT_IDEMPOTENCY_TTL_SECS,
+)
+
+
+class IdempotencyCache:
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_IDEMPOTENCY_CACHE_SIZE,
+        ttl_secs: float = DEFAULT_IDEMPOTENCY_TTL_SECS,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl_secs = ttl_secs
+        self.clock = clock
+        # every key has the same ttl, so insertion order is expiry order
+        self.entries: OrderedDict[Hashable, tuple[float, asyncio.Future]] = (
+            OrderedDict()
+        )
+        self.hits = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def evict(self, now: float) -> None:
+        while self.entries and (
+            len(self.entries) > self.max_entries
+            or next(iter(self.entries.values()))[0] <= now
+        ):
+            self.entries.popitem(last=False)
+
+    def forget(self, key: Hashable, future: asyncio.Future) -> None:
+        if (entry := self.entries.get(key)) is not None and entry[1] is future:
+            del self.entries[key]
+
+    async def run(
+        self, key: Hashable, call: Callable[[], Awaitable[dict]]
+    ) -> dict:
+        """Returns the kept response of the key or runs call for it"""
+        now = self.clock()
+        self.evict(now)
+        if (entry := self.entries.get(key)) is not None:
+            self.hits += 1
+            # a waiter cancelled by its connection must not cancel the run
+            return await asyncio.shield(entry[1])
+
+        future = asyncio.get_running_loop().create_future()
+        self.entries[key] = (now + self.ttl_secs, future)
+        self.evict(now)
+        try:
+            response = await call()
+        except BaseException as error:
+            self.forget(key, future)
+            if isinstance(error, Exception):
+                future.set_exception(error)
+                # waiters may be gone, the error is raised here anyway
+                future.exception()
+            else:
+                future.cancel()
+            raise
+        if "fail" in response:
+            self.forget(key, future)
+        future.set_result(response)
+        return response
@@ -0,0 +1,235 @@
+"""Logging setup for the server entry points.
+
+In queued mode handlers on the event loop thread only put records on a
+queue; a QueueListener thread formats and writes them. Messages use
+%-style arguments, which are merged into the message text by the
+listener, so a record that is sampled out or never written is never
+formatted. Arguments are formatted after the call returns, so they should
+not be mutated afterwards.
+"""
+import argparse
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from contextlib import suppress
+from datetime import datetime, timezone
+from typing import Mapping
+
+from settings import (
+    DEFAULT_LOG_JSON,
+    DEFAULT_LOG_LEVEL,
+    DEFAULT_LOG_LINGER_SECS,
+    DEFAULT_LOG_QUEUED,
+    DEFAULT_LOG_SAMPLE,
+)
+
+TEXT_FORMAT = "[%(levelname)s] - %(asctime)s - %(message)s"
+DATE_FORMAT = "%H:%M:%S"
+MAX_BATCH = 2**12
+
+listener: "BatchingQueueListener | None" = None
+
+
+def parse_sample_rates(value: str) -> dict[str, int]:
+    """Parses `server=100,db=10`: keep one record in N of a logger"""
+    rates = {}
+    for item in filter(None, map(str.strip, value.split(","))):
+        name, rate = item.split("=", maxsplit=1)
+        rates[name.strip()] = int(rate)
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Passes one record in N per logger below WARNING"""
+
+    def __init__(self, rates: Mapping[str, int]) -> None:
+        super().__init__()
+        self.rates = dict(rates)
+        self.counters = dict.fromkeys(self.rates, 0)
+
+    def rate(self, name: str) -> int:
+        # the closest configured ancestor logger decides
+        while name not in self.rates:
+            if "." not in name:
+                return self.rates.get("", 1)
+            name = name.rsplit(".", maxsplit=1)[0]
+        return self.rates[name]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        if (rate := self.rate(record.name)) <= 1:
+            return True
+        count = self.counters.get(record.name, 0)
+        self.counters[record.name] = count + 1
+        return count % rate == 0
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records without formatting their messages"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            # tracebacks hold frames that keep changing, render them now
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+        return record
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """Handles the records queued within `linger` seconds in one batch
+
+    Waking up once per batch keeps the listener thread from contending
+    with the event loop for the GIL on every record, and the handlers
+    flush once per batch instead of once per record.
+    """
+
+    def __init__(
+        self, *args, linger: float = DEFAULT_LOG_LINGER_SECS, **kwargs
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.linger = linger
+
+    def _monitor(self) -> None:
+        while True:
+            batch = [self.dequeue(True)]
+            time.sleep(self.linger)
+            with suppress(queue.Empty):
+                while len(batch) < MAX_BATCH:
+                    batch.append(self.dequeue(False))
+            records = [item for item in batch if item is not self._sentinel]
+            for handler in self.handlers:
+                if isinstance(handler, BatchStreamHandler):
+                    handler.handle_batch(records)
+                else:
+                    for record in records:
+                        handler.handle(record)
+            if len(records) < len(batch):
+                return
+
+
+class BatchStreamHandler(logging.StreamHandler):
+    def handle_batch(self, records: list[logging.LogRecord]) -> None:
+        """Writes records with a single write and flush"""
+        lines = [
+            self.format(record)
+            for record in records
+            if record.levelno >= self.level and self.filter(record)
+        ]
+        if not lines:
+            return
+        self.acquire()
+        try:
+            self.stream.write(self.terminator.join(lines) + self.terminator)
+            self.flush()
+        finally:
+            self.release()
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": datetime.fromtimestamp(
+                record.created, timezone.utc
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+def restart_listener() -> None:
+    """Replaces the queue and thread of the listener in a forked child"""
+    if listener is None:
+        return
+    new_queue = queue.SimpleQueue()
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, LazyQueueHandler):
+            handler.queue = new_queue
+    listener.queue = new_queue
+    listener._thread = None
+    listener.start()
+
+
+def setup_logging(
+    level: str = DEFAULT_LOG_LEVEL,
+    queued: bool = DEFAULT_LOG_QUEUED,
+    json_output: bool = DEFAULT_LOG_JSON,
+    sample_rates: Mapping[str, int] | str = DEFAULT_LOG_SAMPLE,
+) -> None:
+    global listener
+
+    if isinstance(sample_rates, str):
+        sample_rates = parse_sample_rates(sample_rates)
+    output = BatchStreamHandler()
+    output.setFormatter(
+        JsonFormatter()
+        if json_output
+        else logging.Formatter(TEXT_FORMAT, datefmt=DATE_FORMAT)
+    )
+    handler = output
+    if queued:
+        records = queue.SimpleQueue()
+        handler = LazyQueueHandler(records)
+        stop_listener()
+        listener = BatchingQueueListener(records, output)
+        listener.start()
+    if sample_rates:
+        handler.addFilter(SamplingFilter(sample_rates))
+
+    root = logging.getLogger()
+    for old_handler in root.handlers[:]:
+        root.removeHandler(old_handler)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--log-level", default=DEFAULT_LOG_LEVEL)
+    parser.add_argument(
+        "--log-sync",
+        dest="log_queued",
+        action="store_false",
+        default=DEFAULT_LOG_QUEUED,
+        help="write log records on the calling thread",
+    )
+    parser.add_argument(
+        "--log-json",
+        action="store_true",
+        default=DEFAULT_LOG_JSON,
+        help="write one JSON object per record",
+    )
+    parser.add_argument(
+        "--log-sample",
+        default=DEFAULT_LOG_SAMPLE,
+        help="keep one INFO/DEBUG record in N per logger, e.g. server=100",
+    )
+
+
+def setup_from_args(args: argparse.Namespace) -> None:
+    setup_logging(
+        args.log_level, args.log_queued, args.log_json, args.log_sample
+    )
+
+
+def stop_listener() -> None:
+    global listener
+
+    if listener is not None and listener._thread is not None:
+        listener.stop()
+    listener = None
+
+
+atexit.register(stop_listener)
+os.register_at_fork(after_in_child=restart_listener)
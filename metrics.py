@@ -0,0 +1,273 @@
+"""In-process instrumentation exported in Prometheus text format.
+
+Metrics keep plain dicts of label tuples, so recording a sample costs a
+dict lookup and, for histograms, a bisect over precomputed bucket bounds.
+"""
+import abc
+import asyncio
+import bisect
+import time
+from typing import Iterable, Iterator
+
+UNKNOWN = "unknown"
+METHODS = ("GET", "POST")
+
+# log-linear (HDR-style) bounds: every power of two from 2**-20 s (~1 us)
+# to 2**6 s is split into 4 linear sub-buckets
+BUCKET_SUB_COUNT = 4
+BUCKET_MIN_EXPONENT = -20
+BUCKET_MAX_EXPONENT = 6
+
+
+def log_linear_bounds(
+    min_exponent: int = BUCKET_MIN_EXPONENT,
+    max_exponent: int = BUCKET_MAX_EXPONENT,
+    sub_count: int = BUCKET_SUB_COUNT,
+) -> tuple[float, ...]:
+    bounds = []
+    for exponent in range(min_exponent, max_exponent):
+        start = 2.0**exponent
+        step = start / sub_count
+        bounds.extend(start + step * index for index in range(sub_count))
+    bounds.append(2.0**max_exponent)
+    return tuple(bounds)
+
+
+DEFAULT_BOUNDS = log_linear_bounds()
+
+
+def format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{escape(value)}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def escape(value) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\n", "\\n")
+        .replace('"', '\\"')
+    )
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(abc.ABC):
+    type = "untyped"
+
+    def __init__(
+        self, name: str, documentation: str, labels: Iterable[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    @abc.abstractmethod
+    def samples(self) -> Iterator[str]:
+        pass
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+        yield from self.samples()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, labels: tuple = (), amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels: tuple = ()) -> float:
+        return self.values.get(labels, 0)
+
+    def samples(self) -> Iterator[str]:
+        for labels, value in sorted(self.values.items()):
+            yield (
+                f"{self.name}{format_labels(self.labels, labels)} "
+                f"{format_value(value)}"
+            )
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, labels: tuple = (), amount: float = 1) -> None:
+        self.inc(labels, -amount)
+
+    def set(self, value: float, labels: tuple = ()) -> None:
+        self.values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self, *args, bounds: tuple[float, ...] = DEFAULT_BOUNDS, **kwargs
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.bounds = bounds
+        # label values -> [bucket counts..., +Inf count, sum]
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, labels: tuple = ()) -> None:
+        if (row := self.values.get(labels)) is None:
+            row = self.values[labels] = [0] * (len(self.bounds) + 1) + [0.0]
+        row[bisect.bisect_left(self.bounds, value)] += 1
+        row[-1] += value
+
+    def count(self, labels: tuple = ()) -> int:
+        row = self.values.get(labels)
+        return sum(row[:-1]) if row else 0
+
+    def quantile(self, q: float, labels: tuple = ()) -> float:
+        """Upper bound of the bucket holding the q-th quantile"""
+        if not (total := self.count(labels)):
+            return 0.0
+        rank, seen = q * total, 0
+        for bound, bucket in zip(self.bounds, self.values[labels]):
+            seen += bucket
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self) -> Iterator[str]:
+        names = self.labels + ("le",)
+        for labels, row in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.bounds + (float("inf"),), row):
+                cumulative += bucket
+                # empty leading buckets carry no information
+                if cumulative or bound == float("inf"):
+                    le = format_labels(names, labels + (format_value(bound),))
+                    yield f"{self.name}_bucket{le} {cumulative}"
+            label_text = format_labels(self.labels, labels)
+            yield f"{self.name}_sum{label_text} {format_value(row[-1])}"
+            yield f"{self.name}_count{label_text} {cumulative}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self) -> str:
+        lines = [line for metric in self.metrics for line in metric.render()]
+        return "\n".join(lines) + "\n"
+
+
+class ServerMetrics(Registry):
+    """Metrics recorded by Server"""
+
+    def __init__(self, routes: Iterable[str] = ()) -> None:
+        super().__init__()
+        self.routes = frozenset(routes)
+        self.request_labels: dict[tuple[str, str], tuple[str, str]] = {}
+        self.errors = self.counter(
+            "yachat_request_errors_total",
+            "Failed requests by route and error class",
+            ("route", "error"),
+        )
+        # the _count series doubles as the request counter
+        self.latency = self.histogram(
+            "yachat_request_duration_seconds",
+            "Request handling time by route and method",
+            ("route", "method"),
+        )
+        self.cursor_wait = self.histogram(
+            "yachat_db_cursor_wait_seconds",
+            "Time spent waiting for storage shards",
+            ("user",),
+        )
+        self.cursor_hold = self.histogram(
+            "yachat_db_cursor_hold_seconds",
+            "Time storage shards were held",
+            ("user",),
+        )
+        self.shed = self.counter(
+            "yachat_requests_shed_total",
+            "Requests refused by admission control by reason and class",
+            ("reason", "class"),
+        )
+        self.expired = self.counter(
+            "yachat_messages_expired_total",
+            "Messages deleted by retention policies and TTLs",
+        )
+        self.online = self.gauge(
+            "yachat_users_online", "Users with a recent heartbeat"
+        )
+        self.connections = self.gauge(
+            "yachat_connections_in_flight", "Connections being served"
+        )
+        self.timeouts = self.counter(
+            "yachat_connection_timeouts_total",
+            "Connections closed past a header, body, idle or write deadline",
+            ("kind",),
+        )
+        self.refused = self.counter(
+            "yachat_connections_refused_total",
+            "Connections closed at once over the open connection cap",
+        )
+        self.offload_queue = self.gauge(
+            "yachat_offload_queue_depth",
+            "Tasks sent to the offload process pool and not finished",
+        )
+        self.offload_latency = self.histogram(
+            "yachat_offload_duration_seconds",
+            "Time offloaded tasks took, waiting for a worker included",
+        )
+        self.loop_lag = self.histogram(
+            "yachat_event_loop_lag_seconds",
+            "Delay of event loop wakeups past their deadline",
+        )
+
+    def route(self, url: str) -> str:
+        """Bounds label cardinality to the known routes"""
+        return url if url in self.routes else UNKNOWN
+
+    def observe_request(
+        self, url: str, method: str, started: float
+    ) -> None:
+        elapsed = time.perf_counter() - started
+        if (labels := self.request_labels.get((url, method))) is None:
+            labels = (
+                self.route(url),
+                method if method in METHODS else UNKNOWN,
+            )
+            if UNKNOWN not in labels:
+                self.request_labels[url, method] = labels
+        self.latency.observe(elapsed, labels)
+
+    def count_error(self, url: str, error: Exception) -> None:
+        self.errors.inc((self.route(url), type(error).__name__))
+
+    async def monitor_loop_lag(self, interval: float) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag = time.perf_counter() - started - interval
+            self.loop_lag.observe(max(lag, 0.0))
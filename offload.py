@@ -0,0 +1,165 @@
+"""Process pool for CPU-heavy work of the server.
+
+Encoding a response with many thousands of messages is seconds of pure
+Python, and on the event loop it stalls every other connection. Such
+responses are encoded in worker processes instead. Responses below
+`threshold` list items stay on the loop, where a round trip to a worker
+would cost more than the work. The pool is opt-in, a server without
+`OFFLOAD_WORKERS` encodes everything on the loop.
+
+Long lists of a response are pickled on the loop a slice at a time,
+yielding to other tasks between slices, so sending a response to a
+worker never stalls the loop for long either. Messages are pickled as
+compact rows of their fields.
+
+The encoded response comes back from the worker whole, a list of chunks
+pickled at once, so it is held in memory until it is sent. A worker
+streaming chunks back would need a queue between the processes and a
+round trip per chunk; for the response sizes worth offloading holding
+the encoded copy is cheaper, and the frozen copy sent to the worker is
+already as large.
+"""
+import asyncio
+import multiprocessing
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Any, Callable
+
+import utils
+from settings import DEFAULT_OFFLOAD_THRESHOLD, DEFAULT_OFFLOAD_WORKERS
+
+SLICE_ITEMS = 200
+
+
+class Slices(list):
+    """Pickled slices of a long list"""
+
+
+def count_items(data: Any, limit: int) -> int:
+    """Items in the lists of a response, counting stops past `limit`
+
+    Lists of a response hold items of one kind, so only lists starting
+    with a container are looked into.
+    """
+    count, pending = 0, [data]
+    while pending and count < limit:
+        item = pending.pop()
+        if isinstance(item, utils.JsonLines):
+            item = item.items
+        if isinstance(item, dict):
+            pending.extend(item.values())
+        elif isinstance(item, list):
+            count += len(item)
+            if item and isinstance(item[0], (dict, list)):
+                pending.extend(item)
+    return count
+
+
+async def freeze(data: Any) -> Any:
+    """Copy of data with long lists and sets pickled in slices
+
+    The loop runs other tasks between slices. Lists of containers are
+    frozen item by item, as their items may hold long lists too.
+    """
+    if isinstance(data, utils.JsonLines):
+        return utils.JsonLines(await freeze(data.items))
+    if isinstance(data, dict):
+        return {key: await freeze(value) for key, value in data.items()}
+    if isinstance(data, (set, frozenset)):
+        data = list(data)
+    if not isinstance(data, list):
+        return data
+    nested = bool(data) and isinstance(data[0], (dict, list))
+    if len(data) <= SLICE_ITEMS and not nested:
+        return data
+    slices = Slices()
+    for start in range(0, len(data), SLICE_ITEMS):
+        part = data[start:start + SLICE_ITEMS]
+        if nested:
+            part = [await freeze(item) for item in part]
+        slices.append(pickle.dumps(part, pickle.HIGHEST_PROTOCOL))
+        await asyncio.sleep(0)
+    return slices
+
+
+def thaw(data: Any) -> Any:
+    if isinstance(data, utils.JsonLines):
+        return utils.JsonLines(thaw(data.items))
+    if isinstance(data, dict):
+        return {key: thaw(value) for key, value in data.items()}
+    if isinstance(data, Slices):
+        return [
+            thaw(item) for part in data for item in pickle.loads(part)
+        ]
+    return data
+
+
+def encode(data: Any, chunk_size: int) -> list[bytes]:
+    """Encodes frozen data in a worker"""
+    return list(utils.iter_serialize(thaw(data), chunk_size))
+
+
+class Offloader:
+    def __init__(
+        self,
+        workers: int = DEFAULT_OFFLOAD_WORKERS,
+        threshold: int = DEFAULT_OFFLOAD_THRESHOLD,
+    ) -> None:
+        self.workers = workers
+        self.threshold = threshold
+        # created by the first task, Server.startup runs one at once
+        self.pool: ProcessPoolExecutor | None = None
+        self.pending = 0
+
+    def is_heavy(self, data: Any) -> bool:
+        """Whether data is worth encoding in a worker
+
+        JSON-lines responses qualify only with their items in a list,
+        lazy items cannot be sent to a worker.
+        """
+        if isinstance(data, utils.JsonLines):
+            if not isinstance(data.items, list):
+                return False
+        elif not isinstance(data, dict):
+            return False
+        return count_items(data, self.threshold) >= self.threshold
+
+    async def start(self) -> None:
+        """Starts the workers ahead of the first task"""
+        await asyncio.gather(
+            *(self.run(os.getpid) for _ in range(self.workers))
+        )
+
+    async def run(self, func: Callable, *args: Any) -> Any:
+        if self.pool is None:
+            # a forked worker would inherit the sockets and threads of
+            # the running server
+            self.pool = ProcessPoolExecutor(
+                self.workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.pool, func, *args
+            )
+        except BrokenProcessPool:
+            # a worker died, the next task gets a new pool
+            self.pool = None
+            raise
+        finally:
+            self.pending -= 1
+
+    async def encode(self, data: Any, chunk_size: int) -> list[bytes]:
+        return await self.run(encode, await freeze(data), chunk_size)
+
+    async def shutdown(self) -> None:
+        """Stops the workers, waiting for them off the loop"""
+        if (pool := self.pool) is not None:
+            self.pool = None
+            await asyncio.get_running_loop().run_in_executor(
+                None, partial(pool.shutdown, cancel_futures=True)
+            )
@@ -0,0 +1,346 @@
+"""Chat ownership shared by a group of servers.
+
+Every chat but the default one is owned by a single node and requests for
+chats owned by another node are forwarded to it. Users and the default
+chat are replicated to every node, so any of them can validate authors
+and serve the common chat. Subclasses decide how chats are mapped to
+nodes and how nodes talk to each other.
+"""
+import abc
+import asyncio
+import heapq
+import json
+import logging
+import uuid
+from asyncio import StreamWriter
+from typing import Hashable
+
+import protocol
+from db import (
+    Chat,
+    ChatStorageCursor,
+    Message,
+    PeerToPeerChat,
+    User,
+    as_uuid,
+)
+from errors import NotExistError
+from routing import accepts, positive_int, string_map
+from server import (
+    ERROR_NOT_SUPPORTED,
+    Server,
+    inbox_entry_key,
+    inbox_page,
+)
+from settings import DEFAULT_MSG_COUNT
+
+PARTITION = "partition"
+INTERNAL_PREFIX = "/_internal/"
+P2P_NAMESPACE = uuid.UUID("5c1a0e0e-6b1d-4a8e-9f5e-2b8d3f1c7a10")
+
+logger = logging.getLogger(__name__)
+
+
+def p2p_chat_id(user_id: str, other_user_id: str) -> uuid.UUID:
+    """Private chat id of a pair of users, the same on every node"""
+    pair = sorted((str(user_id), str(other_user_id)))
+    return uuid.uuid5(P2P_NAMESPACE, ":".join(pair))
+
+
+def p2p_keys(server: Server, body: dict) -> list:
+    user_id, other_user_id = body.get("user_id"), body.get("other_user_id")
+    return [p2p_chat_id(user_id, other_user_id), user_id, other_user_id]
+
+
+def status_keys(server: Server, body: dict) -> list:
+    return [body.get("user_id"), server.database.default_chat_id]
+
+
+def load_inbox_entry(entry: dict) -> dict:
+    """Restores the types of an inbox entry sent by another node"""
+    return dict(Message.load(entry).serialize(), chat_id=entry["chat_id"])
+
+
+class PartitionedServer(Server, abc.ABC):
+    def __init__(
+        self, *args, node: Hashable, default_chat_id: str | None, **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.node = node
+        if default_chat_id is not None:
+            default_chat = Chat(id=uuid.UUID(default_chat_id), name="default")
+            self.database.chats[default_chat.id] = default_chat
+            self.database.default_chat_id = default_chat_id
+        self.hooks = {
+            "/connect": self.after_register,
+            "/send": self.after_add_message,
+            "/chats/exit": self.after_leave,
+            "/chats": self.after_get_chats,
+            "/inbox": self.after_get_inbox,
+            "/status": self.after_get_status,
+        }
+
+    def create_url_method_action_map(self):
+        return {
+            **super().create_url_method_action_map(),
+            f"{INTERNAL_PREFIX}users": {"POST": self.replicate_users},
+            f"{INTERNAL_PREFIX}message": {"POST": self.replicate_message},
+            f"{INTERNAL_PREFIX}leave": {"POST": self.replicate_leave},
+            f"{INTERNAL_PREFIX}chats": {"GET": self.get_owned_chats},
+            f"{INTERNAL_PREFIX}status": {"GET": self.get_owned_status},
+            f"{INTERNAL_PREFIX}inbox": {"GET": self.get_owned_inbox},
+        }
+
+    # Node mapping and transport, defined by subclasses
+
+    @abc.abstractmethod
+    def owner_of(self, pk: str | uuid.UUID) -> Hashable:
+        pass
+
+    @abc.abstractmethod
+    def peer_nodes(self) -> list[Hashable]:
+        pass
+
+    @abc.abstractmethod
+    async def call(
+        self, node: Hashable, method: str, url: str, body: str = ""
+    ) -> dict:
+        pass
+
+    @abc.abstractmethod
+    async def replicate(self, topic: str, data: dict) -> None:
+        """Applies a change of replicated state on every other node"""
+
+    @abc.abstractmethod
+    async def start_internal_server(self) -> asyncio.AbstractServer:
+        pass
+
+    async def before_serving(self) -> None:
+        pass
+
+    # Routing
+
+    def is_default(self, chat_id: str | None) -> bool:
+        return not chat_id or chat_id == self.database.default_chat_id
+
+    def route(self, url: str, body: dict) -> Hashable:
+        """Returns the node owning the request"""
+        try:
+            if url in ("/send", "/chats", "/chats/exit"):
+                chat_id = body.get("chat_id")
+                if not self.is_default(chat_id):
+                    return self.owner_of(chat_id)
+            elif url == "/connect_p2p":
+                return self.owner_of(
+                    p2p_chat_id(body["user_id"], body["other_user_id"])
+                )
+            elif url == "/report_user":
+                return self.owner_of(body["reported_user_id"])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            # malformed requests are rejected by the local handlers
+            pass
+        return self.node
+
+    async def dispatch(self, request: protocol.Request) -> dict:
+        if request.url.startswith(INTERNAL_PREFIX):
+            return {"fail": ERROR_NOT_SUPPORTED}
+        try:
+            body = json.loads(request.body) if request.body else {}
+        except ValueError:
+            body = {}
+        if not isinstance(body, dict):
+            body = {}
+
+        if (target := self.route(request.url, body)) != self.node:
+            logger.debug("Forwarding %s to %s", request.url, target)
+            return await self.call(
+                target, request.method, request.url, request.body.decode()
+            )
+        response = await super().dispatch(request)
+        if "fail" not in response and (hook := self.hooks.get(request.url)):
+            response = await hook(body, response)
+        return response
+
+    async def gather(self, topic: str, data: dict) -> list[dict]:
+        body = json.dumps(data)
+        return await asyncio.gather(
+            *(
+                self.call(node, "GET", f"{INTERNAL_PREFIX}{topic}", body)
+                for node in self.peer_nodes()
+            )
+        )
+
+    # Local handlers with node-independent results
+
+    @accepts(user_id=as_uuid, other_user_id=as_uuid)
+    @Server.connect_db(keys=p2p_keys)
+    def enter_p2p(self, cursor: ChatStorageCursor, body: dict) -> dict:
+        user = cursor.get_user(body.get("user_id"))
+        other_user = cursor.get_user(body.get("other_user_id"))
+        if user is None or other_user is None:
+            raise NotExistError
+        chat_id = p2p_chat_id(user.id, other_user.id)
+        if (p2p_chat := cursor.get_chat(chat_id)) is None:
+            p2p_chat = PeerToPeerChat(id=chat_id, name="p2p")
+            cursor.add_chat(p2p_chat)
+        for author in (user, other_user):
+            if author.id not in p2p_chat.authors:
+                p2p_chat.enter(author)
+        return {"chat_id": str(p2p_chat.id)}
+
+    # Replication of users and the default chat
+
+    @Server.connect_db(user=PARTITION)
+    def get_user_record(self, cursor: ChatStorageCursor, pk: str) -> User:
+        return cursor.get_user(pk)
+
+    @Server.connect_db(user=PARTITION)
+    def get_default_message(
+        self, cursor: ChatStorageCursor, pk: uuid.UUID
+    ) -> Message:
+        chat = cursor.get_chat(cursor.get_default_chat_id())
+        return chat.messages[pk]
+
+    async def after_register(self, body: dict, response: dict) -> dict:
+        user = await self.get_user_record(response["token"])
+        await self.replicate("users", {"users": [user], "enter_default": True})
+        return response
+
+    async def after_add_message(self, body: dict, response: dict) -> dict:
+        if self.is_default(body.get("chat_id")):
+            message = await self.get_default_message(response["id"])
+            await self.replicate("message", {"message": message})
+        return response
+
+    async def after_leave(self, body: dict, response: dict) -> dict:
+        if self.is_default(body.get("chat_id")):
+            await self.replicate("leave", {"user_id": body.get("user_id")})
+        return response
+
+    async def after_get_chats(self, body: dict, response: dict) -> dict:
+        if body.get("chat_id") is None:
+            for result in await self.gather("chats", body):
+                response["chats"].extend(result.get("chats", []))
+        return response
+
+    async def after_get_inbox(self, body: dict, response: dict) -> dict:
+        pages = [response["messages"]]
+        more = response["next"] is not None
+        for result in await self.gather("inbox", body):
+            pages.append(
+                list(map(load_inbox_entry, result.get("messages", [])))
+            )
+            more = more or result.get("next") is not None
+        return inbox_page(
+            heapq.merge(*pages, key=inbox_entry_key, reverse=True),
+            body.get("msg_count") or DEFAULT_MSG_COUNT,
+            more,
+        )
+
+    async def after_get_status(self, body: dict, response: dict) -> dict:
+        for result in await self.gather("status", body):
+            response["chats_count"] += result.get("chats_count", 0)
+            response["chats_with_user_count"] += result.get(
+                "chats_with_user_count", 0
+            )
+        return response
+
+    async def check_reported_users(self) -> list[User]:
+        users = await super().check_reported_users()
+        if users:
+            await self.replicate("users", {"users": users})
+        return users
+
+    @Server.connect_db(user=PARTITION)
+    def replicate_users(self, cursor: ChatStorageCursor, body: dict) -> dict:
+        default_chat = cursor.get_chat(cursor.get_default_chat_id())
+        for data in body["users"]:
+            user = User.load(data)
+            cursor.add_user(user)
+            if body.get("enter_default"):
+                default_chat.enter(user)
+        return {}
+
+    @Server.connect_db(user=PARTITION)
+    def replicate_message(
+        self, cursor: ChatStorageCursor, body: dict
+    ) -> dict:
+        default_chat = cursor.get_chat(cursor.get_default_chat_id())
+        default_chat.add_message(Message.load(body["message"]))
+        return {}
+
+    @Server.connect_db(user=PARTITION)
+    def replicate_leave(self, cursor: ChatStorageCursor, body: dict) -> dict:
+        if (user := cursor.get_user(body.get("user_id"))) is not None:
+            default_chat = cursor.get_chat(cursor.get_default_chat_id())
+            default_chat.leave(user)
+        return {}
+
+    # Owned chats, gathered by the node serving a listing
+
+    @staticmethod
+    def owned_chats_with_user(
+        cursor: ChatStorageCursor, user_id: str
+    ) -> list[Chat]:
+        if (user := cursor.get_user(user_id)) is None:
+            raise NotExistError
+        default_chat_id = cursor.get_default_chat_id()
+        return [
+            chat
+            for chat in cursor.get_chat_list()
+            if user.id in chat.authors and str(chat.id) != default_chat_id
+        ]
+
+    @accepts(user_id=as_uuid, msg_count=positive_int, versions=string_map)
+    @Server.connect_db(user=PARTITION)
+    def get_owned_chats(self, cursor: ChatStorageCursor, body: dict) -> dict:
+        chats = self.owned_chats_with_user(cursor, body.get("user_id"))
+        msg_count = body.get("msg_count") or DEFAULT_MSG_COUNT
+        versions = body.get("versions") or {}
+        return {
+            "chats": [
+                chat.serialize_since(versions.get(str(chat.id)), msg_count)
+                for chat in chats
+            ]
+        }
+
+    @accepts(user_id=as_uuid, msg_count=positive_int)
+    @Server.connect_db(user=PARTITION)
+    def get_owned_inbox(self, cursor: ChatStorageCursor, body: dict) -> dict:
+        if (user := cursor.get_user(body.get("user_id"))) is None:
+            raise NotExistError
+        default_chat_id = cursor.get_default_chat_id()
+        chats = [
+            cursor.get_chat(chat_id)
+            for chat_id in cursor.db.counters.chats_of(user.id)
+            if str(chat_id) != default_chat_id
+        ]
+        return self.merge_inbox(chats, body)
+
+    @accepts(user_id=as_uuid)
+    @Server.connect_db(user=PARTITION, keys=status_keys)
+    def get_owned_status(self, cursor: ChatStorageCursor, body: dict) -> dict:
+        if (user := cursor.get_user(body.get("user_id"))) is None:
+            raise NotExistError
+        default_chat = cursor.get_chat(cursor.get_default_chat_id())
+        in_default_chat = user.id in default_chat.authors
+        return {
+            "chats_count": cursor.count_chats() - 1,
+            "chats_with_user_count": (
+                cursor.count_chats_with_user(user.id) - in_default_chat
+            ),
+        }
+
+    # Listeners
+
+    def internal_connected_callback(
+        self, reader: protocol.IdleReader, writer: StreamWriter
+    ) -> None:
+        self.handle_connection(reader, writer, super().dispatch)
+
+    async def listen(self) -> None:
+        internal_server = await self.start_internal_server()
+        await self.before_serving()
+        logger.info("Node %s is ready", self.node)
+        async with internal_server:
+            await super().listen()
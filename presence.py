@@ -0,0 +1,187 @@
+"""Online presence of users kept alive by heartbeats.
+
+A user is online from a heartbeat until `timeout_secs` pass without one.
+Expiry times live in a hierarchical `TimingWheel`, so a heartbeat only
+moves its user between two slots and expiring users never scans the
+storage. Online counts of chats are kept up to date as users go online
+or offline and enter or leave chats, so reading them is O(1).
+"""
+import math
+import time
+from collections import Counter
+from typing import TYPE_CHECKING, Callable, Hashable, Iterator
+
+from settings import (
+    DEFAULT_PRESENCE_TICK_SECS,
+    DEFAULT_PRESENCE_TIMEOUT_SECS,
+    DEFAULT_PRESENCE_WHEEL_SLOTS,
+)
+
+if TYPE_CHECKING:
+    import uuid
+
+    from db import Chat, StorageCounters
+
+DEFAULT_WHEEL_LEVELS = 4
+
+
+class TimingWheel:
+    """Keys released at their due tick of `tick_secs`
+
+    Level n has `slots` slots spanning slots**n ticks each. A key goes to
+    the lowest level whose span reaches its due tick and moves down a
+    level when its slot comes round, so scheduling and cancelling a key
+    is O(1) and a tick costs O(1) besides the keys it moves or releases.
+    """
+
+    def __init__(
+        self,
+        tick_secs: float = DEFAULT_PRESENCE_TICK_SECS,
+        slots: int = DEFAULT_PRESENCE_WHEEL_SLOTS,
+        levels: int = DEFAULT_WHEEL_LEVELS,
+        start: float = 0.0,
+    ) -> None:
+        self.tick_secs = tick_secs
+        self.slots = slots
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.tick = int(start // tick_secs)
+        # key -> due tick and the slot holding it
+        self.keys: dict[Hashable, tuple[int, set]] = {}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.keys
+
+    def place(self, key: Hashable, due: int) -> None:
+        delta = due - self.tick
+        for level, wheel in enumerate(self.wheels):
+            span = self.slots**level
+            if delta < span * self.slots:
+                index = due // span % self.slots
+                break
+        else:
+            # beyond the last level, wait in its farthest slot
+            index = (self.tick // span + self.slots - 1) % self.slots
+        slot = wheel[index]
+        slot.add(key)
+        self.keys[key] = (due, slot)
+
+    def schedule(self, key: Hashable, when: float) -> None:
+        """(Re)schedules the key to be released once `when` has passed"""
+        self.cancel(key)
+        self.place(key, max(math.ceil(when / self.tick_secs), self.tick + 1))
+
+    def cancel(self, key: Hashable) -> None:
+        if (entry := self.keys.pop(key, None)) is not None:
+            entry[1].discard(key)
+
+    def cascade(self, slot: set) -> None:
+        keys = list(slot)
+        slot.clear()
+        for key in keys:
+            self.place(key, self.keys[key][0])
+
+    def advance(self, now: float) -> Iterator[Hashable]:
+        """Releases the keys due by `now`"""
+        target = int(now // self.tick_secs)
+        while self.tick < target:
+            if not self.keys:
+                self.tick = target
+                break
+            self.tick += 1
+            # higher levels first, they may fill the slots cascaded next
+            for level in range(len(self.wheels) - 1, 0, -1):
+                span = self.slots**level
+                if not self.tick % span:
+                    index = self.tick // span % self.slots
+                    self.cascade(self.wheels[level][index])
+            slot = self.wheels[0][self.tick % self.slots]
+            while slot:
+                key = slot.pop()
+                del self.keys[key]
+                yield key
+
+
+class Presence:
+    """Users online and the online counts of the chats of a storage
+
+    A heartbeat of an online user is O(1); going online or offline
+    updates each chat of the user once.
+    """
+
+    def __init__(
+        self,
+        timeout_secs: float = DEFAULT_PRESENCE_TIMEOUT_SECS,
+        tick_secs: float = DEFAULT_PRESENCE_TICK_SECS,
+        slots: int = DEFAULT_PRESENCE_WHEEL_SLOTS,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.timeout_secs = timeout_secs
+        self.clock = clock
+        self.wheel = TimingWheel(tick_secs, slots, start=clock())
+        self.online_per_chat: Counter["uuid.UUID"] = Counter()
+        # set by the storage, knows the chats of every user
+        self.counters: "StorageCounters | None" = None
+
+    def __len__(self) -> int:
+        return len(self.wheel)
+
+    @property
+    def tick_secs(self) -> float:
+        return self.wheel.tick_secs
+
+    def is_online(self, user_id: "uuid.UUID") -> bool:
+        return user_id in self.wheel
+
+    def online_in(self, chat_id: "uuid.UUID") -> int:
+        return self.online_per_chat[chat_id]
+
+    def heartbeat(
+        self, user_id: "uuid.UUID", now: float | None = None
+    ) -> bool:
+        """Keeps the user online, returns whether it just came online"""
+        now = self.clock() if now is None else now
+        came_online = user_id not in self.wheel
+        self.wheel.schedule(user_id, now + self.timeout_secs)
+        if came_online:
+            self.count(user_id, 1)
+        return came_online
+
+    def expire(self, now: float | None = None) -> list["uuid.UUID"]:
+        """Takes offline the users whose heartbeats stopped"""
+        now = self.clock() if now is None else now
+        users = list(self.wheel.advance(now))
+        for user_id in users:
+            self.count(user_id, -1)
+        return users
+
+    def count(self, user_id: "uuid.UUID", amount: int) -> None:
+        if self.counters is None:
+            return
+        for chat_id in self.counters.chats_of(user_id):
+            self.add(chat_id, amount)
+
+    def add(self, chat_id: "uuid.UUID", amount: int) -> None:
+        if online := self.online_per_chat[chat_id] + amount:
+            self.online_per_chat[chat_id] = online
+        else:
+            del self.online_per_chat[chat_id]
+
+    def entered(self, chat_id: "uuid.UUID", user_id: "uuid.UUID") -> None:
+        if user_id in self.wheel:
+            self.add(chat_id, 1)
+
+    def left(self, chat_id: "uuid.UUID", user_id: "uuid.UUID") -> None:
+        if user_id in self.wheel:
+            self.add(chat_id, -1)
+
+    def add_chat(self, chat: "Chat") -> None:
+        chat.presence = self
+        for author in chat.authors:
+            self.entered(chat.id, author)
+
+    def remove_chat(self, chat: "Chat") -> None:
+        chat.presence = None
+        self.online_per_chat.pop(chat.id, None)
@@ -0,0 +1,273 @@
+"""Opt-in capture of request profiles.
+
+One request in `sample_every` runs under cProfile. With a latency
+threshold a background thread samples the stack of the event loop thread,
+and the samples taken while a request slower than the threshold was being
+handled are kept as its profile. Both kinds compete for the top-K slots by
+duration.
+
+Handlers run on a single event loop, so a profile also covers whatever
+other coroutines ran while the request awaited storage or the network.
+"""
+import cProfile
+import heapq
+import io
+import itertools
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import utils
+from settings import DEFAULT_PROFILE_DIR, DEFAULT_PROFILE_TOP_K
+
+SAMPLED = "sampled"
+SLOW = "slow"
+DEFAULT_SAMPLER_INTERVAL_SECS = 0.005
+DEFAULT_SAMPLER_MAXLEN = 2**14
+DEFAULT_SUMMARY_LIMIT = 15
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Trace:
+    """Request being handled"""
+
+    route: str
+    method: str
+    body_size: int
+    started: float = field(default_factory=time.perf_counter)
+    cursor_wait: float = 0.0
+    profile: cProfile.Profile | None = None
+
+
+@dataclass
+class ProfileRecord:
+    id: int
+    route: str
+    method: str
+    body_size: int
+    cursor_wait: float
+    duration: float
+    reason: str
+    created: datetime
+    stats: pstats.Stats | None = None
+    stacks: Counter | None = None
+
+    def top_functions(self, limit: int) -> list[dict]:
+        if self.stats is None:
+            return []
+        rows = sorted(
+            self.stats.stats.items(), key=lambda item: item[1][3], reverse=True
+        )
+        return [
+            dict(
+                function=pstats.func_std_string(func),
+                calls=calls,
+                tottime=tottime,
+                cumtime=cumtime,
+            )
+            for func, (_, calls, tottime, cumtime, _) in rows[:limit]
+        ]
+
+    def top_stacks(self, limit: int) -> list[dict]:
+        if not self.stacks:
+            return []
+        return [
+            dict(stack=stack, samples=count)
+            for stack, count in self.stacks.most_common(limit)
+        ]
+
+    def summary(self, limit: int = DEFAULT_SUMMARY_LIMIT) -> dict:
+        return dict(
+            id=self.id,
+            route=self.route,
+            method=self.method,
+            body_size=self.body_size,
+            cursor_wait=self.cursor_wait,
+            duration=self.duration,
+            reason=self.reason,
+            created=self.created,
+            functions=self.top_functions(limit),
+            stacks=self.top_stacks(limit),
+        )
+
+    def dump(self, directory: str) -> str:
+        """Writes a pstats file or, for stack samples, collapsed stacks"""
+        name = f"{self.id:06d}-{self.route.strip('/').replace('/', '_')}"
+        if self.stats is not None:
+            path = os.path.join(directory, f"{name}.pstats")
+            self.stats.dump_stats(path)
+        else:
+            path = os.path.join(directory, f"{name}.folded")
+            with open(path, "w") as file:
+                for stack, count in (self.stacks or Counter()).items():
+                    file.write(f"{stack} {count}\n")
+        return path
+
+
+def collapse(frame) -> str:
+    """Formats a stack root first, the way flame graph tools expect"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}"
+            f":{frame.f_lineno})"
+        )
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler(threading.Thread):
+    def __init__(
+        self,
+        thread_id: int,
+        interval: float = DEFAULT_SAMPLER_INTERVAL_SECS,
+        maxlen: int = DEFAULT_SAMPLER_MAXLEN,
+    ) -> None:
+        super().__init__(name="stack-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples: deque[tuple[float, str]] = deque(maxlen=maxlen)
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples.append((time.perf_counter(), collapse(frame)))
+
+    def collect(self, started: float, finished: float) -> Counter:
+        return Counter(
+            stack
+            for taken, stack in list(self.samples)
+            if started <= taken <= finished
+        )
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+class SlowestProfiles:
+    """Bounded buffer keeping the k slowest records"""
+
+    def __init__(self, size: int = DEFAULT_PROFILE_TOP_K) -> None:
+        self.size = size
+        self.heap: list[tuple[float, int, ProfileRecord]] = []
+
+    def add(self, record: ProfileRecord) -> None:
+        item = (record.duration, record.id, record)
+        if len(self.heap) < self.size:
+            heapq.heappush(self.heap, item)
+        elif item > self.heap[0]:
+            heapq.heapreplace(self.heap, item)
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def records(self) -> list[ProfileRecord]:
+        return [record for *_, record in sorted(self.heap, reverse=True)]
+
+    def clear(self) -> None:
+        self.heap.clear()
+
+
+current_trace: ContextVar[Trace | None] = ContextVar(
+    "current_trace", default=None
+)
+
+
+def add_cursor_wait(seconds: float) -> None:
+    if (trace := current_trace.get()) is not None:
+        trace.cursor_wait += seconds
+
+
+class Profiler:
+    def __init__(
+        self,
+        sample_every: int = 0,
+        threshold_secs: float = 0.0,
+        top_k: int = DEFAULT_PROFILE_TOP_K,
+        directory: str = DEFAULT_PROFILE_DIR,
+        sampler_interval: float = DEFAULT_SAMPLER_INTERVAL_SECS,
+    ) -> None:
+        self.sample_every = sample_every
+        self.threshold_secs = threshold_secs
+        self.directory = directory
+        self.sampler_interval = sampler_interval
+        self.slowest = SlowestProfiles(top_k)
+        self.requests = itertools.count(1)
+        self.ids = itertools.count(1)
+        self.sampler: StackSampler | None = None
+        # cProfile keeps one active profile per thread
+        self.profiling = False
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.sample_every or self.threshold_secs)
+
+    def start(self, route: str, method: str, body: str) -> Trace:
+        trace = Trace(route, method, len(body))
+        if self.threshold_secs and self.sampler is None:
+            self.sampler = StackSampler(
+                threading.get_ident(), self.sampler_interval
+            )
+            self.sampler.start()
+        sampled = (
+            self.sample_every
+            and next(self.requests) % self.sample_every == 0
+        )
+        if sampled and not self.profiling:
+            self.profiling = True
+            trace.profile = cProfile.Profile()
+            trace.profile.enable()
+        current_trace.set(trace)
+        return trace
+
+    def finish(self, trace: Trace) -> ProfileRecord | None:
+        finished = time.perf_counter()
+        duration = finished - trace.started
+        current_trace.set(None)
+        stats = stacks = None
+        if trace.profile is not None:
+            trace.profile.disable()
+            self.profiling = False
+            stats = pstats.Stats(trace.profile, stream=io.StringIO())
+        slow = bool(self.threshold_secs) and duration >= self.threshold_secs
+        if slow and self.sampler is not None:
+            stacks = self.sampler.collect(trace.started, finished)
+        if stats is None and stacks is None:
+            return None
+        record = ProfileRecord(
+            id=next(self.ids),
+            route=trace.route,
+            method=trace.method,
+            body_size=trace.body_size,
+            cursor_wait=trace.cursor_wait,
+            duration=duration,
+            reason=SLOW if slow else SAMPLED,
+            created=utils.now(),
+            stats=stats,
+            stacks=stacks,
+        )
+        self.slowest.add(record)
+        return record
+
+    def dump(self) -> list[str]:
+        os.makedirs(self.directory, exist_ok=True)
+        return [
+            record.dump(self.directory) for record in self.slowest.records()
+        ]
+
+    def close(self) -> None:
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
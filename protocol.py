@@ -0,0 +1,214 @@
+import asyncio
+import time
+from asyncio import IncompleteReadError, StreamReader
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable
+
+LINE_END = b"\r\n"
+HEAD_END = LINE_END + LINE_END
+LAST_CHUNK = b"0" + LINE_END + LINE_END
+HEADER_SEPARATOR = ": "
+
+ACCEPT_ENCODING = "accept-encoding"
+CONNECTION = "connection"
+CONTENT_ENCODING = "content-encoding"
+CONTENT_LENGTH = "content-length"
+IDEMPOTENCY_KEY = "idempotency-key"
+TRANSFER_ENCODING = "transfer-encoding"
+CHUNKED = "chunked"
+KEEP_ALIVE = "keep-alive"
+
+
+class BodyTooLargeError(ValueError):
+    """Request body is larger than the limit"""
+
+
+@dataclass
+class Request:
+    method: str
+    url: str
+    # left undecoded, json.loads reads bytes as they are
+    body: bytes = b""
+    headers: dict[str, str] = field(default_factory=dict)
+    # wall time the head was parsed at
+    received: float = field(default_factory=time.time)
+
+
+def encode_headers(headers: dict[str, str]) -> bytes:
+    lines = [
+        f"{name}{HEADER_SEPARATOR}{value}" for name, value in headers.items()
+    ]
+    return "".join(f"{line}\r\n" for line in lines).encode() + LINE_END
+
+
+def encode_request(
+    method: str,
+    url: str,
+    body: str | bytes = "",
+    headers: dict | None = None,
+) -> bytes:
+    payload = body.encode() if isinstance(body, str) else body
+    headers = {**(headers or {}), CONTENT_LENGTH: len(payload)}
+    start_line = f"{method} {url}".encode() + LINE_END
+    return start_line + encode_headers(headers) + payload
+
+
+def parse_header(line: bytes, headers: dict[str, str]) -> None:
+    name, separator, value = line.partition(b":")
+    if not separator:
+        raise ValueError(f"Malformed header line {line!r}")
+    # latin-1 decodes any byte, names and values are ASCII in practice
+    name = name.strip().lower().decode("latin-1")
+    headers[name] = value.strip().decode("latin-1")
+
+
+def parse_head(head: bytes) -> Request:
+    """Parses a start line and headers ending with an empty line"""
+    start_line, *lines = head.strip().split(LINE_END)
+    method, url = start_line.split()
+    headers = {}
+    for line in lines:
+        parse_header(line, headers)
+    return Request(method.decode("ascii"), url.decode("ascii"), b"", headers)
+
+
+async def read_headers(reader: StreamReader) -> dict[str, str]:
+    headers = {}
+    while (line := await reader.readline()) not in (LINE_END, b""):
+        parse_header(line, headers)
+    return headers
+
+
+async def read_head(reader: StreamReader) -> Request | None:
+    """Reads the start line and headers of a request, leaving the body
+
+    The head is read at once, up to the limit of the reader, and only
+    the method, url and headers are decoded.
+    """
+    try:
+        head = await reader.readuntil(HEAD_END)
+    except asyncio.IncompleteReadError as error:
+        if not error.partial.strip():
+            return None
+        raise
+    except asyncio.LimitOverrunError as error:
+        raise ValueError("Request head is longer than the limit") from error
+    if not head.strip():
+        return None
+    return parse_head(head)
+
+
+def content_length(request: Request, max_size: int = 0) -> int:
+    """Length of the body announced by the request, up to `max_size`
+
+    A zero `max_size` does not limit the body.
+    """
+    value = request.headers.get(CONTENT_LENGTH, "0")
+    if not value.isdigit():
+        raise ValueError(f"Malformed content length {value!r}")
+    length = int(value)
+    if max_size and length > max_size:
+        raise BodyTooLargeError(BodyTooLargeError.__doc__)
+    return length
+
+
+async def read_body(
+    reader: StreamReader, request: Request, max_size: int = 0
+) -> None:
+    if length := content_length(request, max_size):
+        request.body = await reader.readexactly(length)
+
+
+async def read_request(
+    reader: StreamReader, max_size: int = 0
+) -> Request | None:
+    if (request := await read_head(reader)) is not None:
+        await read_body(reader, request, max_size)
+    return request
+
+
+def encode_chunk(data: bytes) -> tuple[bytes, bytes, bytes]:
+    """Frames data as `<hex size>CRLF<data>CRLF` without copying it"""
+    return b"%x" % len(data) + LINE_END, data, LINE_END
+
+
+async def read_chunks(reader: StreamReader) -> AsyncIterator[bytes]:
+    """Yields frame payloads until the terminating empty frame"""
+    while True:
+        if not (size_line := await reader.readline()):
+            raise IncompleteReadError(b"", None)
+        size = int(size_line, 16)
+        frame = await reader.readexactly(size + len(LINE_END))
+        if not size:
+            return
+        yield frame[:size]
+
+
+class IdleReader(StreamReader):
+    """Stream reader waking a parked connection up when data arrives
+
+    A connection waiting for its next request parks a callback here
+    instead of keeping a task blocked in `readline`.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.waker: Callable[[], None] | None = None
+
+    def park(self, waker: Callable[[], None]) -> None:
+        """Calls `waker` once data or EOF arrives, at once if buffered"""
+        if self._buffer or self._eof or self._exception:
+            waker()
+        else:
+            self.waker = waker
+
+    def unpark(self) -> None:
+        self.waker = None
+
+    def wake(self) -> None:
+        if self.waker is not None:
+            waker, self.waker = self.waker, None
+            waker()
+
+    def feed_data(self, data: bytes) -> None:
+        super().feed_data(data)
+        self.wake()
+
+    def feed_eof(self) -> None:
+        super().feed_eof()
+        self.wake()
+
+    def set_exception(self, exc: BaseException) -> None:
+        super().set_exception(exc)
+        self.wake()
+
+
+def idle_reader_factory(
+    client_connected_cb: Callable, limit: int
+) -> Callable[[], asyncio.StreamReaderProtocol]:
+    loop = asyncio.get_running_loop()
+
+    def factory() -> asyncio.StreamReaderProtocol:
+        reader = IdleReader(limit=limit, loop=loop)
+        return asyncio.StreamReaderProtocol(
+            reader, client_connected_cb, loop=loop
+        )
+
+    return factory
+
+
+async def start_server(
+    client_connected_cb: Callable, host: str, port: int, limit: int, **kwargs
+) -> asyncio.AbstractServer:
+    """`asyncio.start_server` handing an `IdleReader` to the callback"""
+    loop = asyncio.get_running_loop()
+    factory = idle_reader_factory(client_connected_cb, limit)
+    return await loop.create_server(factory, host, port, **kwargs)
+
+
+async def start_unix_server(
+    client_connected_cb: Callable, path: str, limit: int, **kwargs
+) -> asyncio.AbstractServer:
+    loop = asyncio.get_running_loop()
+    factory = idle_reader_factory(client_connected_cb, limit)
+    return await loop.create_unix_server(factory, path, **kwargs)
@@ -0,0 +1,206 @@
+"""Message retention policies and their expiry engine.
+
+Every chat type may keep only its last `max_messages` messages and only
+messages younger than `max_age`; a message may also carry its own expiry
+time (a TTL). The message limit is enforced as messages are added. Ages
+and TTLs are tracked in an `ExpiryIndex` of time buckets and expired by
+`Retention.expire` in bounded slices, so long histories never stall the
+event loop.
+
+Chats expiring by age are indexed once, at the expiry of their oldest
+message, instead of once per message: history is kept in insertion
+order, so expiring a chat drops messages from its front until one is
+still young enough and indexes the chat again at that message's expiry.
+"""
+import heapq
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Hashable, Iterator
+
+from constants import ChatType
+from settings import (
+    DEFAULT_EXPIRY_BUCKET_SECS,
+    DEFAULT_RETENTION_COMMON_HOURS,
+    DEFAULT_RETENTION_COMMON_MAX_MESSAGES,
+    DEFAULT_RETENTION_PRIVATE_HOURS,
+    DEFAULT_RETENTION_PRIVATE_MAX_MESSAGES,
+)
+
+if TYPE_CHECKING:
+    from db import Chat, ChatStorageCursor, Message
+
+
+@dataclass(frozen=True)
+class RetentionPolicy:
+    max_messages: int = 0
+    max_age: timedelta | None = None
+
+    @classmethod
+    def from_settings(cls, max_messages: int, hours: float):
+        return cls(max_messages, timedelta(hours=hours) if hours else None)
+
+
+def default_policies() -> dict[ChatType, RetentionPolicy]:
+    return {
+        ChatType.COMMON: RetentionPolicy.from_settings(
+            DEFAULT_RETENTION_COMMON_MAX_MESSAGES,
+            DEFAULT_RETENTION_COMMON_HOURS,
+        ),
+        ChatType.PRIVATE: RetentionPolicy.from_settings(
+            DEFAULT_RETENTION_PRIVATE_MAX_MESSAGES,
+            DEFAULT_RETENTION_PRIVATE_HOURS,
+        ),
+    }
+
+
+class ExpiryIndex:
+    """Keys grouped into buckets of `bucket_secs` by their due time
+
+    A bucket is released once its whole span has passed, so keys expire
+    at most `bucket_secs` late, and adding or releasing a key is O(1)
+    besides a heap operation per bucket.
+    """
+
+    def __init__(self, bucket_secs: float = DEFAULT_EXPIRY_BUCKET_SECS):
+        self.bucket_secs = bucket_secs
+        self.buckets: dict[int, list[Hashable]] = {}
+        self.bucket_heap: list[int] = []
+
+    def __len__(self) -> int:
+        return sum(map(len, self.buckets.values()))
+
+    def add(self, due: float, key: Hashable) -> None:
+        bucket = int(due // self.bucket_secs)
+        if (keys := self.buckets.get(bucket)) is None:
+            keys = self.buckets[bucket] = []
+            heapq.heappush(self.bucket_heap, bucket)
+        keys.append(key)
+
+    def has_due(self, now: float) -> bool:
+        return bool(
+            self.bucket_heap
+            and (self.bucket_heap[0] + 1) * self.bucket_secs <= now
+        )
+
+    def pop_due(self, now: float) -> Iterator[Hashable]:
+        """Releases the keys of every bucket that ended by `now`"""
+        while self.has_due(now):
+            yield from self.buckets.pop(heapq.heappop(self.bucket_heap))
+
+
+class Retention:
+    """Applies retention policies to the chats of a storage
+
+    Index keys are `(chat_id, None)` for the age of a chat and
+    `(chat_id, message_id)` for a message TTL.
+    """
+
+    def __init__(
+        self,
+        policies: dict[ChatType, RetentionPolicy] | None = None,
+        bucket_secs: float = DEFAULT_EXPIRY_BUCKET_SECS,
+    ) -> None:
+        self.policies = default_policies() if policies is None else policies
+        self.index = ExpiryIndex(bucket_secs)
+        # released keys not processed yet by a time-limited slice
+        self.due: deque[tuple] = deque()
+        # chats indexed by the age of their oldest message
+        self.aging: set = set()
+        self.expired = 0
+
+    def policy(self, chat: "Chat") -> RetentionPolicy:
+        return self.policies.get(chat.type) or RetentionPolicy()
+
+    @property
+    def pending(self) -> int:
+        return len(self.due) + len(self.index)
+
+    def has_due(self, now: float) -> bool:
+        return bool(self.due) or self.index.has_due(now)
+
+    def track(self, chat: "Chat") -> None:
+        """Indexes a chat as it is stored with the messages it has"""
+        chat.retention = self
+        self.trim(chat)
+        for message in chat.messages.values():
+            self.schedule_message(chat, message)
+        self.schedule_age(chat)
+
+    def untrack(self, chat: "Chat") -> None:
+        # index entries of the chat are dropped as they come due
+        chat.retention = None
+        self.aging.discard(chat.id)
+
+    def added(self, chat: "Chat", message: "Message") -> None:
+        self.trim(chat)
+        self.schedule_message(chat, message)
+        if chat.id not in self.aging:
+            self.schedule_age(chat)
+
+    def trim(self, chat: "Chat") -> None:
+        if not (max_messages := self.policy(chat).max_messages):
+            return
+        while len(chat.messages) > max_messages:
+            chat.delete_message(next(iter(chat.messages)))
+            self.expired += 1
+
+    def schedule_message(self, chat: "Chat", message: "Message") -> None:
+        if message.expires is not None:
+            due = message.expires.timestamp()
+            self.index.add(due, (chat.id, message.id))
+
+    def schedule_age(self, chat: "Chat") -> None:
+        """Indexes the chat at the expiry of its oldest message"""
+        max_age = self.policy(chat).max_age
+        if max_age is None or not chat.messages:
+            self.aging.discard(chat.id)
+            return
+        oldest = chat.messages[next(iter(chat.messages))]
+        due = (oldest.created + max_age).timestamp()
+        self.index.add(due, (chat.id, None))
+        self.aging.add(chat.id)
+
+    def expire_chat(
+        self, chat: "Chat", now: datetime, deadline: float
+    ) -> bool:
+        """Drops aged messages, returns False if the deadline cut it short"""
+        if (max_age := self.policy(chat).max_age) is None:
+            self.aging.discard(chat.id)
+            return True
+        while chat.messages:
+            oldest = chat.messages[next(iter(chat.messages))]
+            if oldest.created + max_age > now:
+                break
+            chat.delete_message(oldest.id)
+            self.expired += 1
+            if time.perf_counter() >= deadline:
+                return False
+        self.aging.discard(chat.id)
+        self.schedule_age(chat)
+        return True
+
+    def expire(
+        self, cursor: "ChatStorageCursor", now: datetime, budget_secs: float
+    ) -> bool:
+        """Deletes expired messages for up to `budget_secs` of CPU time
+
+        Returns whether due work is left for another slice.
+        """
+        self.due.extend(self.index.pop_due(now.timestamp()))
+        deadline = time.perf_counter() + budget_secs
+        while self.due:
+            chat_id, message_id = self.due.popleft()
+            chat = cursor.get_chat(chat_id)
+            if chat is None or chat.retention is not self:
+                continue
+            if message_id is None:
+                if not self.expire_chat(chat, now, deadline):
+                    self.due.appendleft((chat_id, None))
+                    break
+            elif chat.delete_message(message_id) is not None:
+                self.expired += 1
+            if time.perf_counter() >= deadline:
+                break
+        return bool(self.due)
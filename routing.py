@@ -0,0 +1,97 @@
+"""Route table of the server and the request bodies its routes accept.
+
+Handlers declare the fields of their bodies with `accepts`. Ids are
+parsed into UUIDs there, once per request, instead of by every storage
+lookup. `compile_routes` flattens the URL map of a server into a single
+dict keyed by method and url, holding the schema of every handler.
+"""
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from errors import ValidationError
+
+
+def positive_int(value: Any) -> int:
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError(value)
+    return value
+
+
+def positive_number(value: Any) -> int | float:
+    if (
+        isinstance(value, bool)
+        or not isinstance(value, (int, float))
+        or not value > 0
+    ):
+        raise ValueError(value)
+    return value
+
+
+def string(value: Any) -> str:
+    if not isinstance(value, str):
+        raise ValueError(value)
+    return value
+
+
+def string_map(value: Any) -> dict[str, str]:
+    if not isinstance(value, dict) or not all(
+        isinstance(item, str) for item in value.values()
+    ):
+        raise ValueError(value)
+    return value
+
+
+class Schema:
+    """Fields of a request body with the parsers of their values
+
+    Fields missing or null are left to the handler, other fields are
+    replaced by their parsed values in a copy of the body.
+    """
+
+    def __init__(self, **fields: Callable[[Any], Any]) -> None:
+        self.fields = fields
+
+    def validate(self, body: Any) -> dict:
+        """Returns a new body, the request body may still be logged"""
+        if not isinstance(body, dict):
+            raise ValidationError("Request body should be a JSON object")
+        parsed = {}
+        for name, parse in self.fields.items():
+            if (value := body.get(name)) is None:
+                continue
+            try:
+                parsed[name] = parse(value)
+            except (AttributeError, TypeError, ValueError):
+                raise ValidationError(f"Field {name} is not valid")
+        return {**body, **parsed}
+
+
+def accepts(**fields: Callable[[Any], Any]) -> Callable[[Callable], Callable]:
+    """Declares the body fields of a handler and how to parse them"""
+
+    def wrapper(func: Callable) -> Callable:
+        func.schema = Schema(**fields)
+        return func
+
+    return wrapper
+
+
+@dataclass(frozen=True)
+class Route:
+    handler: Callable
+    schema: Schema | None = None
+
+    def __call__(self, body: Any) -> Any:
+        if self.schema is not None:
+            body = self.schema.validate(body)
+        return self.handler(body)
+
+
+def compile_routes(
+    url_map: dict[str, dict[str, Callable]]
+) -> dict[tuple[str, str], Route]:
+    return {
+        (method, url): Route(handler, getattr(handler, "schema", None))
+        for url, methods in url_map.items()
+        for method, handler in methods.items()
+    }
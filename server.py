@@ -1,44 +1,169 @@
+import argparse
 import asyncio
+import gc
+import heapq
 import json
 import logging
+import os
 import signal
+import time
 import uuid
 from asyncio import StreamReader, StreamWriter
-from datetime import timedelta
-from functools import wraps
-from typing import Any, Callable
+from datetime import datetime, timedelta
+from functools import partial, wraps
+from itertools import chain, islice, repeat
+from typing import Any, Awaitable, Callable, Iterable, Iterator
 
+import admission
+import archive
+import batching
+import clock
+import compression
+import idempotency
+import logs
+import metrics
+import offload
+import profiling
+import protocol
+import routing
+import traffic
 import utils
 from constants import ChatType
-from db import Chat, ChatStorage, ChatStorageCursor, Message, User
+from db import (
+    Chat,
+    ChatStorage,
+    ChatStorageCursor,
+    Message,
+    User,
+    as_uuid,
+    timeline_key,
+)
 from errors import (
     BannedError,
     MsgLimitExceededError,
     NotExistError,
     ValidationError,
 )
+from routing import (
+    accepts,
+    positive_int,
+    positive_number,
+    string,
+    string_map,
+)
 from settings import (
+    DEFAULT_ADMISSION_IP_BURST,
+    DEFAULT_ADMISSION_IP_RATE,
+    DEFAULT_ADMISSION_MAX_IN_FLIGHT,
+    DEFAULT_ADMISSION_MAX_QUEUE_DEPTH,
+    DEFAULT_ADMISSION_PRIORITY,
+    DEFAULT_ARCHIVE_DIR,
     DEFAULT_BAN_PERIOD_HOURS,
+    DEFAULT_BODY_TIMEOUT_SECS,
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_COMPRESSION_THRESHOLD,
+    DEFAULT_EXPIRY_CYCLE_SECS,
+    DEFAULT_EXPIRY_SLICE_MS,
+    DEFAULT_HEADER_TIMEOUT_SECS,
     DEFAULT_HOST,
+    DEFAULT_IDEMPOTENCY_CACHE_SIZE,
+    DEFAULT_IDEMPOTENCY_TTL_SECS,
+    DEFAULT_LOAD_PATH,
+    DEFAULT_KEEPALIVE_TIMEOUT_SECS,
+    DEFAULT_LOOP_LAG_INTERVAL_SECS,
+    DEFAULT_MAX_BODY_SIZE,
     DEFAULT_MAX_COMPLAINT_COUNT,
+    DEFAULT_MAX_MESSAGE_TTL_SECS,
     DEFAULT_MODERATION_CYCLE_SECS,
     DEFAULT_MSG_COUNT,
     DEFAULT_MSG_LIMIT,
     DEFAULT_MSG_LIMIT_PERIOD_HOURS,
+    DEFAULT_OFFLOAD_THRESHOLD,
+    DEFAULT_OFFLOAD_WORKERS,
     DEFAULT_PORT,
+    DEFAULT_PROFILE_SAMPLE_EVERY,
+    DEFAULT_PROFILE_THRESHOLD_MS,
+    DEFAULT_RECORD_PATH,
     DEFAULT_SERVER_BUFFER_LIMIT,
+    DEFAULT_SEND_BATCH_DELAY_SECS,
+    DEFAULT_SEND_BATCH_SIZE,
+    DEFAULT_SERVER_MAX_CONNECTIONS,
+    DEFAULT_WRITE_TIMEOUT_SECS,
 )
 
 ERROR_DEFAULT_SERVER = "Server Internal error"
 ERROR_NOT_SUPPORTED = "Method or url is not supported"
+ERROR_BODY_TOO_LARGE = "Request body is too large"
+ERROR_OVERLOADED = "Server is overloaded, retry later"
 
 SERVER = "server"
 MODERATOR = "moderator"
+EXPIRY = "expiry"
+
+# connection deadlines
+HEADER = "header"
+BODY = "body"
+IDLE = "idle"
+WRITE = "write"
 
 
 logger = logging.getLogger(__name__)
 
 
+def chat_keys(server: "Server", body: dict) -> list:
+    return [body.get("chat_id"), body.get("user_id")]
+
+
+def single_chat_keys(server: "Server", body: dict) -> list:
+    """Shards of a single chat request, every shard for a chat listing"""
+    return chat_keys(server, body) if body.get("chat_id") else []
+
+
+def message_keys(server: "Server", body: dict) -> list:
+    chat_id = body.get("chat_id") or server.database.default_chat_id
+    return [chat_id, body.get("author_id")]
+
+
+def user_keys(server: "Server", body: dict) -> list:
+    return [body.get("user_id")]
+
+
+def batch_message_keys(server: "Server", bodies: list[dict]) -> list:
+    return [key for body in bodies for key in message_keys(server, body)]
+
+
+def inbox_entry_key(entry: dict) -> tuple:
+    return entry["created"], entry["id"]
+
+
+def load_inbox_cursor(value: str | None) -> tuple | None:
+    """Reads the position an inbox page continues from"""
+    if value is None:
+        return None
+    try:
+        created, _, pk = value.rpartition("/")
+        return datetime.fromisoformat(created), uuid.UUID(pk)
+    except (AttributeError, TypeError, ValueError):
+        raise ValidationError("Inbox cursor is not valid")
+
+
+def inbox_page(
+    entries: Iterator[dict], limit: int, more: bool = False
+) -> dict:
+    """Takes a page of newest first entries, with the cursor of the next
+
+    more tells that entries beyond the given ones are known to exist.
+    """
+    page = list(islice(entries, limit + 1))
+    cursor = None
+    if more or len(page) > limit:
+        del page[limit:]
+        if page:
+            last = page[-1]
+            cursor = f"{last['created'].isoformat()}/{last['id']}"
+    return {"messages": page, "next": cursor}
+
+
 class Server:
     def __init__(
         self,
@@ -47,35 +172,127 @@ class Server:
         limit: int = DEFAULT_SERVER_BUFFER_LIMIT,
         msg_limit_enabled: bool = False,
         moderation_cycle_secs: int = DEFAULT_MODERATION_CYCLE_SECS,
+        expiry_cycle_secs: float = DEFAULT_EXPIRY_CYCLE_SECS,
+        expiry_slice_secs: float = DEFAULT_EXPIRY_SLICE_MS / 1000,
+        compression_threshold: int = DEFAULT_COMPRESSION_THRESHOLD,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        reuse_port: bool = False,
+        keepalive_timeout_secs: float = DEFAULT_KEEPALIVE_TIMEOUT_SECS,
+        header_timeout_secs: float = DEFAULT_HEADER_TIMEOUT_SECS,
+        body_timeout_secs: float = DEFAULT_BODY_TIMEOUT_SECS,
+        write_timeout_secs: float = DEFAULT_WRITE_TIMEOUT_SECS,
+        max_body_size: int = DEFAULT_MAX_BODY_SIZE,
+        max_connections: int = DEFAULT_SERVER_MAX_CONNECTIONS,
+        send_batch_size: int = DEFAULT_SEND_BATCH_SIZE,
+        send_batch_delay_secs: float = DEFAULT_SEND_BATCH_DELAY_SECS,
+        idempotency_cache_size: int = DEFAULT_IDEMPOTENCY_CACHE_SIZE,
+        idempotency_ttl_secs: float = DEFAULT_IDEMPOTENCY_TTL_SECS,
+        loop_lag_interval_secs: float = DEFAULT_LOOP_LAG_INTERVAL_SECS,
+        offload_workers: int = DEFAULT_OFFLOAD_WORKERS,
+        offload_threshold: int = DEFAULT_OFFLOAD_THRESHOLD,
+        load_path: str = "",
+        archive_dir: str = "",
+        profiler: profiling.Profiler | None = None,
+        recorder: traffic.TrafficRecorder | None = None,
+        admission: admission.AdmissionController | None = None,
     ):
         self.host = host
         self.port = port
         self.limit = limit
         self.msg_limit_enabled = msg_limit_enabled
         self.moderation_cycle_secs = moderation_cycle_secs
+        self.expiry_cycle_secs = expiry_cycle_secs
+        self.expiry_slice_secs = expiry_slice_secs
+        self.compression_threshold = compression_threshold
+        self.chunk_size = chunk_size
+        self.reuse_port = reuse_port
+        self.keepalive_timeout_secs = keepalive_timeout_secs
+        self.header_timeout_secs = header_timeout_secs
+        self.body_timeout_secs = body_timeout_secs
+        self.write_timeout_secs = write_timeout_secs
+        self.max_body_size = max_body_size
+        self.max_connections = max_connections
+        self.loop_lag_interval_secs = loop_lag_interval_secs
+        self.load_path = load_path
+        self.archive_dir = archive_dir
+        self.profiler = profiler
+        self.recorder = recorder
+        self.admission = admission
         self.database = ChatStorage()
+        self.message_ids = clock.MessageIds()
+        self.idempotency = None
+        if idempotency_cache_size:
+            self.idempotency = idempotency.IdempotencyCache(
+                idempotency_cache_size, idempotency_ttl_secs
+            )
+        self.send_batcher = None
+        if send_batch_size > 1:
+            self.send_batcher = batching.Batcher(
+                self.add_messages, send_batch_size, send_batch_delay_secs
+            )
+        self.offloader = None
+        if offload_workers:
+            self.offloader = offload.Offloader(
+                offload_workers, offload_threshold
+            )
+        self.connection_writers: set[StreamWriter] = set()
+        self.connection_tasks: set[asyncio.Task] = set()
+        # background tasks of startup, and the graceful stop once begun
+        self.serving: asyncio.Future | None = None
+        self.stopping: asyncio.Task | None = None
         # URL map
         self.URL_METHOD_ACTION_MAP = self.create_url_method_action_map()
+        self.routes = routing.compile_routes(self.URL_METHOD_ACTION_MAP)
+        self.metrics = metrics.ServerMetrics(self.URL_METHOD_ACTION_MAP)
 
     def create_url_method_action_map(self):
+        admin_urls = {}
+        if self.profiler is not None:
+            admin_urls = {
+                "/admin/profiles": {"GET": self.get_profiles},
+                "/admin/profiles/dump": {"POST": self.dump_profiles},
+            }
+        if self.admission is not None:
+            admin_urls["/admin/admission"] = {"GET": self.get_admission}
+        if self.archive_dir:
+            admin_urls[archive.ADMIN_ARCHIVE_URL] = {
+                "POST": self.export_archive
+            }
         return {
+            **admin_urls,
             "/connect": {"POST": self.register},
             "/status": {"GET": self.get_status},
-            "/send": {"POST": self.add_message},
+            "/send": {"POST": self.send},
             "/chats": {"GET": self.get_chats},
+            "/inbox": {"GET": self.get_inbox},
             "/connect_p2p": {"POST": self.enter_p2p},
             "/chats/exit": {"POST": self.leave},
             "/report_user": {"POST": self.report_user},
+            "/heartbeat": {"POST": self.heartbeat},
+            "/metrics": {"GET": self.get_metrics},
         }
 
     @staticmethod
-    def connect_db(user: str = SERVER) -> Callable:
+    def connect_db(
+        user: str = SERVER, keys: Callable[..., list] | None = None
+    ) -> Callable:
+        """Runs func with a cursor holding the storage shards of keys
+
+        keys receives the same arguments as func and returns the chat and
+        user ids it touches; without keys every shard is acquired.
+        """
+
         def wrapper(func: Callable) -> Callable:
             @wraps(func)
             async def inner(self, *args, **kwargs) -> Any:
+                shard_keys = keys(self, *args, **kwargs) if keys else ()
+                started = time.perf_counter()
+                cursor = await self.database.connect(*shard_keys)
+                acquired = time.perf_counter()
+                self.metrics.cursor_wait.observe(acquired - started, (user,))
+                profiling.add_cursor_wait(acquired - started)
                 try:
-                    cursor = await self.database.connect()
-                    logger.info(f"Connected {user} to db")
+                    logger.info("Connected %s to db", user)
 
                     result = func(self, cursor, *args, **kwargs)
 
@@ -84,7 +301,10 @@ class Server:
                     raise
                 finally:
                     cursor.disconnect()
-                    logger.info(f"Disconnected {user} from db")
+                    self.metrics.cursor_hold.observe(
+                        time.perf_counter() - acquired, (user,)
+                    )
+                    logger.info("Disconnected %s from db", user)
                 return result
 
             return inner
@@ -101,14 +321,16 @@ class Server:
             raise NotExistError
         return user, chat
 
-    async def parse(self, message: str = "") -> str:
-        if not message:
-            return ""
+    async def parse(
+        self, method: str, url: str, body: bytes | str = b""
+    ) -> dict:
+        started = time.perf_counter()
+        trace = self.profiler and self.profiler.start(url, method, body)
         try:
-            method, url, body = message.split(" ", maxsplit=2)
+            route = self.routes[method, url]
             json_body = json.loads(body) if body else {}
-            logger.info(f"body: {json_body}")
-            return await self.URL_METHOD_ACTION_MAP[url][method](json_body)
+            logger.info("body: %s", json_body)
+            return await route(json_body)
         except (
             ValidationError,
             BannedError,
@@ -116,87 +338,146 @@ class Server:
             MsgLimitExceededError,
         ) as error:
             logger.exception("Error caused by user actions")
-            return utils.serialize({"fail": str(error)})
-        except (ValueError, KeyError, TypeError):
+            self.metrics.count_error(url, error)
+            return {"fail": str(error)}
+        except (ValueError, KeyError, TypeError) as error:
             logger.exception(ERROR_NOT_SUPPORTED)
-            return utils.serialize({"fail": ERROR_NOT_SUPPORTED})
-        except Exception:
+            self.metrics.count_error(url, error)
+            return {"fail": ERROR_NOT_SUPPORTED}
+        except Exception as error:
             logger.exception("Error while running Server.parse")
-            return utils.serialize({"fail": ERROR_DEFAULT_SERVER})
+            self.metrics.count_error(url, error)
+            return {"fail": ERROR_DEFAULT_SERVER}
+        finally:
+            self.metrics.observe_request(url, method, started)
+            if trace:
+                self.profiler.finish(trace)
 
     def check_msg_limit_exceeded(
-        self, cursor: ChatStorageCursor, user: User, chat: Chat
+        self,
+        cursor: ChatStorageCursor,
+        user: User,
+        chat: Chat,
+        now: datetime | None = None,
     ) -> bool:
-        def is_target_msg(obj):
-            return (
-                obj.author == user.id
-                and obj.created
-                > utils.now() - timedelta(hours=DEFAULT_MSG_LIMIT_PERIOD_HOURS)
-            )
+        """Whether the user sent the limit to the default chat lately
 
-        target_is_default_chat = cursor.get_default_chat_id() == str(chat.id)
-        msg_count_exceeds_limit = (
-            len(list(filter(is_target_msg, chat.messages.values())))
-            >= DEFAULT_MSG_LIMIT
+        Only messages of the period are read, newest first.
+        """
+        if cursor.get_default_chat_id() != str(chat.id):
+            return False
+        since = (now or utils.now()) - timedelta(
+            hours=DEFAULT_MSG_LIMIT_PERIOD_HOURS
         )
-        return bool(target_is_default_chat and msg_count_exceeds_limit)
+        sent = 0
+        for message in chat.history_before():
+            if message.created <= since:
+                break
+            sent += message.author == user.id
+            if sent >= DEFAULT_MSG_LIMIT:
+                return True
+        return False
 
     @connect_db()
-    def register(self, cursor: ChatStorageCursor, body: dict) -> str:
+    def register(self, cursor: ChatStorageCursor, body: dict) -> dict:
         peer = cursor.create_user()
-        logger.info(f"New peer: {peer}")
+        logger.info("New peer: %s", peer)
         author = cursor.get_user(peer)
         chat = cursor.get_chat(cursor.get_default_chat_id())
         chat.enter(author)
-        return utils.serialize({"token": peer})
+        return {"token": peer}
 
-    @connect_db()
-    def get_status(self, cursor: ChatStorageCursor, body: dict) -> str:
+    @accepts(user_id=as_uuid)
+    @connect_db(keys=user_keys)
+    def get_status(self, cursor: ChatStorageCursor, body: dict) -> dict:
         if (user := cursor.get_user(body.get("user_id"))) is None:
             raise NotExistError
-        chats = cursor.get_chat_list()
-        chats_with_user = list(
-            filter(lambda obj: user.id in obj.authors, chats)
-        )
-        return utils.serialize(
-            {
-                "time": utils.now(),
-                "connections_db_max": cursor.db.max_connections,
-                "connections_db_now": len(cursor.db.connections),
-                "chat_default": cursor.get_default_chat_id(),
-                "chats_count": len(chats),
-                "chats_with_user_count": len(chats_with_user),
-                "user": user,
-            }
-        )
+        return {
+            "time": utils.now(),
+            "connections_db_max": cursor.db.max_connections,
+            "connections_db_now": len(cursor.db.cursors),
+            "chat_default": cursor.get_default_chat_id(),
+            "chats_count": cursor.count_chats(),
+            "chats_with_user_count": cursor.count_chats_with_user(user.id),
+            "online_count": len(self.database.presence),
+            "user": user,
+        }
 
-    @connect_db()
-    def get_chats(self, cursor: ChatStorageCursor, body: dict) -> str:
+    @accepts(
+        user_id=as_uuid,
+        chat_id=as_uuid,
+        msg_count=positive_int,
+        versions=string_map,
+        version=string,
+    )
+    @connect_db(keys=single_chat_keys)
+    def get_chats(self, cursor: ChatStorageCursor, body: dict) -> dict:
         if (chat_id := body.get("chat_id")) is not None:
             return self.get_chat(cursor, chat_id, body)
         if (user := cursor.get_user(body.get("user_id"))) is None:
             raise NotExistError
         msg_count = body.get("msg_count") or DEFAULT_MSG_COUNT
 
+        versions = body.get("versions") or {}
+
         chats = cursor.get_chat_list()
         chats_with_user = list(
             filter(lambda obj: user.id in obj.authors, chats)
         )
-        return utils.serialize(
-            {
-                "chats": [
-                    chat.serialize(msg_count) for chat in chats_with_user
-                ],
-            }
-        )
+        return {
+            "chats": [
+                chat.serialize_since(versions.get(str(chat.id)), msg_count)
+                for chat in chats_with_user
+            ],
+        }
 
-    def get_chat(self, cursor: ChatStorageCursor, pk: str, body: dict) -> str:
+    def get_chat(
+        self, cursor: ChatStorageCursor, pk: str, body: dict
+    ) -> dict:
         _, chat = self.get_user_and_chat(cursor, body.get("user_id"), pk)
         msg_count = body.get("msg_count") or DEFAULT_MSG_COUNT
-        return utils.serialize({"history": chat.serialize(msg_count)})
+        version = body.get("version")
+        return {"history": chat.serialize_since(version, msg_count)}
+
+    @accepts(user_id=as_uuid, msg_count=positive_int)
+    @connect_db()
+    def get_inbox(self, cursor: ChatStorageCursor, body: dict) -> dict:
+        if (user := cursor.get_user(body.get("user_id"))) is None:
+            raise NotExistError
+        chats = [
+            cursor.get_chat(chat_id)
+            for chat_id in cursor.db.counters.chats_of(user.id)
+        ]
+        return self.merge_inbox(chats, body)
 
+    @staticmethod
+    def merge_inbox(chats: Iterable[Chat], body: dict) -> dict:
+        """Newest messages of the chats before the cursor of the body
+
+        Timelines of the chats are merged lazily from their newest ends,
+        so a page reads only its messages and a heap entry per chat.
+        """
+        limit = body.get("msg_count") or DEFAULT_MSG_COUNT
+        before = load_inbox_cursor(body.get("before"))
+        newest = heapq.merge(
+            *(
+                zip(chat.history_before(before), repeat(chat.id))
+                for chat in chats
+            ),
+            key=lambda item: timeline_key(item[0]),
+            reverse=True,
+        )
+        return inbox_page(
+            (
+                dict(message.serialize(), chat_id=chat_id)
+                for message, chat_id in newest
+            ),
+            limit,
+        )
+
+    @accepts(user_id=as_uuid, other_user_id=as_uuid)
     @connect_db()
-    def enter_p2p(self, cursor: ChatStorageCursor, body: dict) -> str:
+    def enter_p2p(self, cursor: ChatStorageCursor, body: dict) -> dict:
         user = cursor.get_user(body.get("user_id"))
         other_user = cursor.get_user(body.get("other_user_id"))
         chats = list(
@@ -214,18 +495,50 @@ class Server:
             p2p_chat.enter(other_user)
         else:
             p2p_chat = chats[0]
-        return utils.serialize({"chat_id": str(p2p_chat.id)})
+        return {"chat_id": str(p2p_chat.id)}
 
-    @connect_db()
-    def leave(self, cursor: ChatStorageCursor, body: dict) -> str:
+    @accepts(user_id=as_uuid, chat_id=as_uuid)
+    @connect_db(keys=chat_keys)
+    def leave(self, cursor: ChatStorageCursor, body: dict) -> dict:
         author, chat = self.get_user_and_chat(
             cursor, body.get("user_id"), body.get("chat_id")
         )
         chat.leave(author)
-        return utils.serialize({})
+        return {}
 
-    @connect_db()
-    def add_message(self, cursor: ChatStorageCursor, body: dict) -> str:
+    @accepts(
+        author_id=as_uuid,
+        chat_id=as_uuid,
+        comment_on=as_uuid,
+        ttl=positive_number,
+    )
+    async def send(self, body: dict) -> dict:
+        """Adds a message, in a batch with concurrent ones if enabled"""
+        if self.send_batcher is None or not isinstance(body, dict):
+            return await self.add_message(body)
+        return await self.send_batcher.submit(body)
+
+    @connect_db(keys=message_keys)
+    def add_message(self, cursor: ChatStorageCursor, body: dict) -> dict:
+        return self.write_message(cursor, body, utils.now())
+
+    @connect_db(keys=batch_message_keys)
+    def add_messages(
+        self, cursor: ChatStorageCursor, bodies: list[dict]
+    ) -> list[dict | Exception]:
+        """Adds messages in order under one cursor, failing them apart"""
+        now = utils.now()
+        results = []
+        for body in bodies:
+            try:
+                results.append(self.write_message(cursor, body, now))
+            except Exception as error:
+                results.append(error)
+        return results
+
+    def write_message(
+        self, cursor: ChatStorageCursor, body: dict, now: datetime
+    ) -> dict:
         author, chat = self.get_user_and_chat(
             cursor,
             body.get("author_id"),
@@ -234,9 +547,17 @@ class Server:
         message = body.get("message")
 
         if self.msg_limit_enabled and self.check_msg_limit_exceeded(
-            cursor, author, chat
+            cursor, author, chat, now
         ):
             raise MsgLimitExceededError
+        expires = None
+        if (ttl := body.get("ttl")) is not None:
+            if ttl > DEFAULT_MAX_MESSAGE_TTL_SECS:
+                raise ValidationError(
+                    "TTL should be a positive number of seconds up to "
+                    f"{DEFAULT_MAX_MESSAGE_TTL_SECS:g}"
+                )
+            expires = now + timedelta(seconds=ttl)
         comment_on = body.get("comment_on")
         if comment_on is not None and cursor.get_message(comment_on) is None:
             comment_on = None
@@ -245,17 +566,19 @@ class Server:
             raise BannedError
 
         new_message = Message(
-            uuid.uuid4(),
-            utils.now(),
+            self.message_ids(),
+            now,
             author.id,
             text=message,
             is_comment_on=comment_on,
+            expires=expires,
         )
         chat.add_message(new_message)
-        return utils.serialize({"id": new_message.id})
+        return {"id": new_message.id}
 
+    @accepts(user_id=as_uuid, reported_user_id=as_uuid)
     @connect_db()
-    def report_user(self, cursor: ChatStorageCursor, body: dict) -> str:
+    def report_user(self, cursor: ChatStorageCursor, body: dict) -> dict:
         user_id = body.get("user_id")
         reported_user_id = body.get("reported_user_id")
         reason = body.get("reason")
@@ -286,47 +609,353 @@ class Server:
             reported_user=reported_user.id,
             reason=reason,
         )
-        return utils.serialize({"id": complaint_id})
+        return {"id": complaint_id}
+
+    @accepts(user_id=as_uuid)
+    @connect_db(keys=user_keys)
+    def heartbeat(self, cursor: ChatStorageCursor, body: dict) -> dict:
+        if (user := cursor.get_user(body.get("user_id"))) is None:
+            raise NotExistError
+        presence = self.database.presence
+        presence.heartbeat(user.id)
+        return {"timeout": presence.timeout_secs}
+
+    async def get_metrics(self, body: dict) -> str:
+        return self.metrics.render()
+
+    @accepts(limit=positive_int)
+    async def get_profiles(self, body: dict) -> dict:
+        limit = body.get("limit") or profiling.DEFAULT_SUMMARY_LIMIT
+        return {
+            "profiles": [
+                record.summary(limit)
+                for record in self.profiler.slowest.records()
+            ]
+        }
+
+    async def dump_profiles(self, body: dict) -> dict:
+        return {"paths": self.profiler.dump()}
+
+    async def get_admission(self, body: dict) -> dict:
+        return self.admission.stats(self.database.waiting)
+
+    @accepts(format=string)
+    async def export_archive(self, body: dict) -> dict:
+        """Streams the storage to a new archive in `archive_dir`"""
+        fmt = body.get("format") or archive.BINARY
+        if fmt not in archive.FORMATS:
+            raise ValidationError(
+                f"Format should be one of {', '.join(archive.FORMATS)}"
+            )
+        os.makedirs(self.archive_dir, exist_ok=True)
+        name = f"yachat-{utils.now():%Y%m%d-%H%M%S-%f}{archive.SUFFIXES[fmt]}"
+        path = os.path.join(self.archive_dir, name)
+        counts = await archive.export_file(self.database, path, fmt)
+        return {"path": path, **counts}
+
+    async def dispatch(self, request: protocol.Request) -> dict:
+        return await self.parse(request.method, request.url, request.body)
+
+    async def record_dispatch(self, request: protocol.Request) -> dict:
+        response = await self.dispatch(request)
+        self.recorder.record(request, response)
+        return response
+
+    async def idempotent_dispatch(
+        self,
+        dispatch: Callable[[protocol.Request], Awaitable[dict]],
+        request: protocol.Request,
+    ) -> dict:
+        """Answers a retried POST with the response of its first attempt"""
+        key = request.headers.get(protocol.IDEMPOTENCY_KEY)
+        if key is None or request.method != "POST":
+            return await dispatch(request)
+        return await self.idempotency.run(
+            (request.url, key), partial(dispatch, request)
+        )
+
+    async def admit_dispatch(
+        self,
+        dispatch: Callable[[protocol.Request], Awaitable[dict]],
+        host: str,
+        request: protocol.Request,
+    ) -> dict:
+        """Sheds the request at once if the server is overloaded"""
+        rejection = self.admission.admit(
+            request.method, request.url, host, self.database.waiting
+        )
+        if rejection is not None:
+            logger.info(
+                "Shed %s %s from %s: %s",
+                request.method,
+                request.url,
+                host,
+                rejection.reason,
+            )
+            self.metrics.shed.inc((rejection.reason, rejection.request_class))
+            return {
+                "fail": ERROR_OVERLOADED,
+                "retry_after": round(rejection.retry_after, 3),
+            }
+        try:
+            return await dispatch(request)
+        finally:
+            self.admission.release()
 
-    async def client_connected_callback(
-        self, reader: StreamReader, writer: StreamWriter
+    def client_connected_callback(
+        self, reader: protocol.IdleReader, writer: StreamWriter
     ) -> None:
-        addr = writer.get_extra_info("peername")
-        data = await reader.read(self.limit)
-        message = data.decode()
-        logger.debug(f"Received {message} from {addr}")
+        dispatch = self.dispatch
+        if self.recorder is not None:
+            dispatch = self.record_dispatch
+        if self.idempotency is not None:
+            dispatch = partial(self.idempotent_dispatch, dispatch)
+        if self.admission is not None:
+            peer = writer.get_extra_info("peername")
+            host = peer[0] if isinstance(peer, tuple) else "local"
+            dispatch = partial(self.admit_dispatch, dispatch, host)
+        self.handle_connection(reader, writer, dispatch)
+
+    def handle_connection(
+        self,
+        reader: protocol.IdleReader,
+        writer: StreamWriter,
+        dispatch: Callable[[protocol.Request], Awaitable[dict]],
+    ) -> None:
+        """Parks a new connection until its first request arrives"""
+        if (
+            self.max_connections
+            and len(self.connection_writers) >= self.max_connections
+        ):
+            logger.warning(
+                "Refusing a connection, %d are open", self.max_connections
+            )
+            self.metrics.refused.inc()
+            writer.close()
+            return
+        self.connection_writers.add(writer)
+        self.metrics.connections.inc()
+        self.park(reader, writer, dispatch)
+
+    def park(
+        self,
+        reader: protocol.IdleReader,
+        writer: StreamWriter,
+        dispatch: Callable[[protocol.Request], Awaitable[dict]],
+    ) -> None:
+        """Waits for the next request without a task, up to the idle deadline
+
+        A task to serve the connection is only started once data arrives.
+        """
+        loop = asyncio.get_running_loop()
+        expiry = None
+        if self.keepalive_timeout_secs:
+            expiry = loop.call_later(
+                self.keepalive_timeout_secs, self.expire, reader, writer
+            )
+
+        def wake() -> None:
+            if expiry is not None:
+                expiry.cancel()
+            task = loop.create_task(
+                self.serve_connection(reader, writer, dispatch)
+            )
+            self.connection_tasks.add(task)
+            task.add_done_callback(self.connection_tasks.discard)
 
-        response = await self.parse(message)
+        reader.park(wake)
 
-        logger.debug(f"Sending: {response}")
-        writer.write(response.encode())
-        await writer.drain()
+    def expire(
+        self, reader: protocol.IdleReader, writer: StreamWriter
+    ) -> None:
+        reader.unpark()
+        self.count_timeout(IDLE, writer)
+        self.close_connection(writer)
 
+    def close_connection(self, writer: StreamWriter) -> None:
         logger.info("Closing the connection")
+        if writer in self.connection_writers:
+            self.connection_writers.discard(writer)
+            self.metrics.connections.dec()
         writer.close()
-        await writer.wait_closed()
+
+    def count_timeout(self, kind: str, writer: StreamWriter) -> None:
+        logger.info(
+            "Connection to %s passed its %s deadline",
+            writer.get_extra_info("peername"),
+            kind,
+        )
+        self.metrics.timeouts.inc((kind,))
+
+    async def serve_connection(
+        self,
+        reader: protocol.IdleReader,
+        writer: StreamWriter,
+        dispatch: Callable[[protocol.Request], Awaitable[dict]],
+    ) -> None:
+        """Answers an arrived request, then parks or closes the connection"""
+        keep_alive = False
+        try:
+            keep_alive = await self.serve_request(reader, writer, dispatch)
+        finally:
+            if keep_alive:
+                logger.debug(
+                    "Keeping the connection to %s alive",
+                    writer.get_extra_info("peername"),
+                )
+                self.park(reader, writer, dispatch)
+            else:
+                self.close_connection(writer)
+
+    async def serve_request(
+        self,
+        reader: StreamReader,
+        writer: StreamWriter,
+        dispatch: Callable[[protocol.Request], Awaitable[dict]],
+    ) -> bool:
+        """Answers one request, returns whether to wait for another one
+
+        A client asks to reuse the connection with a `connection:
+        keep-alive` header. Headers and body are read within their own
+        deadlines, so a slow client cannot hold the connection.
+        """
+        addr = writer.get_extra_info("peername")
+        accept_encoding = None
+        keep_alive = False
+        deadline = HEADER
+        try:
+            request = await asyncio.wait_for(
+                protocol.read_head(reader), self.header_timeout_secs or None
+            )
+            if request is not None:
+                deadline = BODY
+                await asyncio.wait_for(
+                    protocol.read_body(reader, request, self.max_body_size),
+                    self.body_timeout_secs or None,
+                )
+        except asyncio.TimeoutError:
+            self.count_timeout(deadline, writer)
+            return False
+        except protocol.BodyTooLargeError:
+            logger.warning("Rejected a too large body from %s", addr)
+            response = {"fail": ERROR_BODY_TOO_LARGE}
+        except (ValueError, asyncio.IncompleteReadError):
+            logger.exception(ERROR_NOT_SUPPORTED)
+            response = {"fail": ERROR_NOT_SUPPORTED}
+        else:
+            if request is None:
+                return False
+            logger.debug("Received %s from %s", request, addr)
+            accept_encoding = request.headers.get(protocol.ACCEPT_ENCODING)
+            keep_alive = (
+                request.headers.get(protocol.CONNECTION) == protocol.KEEP_ALIVE
+            )
+            response = await dispatch(request)
+
+        try:
+            logger.debug("Streaming response to %s", addr)
+            await self.write_response(
+                writer,
+                await self.encode_response(response),
+                accept_encoding,
+                keep_alive,
+            )
+        except asyncio.TimeoutError:
+            self.count_timeout(WRITE, writer)
+            return False
+        except Exception:
+            logger.exception("Error while streaming response")
+            return False
+        return keep_alive
+
+    async def encode_response(self, response: Any) -> Iterable[bytes]:
+        """Chunks of the response, heavy ones encoded by the offload pool"""
+        if self.offloader is None or not self.offloader.is_heavy(response):
+            return utils.iter_serialize(response, self.chunk_size)
+        started = time.perf_counter()
+        self.metrics.offload_queue.inc()
+        try:
+            return await self.offloader.encode(response, self.chunk_size)
+        except Exception:
+            logger.exception("Error while offloading, encoding inline")
+            return utils.iter_serialize(response, self.chunk_size)
+        finally:
+            self.metrics.offload_queue.dec()
+            self.metrics.offload_latency.observe(
+                time.perf_counter() - started
+            )
+
+    async def write_response(
+        self,
+        writer: StreamWriter,
+        chunks: Iterable[bytes],
+        accept_encoding: str | None,
+        keep_alive: bool = False,
+    ) -> None:
+        """Streams chunks as frames, compressing them above the threshold"""
+        chunks = iter(chunks)
+        head, size = [], 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= self.compression_threshold:
+                break
+        encoding = compression.IDENTITY
+        if size >= self.compression_threshold:
+            encoding = compression.negotiate(accept_encoding)
+        headers = {
+            protocol.CONTENT_ENCODING: encoding,
+            protocol.TRANSFER_ENCODING: protocol.CHUNKED,
+        }
+        if keep_alive:
+            headers[protocol.CONNECTION] = protocol.KEEP_ALIVE
+        writer.write(protocol.encode_headers(headers))
+
+        frames = compression.compress_stream(chain(head, chunks), encoding)
+        for frame in frames:
+            writer.writelines(protocol.encode_chunk(frame))
+            await self.drain(writer)
+        writer.write(protocol.LAST_CHUNK)
+        await self.drain(writer)
+
+    async def drain(self, writer: StreamWriter) -> None:
+        """Waits for a slow reader to take the response, up to a deadline"""
+        await asyncio.wait_for(
+            writer.drain(), self.write_timeout_secs or None
+        )
 
     def sigint_handler(self) -> None:
         logger.warning("SIGINT called. Finishing")
-        loop = asyncio.get_event_loop()
-        loop.stop()
+        if self.stopping is None:
+            self.stopping = asyncio.ensure_future(self.stop())
+
+    async def stop(self) -> None:
+        """Stops serving, startup then returns"""
+        if self.serving is not None:
+            self.serving.cancel()
 
     async def listen(self) -> None:
         loop = asyncio.get_event_loop()
         loop.add_signal_handler(signal.SIGINT, self.sigint_handler)
 
-        server = await asyncio.start_server(
+        server = await protocol.start_server(
             self.client_connected_callback,
             self.host,
             self.port,
             limit=self.limit,
+            reuse_port=self.reuse_port,
         )
 
         addrs = ", ".join(str(sock.getsockname()) for sock in server.sockets)
-        logger.info(f"Serving on {addrs}")
+        logger.info("Serving on %s", addrs)
 
-        async with server:
-            await server.serve_forever()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            # keep-alive connections would otherwise outlive the server
+            for writer in self.connection_writers:
+                writer.close()
 
     async def moderator(self) -> None:
         while True:
@@ -335,20 +964,25 @@ class Server:
             await asyncio.sleep(self.moderation_cycle_secs)
 
     @connect_db(user=MODERATOR)
-    def check_reported_users(self, cursor: ChatStorageCursor) -> None:
+    def check_reported_users(self, cursor: ChatStorageCursor) -> list[User]:
+        reviewed_users = []
         for bid in cursor.get_complaint_list():
             if bid.reviewed:
                 continue
-            user = cursor.get_user(str(bid.reported_user))
+            user = cursor.get_user(bid.reported_user)
             if user.reported_times + 1 == DEFAULT_MAX_COMPLAINT_COUNT:
                 user.is_banned = True
                 user.banned_when = utils.now()
             else:
                 user.reported_times += 1
             bid.reviewed = True
+            reviewed_users.append(user)
+        return reviewed_users
 
     @connect_db(user=MODERATOR)
     def check_unban(self, cursor: ChatStorageCursor) -> None:
+        if not cursor.count_banned_users():
+            return
         for user in cursor.get_user_list():
             if (
                 user.is_banned
@@ -359,18 +993,194 @@ class Server:
                 user.is_banned = False
                 user.banned_when = None
 
-    async def startup(self) -> None:
-        await asyncio.gather(
-            self.listen(), self.moderator(), return_exceptions=True
+    async def expiry(self) -> None:
+        """Deletes expired messages in short slices between requests"""
+        while True:
+            while self.database.retention.has_due(time.time()):
+                await self.expire_slice()
+                await asyncio.sleep(0)
+            await asyncio.sleep(self.expiry_cycle_secs)
+
+    @connect_db(user=EXPIRY)
+    def expire_slice(self, cursor: ChatStorageCursor) -> None:
+        retention = self.database.retention
+        retention.expire(cursor, utils.now(), self.expiry_slice_secs)
+        # catches up with the messages trimmed as others were added
+        self.metrics.expired.inc(
+            amount=retention.expired - self.metrics.expired.get()
         )
 
+    async def presence_expiry(self) -> None:
+        """Takes users offline as they miss their heartbeats"""
+        presence = self.database.presence
+        while True:
+            presence.expire()
+            self.metrics.online.set(len(presence))
+            await asyncio.sleep(presence.tick_secs)
+
+    async def load(self, path: str) -> None:
+        """Fills the storage from an archive before serving"""
+        started = time.perf_counter()
+        counts = await archive.load_file(self.database, path)
+        # loaded objects live as long as the server, collections need
+        # not walk them again
+        gc.freeze()
+        logger.info(
+            "Loaded %s in %.1fs",
+            archive.summarize(counts),
+            time.perf_counter() - started,
+        )
+
+    async def startup(self) -> None:
+        if self.load_path:
+            await self.load(self.load_path)
+        background = [
+            self.listen(),
+            self.moderator(),
+            self.expiry(),
+            self.presence_expiry(),
+            self.metrics.monitor_loop_lag(self.loop_lag_interval_secs),
+        ]
+        if self.offloader is not None:
+            # workers start alongside the listener, not ahead of it
+            background.append(self.offloader.start())
+        self.serving = asyncio.gather(*background, return_exceptions=True)
+        try:
+            await self.serving
+        except asyncio.CancelledError:
+            # cancelled by stop, not by the caller
+            if self.stopping is None:
+                raise
+        finally:
+            if self.offloader is not None:
+                await self.offloader.shutdown()
+            if self.profiler is not None:
+                # stops the stack sampler thread
+                self.profiler.close()
+            if self.recorder is not None:
+                self.recorder.close()
+
 
 if __name__ == "__main__":
-    logging.basicConfig(
-        format="[%(levelname)s] - %(asctime)s - %(message)s",
-        level=logging.DEBUG,
-        datefmt="%H:%M:%S",
+    parser = argparse.ArgumentParser(description="yachat server")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes sharing the port",
+    )
+    parser.add_argument(
+        "--profile-every",
+        type=int,
+        default=DEFAULT_PROFILE_SAMPLE_EVERY,
+        help="run one request in N under cProfile",
+    )
+    parser.add_argument(
+        "--profile-threshold-ms",
+        type=float,
+        default=DEFAULT_PROFILE_THRESHOLD_MS,
+        help="keep stack samples of requests slower than this",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=DEFAULT_SERVER_MAX_CONNECTIONS,
+        help="close new connections beyond this many open, 0 for no cap",
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=DEFAULT_ADMISSION_MAX_IN_FLIGHT,
+        help="shed requests beyond this many in flight",
+    )
+    parser.add_argument(
+        "--max-queue-depth",
+        type=int,
+        default=DEFAULT_ADMISSION_MAX_QUEUE_DEPTH,
+        help="shed requests while this many wait for storage shards",
+    )
+    parser.add_argument(
+        "--priority",
+        choices=admission.PRIORITIES,
+        default=DEFAULT_ADMISSION_PRIORITY,
+        help="requests admitted first when the limits are close",
+    )
+    parser.add_argument(
+        "--ip-rate",
+        type=float,
+        default=DEFAULT_ADMISSION_IP_RATE,
+        help="requests per second allowed to each client IP",
+    )
+    parser.add_argument(
+        "--ip-burst",
+        type=float,
+        default=DEFAULT_ADMISSION_IP_BURST,
+        help="requests a client IP may send at once, --ip-rate by default",
     )
+    parser.add_argument(
+        "--record",
+        metavar="PATH",
+        default=DEFAULT_RECORD_PATH,
+        help="append served requests to a JSON-lines capture file",
+    )
+    parser.add_argument(
+        "--load",
+        metavar="PATH",
+        default=DEFAULT_LOAD_PATH,
+        help="fill the storage from an archive of archive.py on startup",
+    )
+    parser.add_argument(
+        "--archive-dir",
+        default=DEFAULT_ARCHIVE_DIR,
+        help="serve POST /admin/archive writing archives of the storage here",
+    )
+    logs.add_arguments(parser)
+    args = parser.parse_args()
+    if args.record and args.workers > 1:
+        parser.error("--record needs a single worker")
+    if args.load and args.workers > 1:
+        parser.error("--load needs a single worker")
+
+    logs.setup_from_args(args)
+
+    admission_controller = admission.AdmissionController(
+        max_in_flight=args.max_in_flight,
+        max_queue_depth=args.max_queue_depth,
+        priority=args.priority,
+        ip_rate=args.ip_rate,
+        ip_burst=args.ip_burst,
+    )
+    if not admission_controller.enabled:
+        admission_controller = None
+
+    if args.workers > 1:
+        from workers import run_workers
 
-    server = Server()
-    asyncio.run(server.startup())
+        run_workers(
+            args.workers,
+            host=args.host,
+            port=args.port,
+            max_connections=args.max_connections,
+            admission=admission_controller,
+        )
+    else:
+        recorder = None
+        if args.record:
+            recorder = traffic.TrafficRecorder(args.record)
+        profiler = profiling.Profiler(
+            sample_every=args.profile_every,
+            threshold_secs=args.profile_threshold_ms / 1000,
+        )
+        server = Server(
+            host=args.host,
+            port=args.port,
+            profiler=profiler if profiler.enabled else None,
+            recorder=recorder,
+            load_path=args.load,
+            archive_dir=args.archive_dir,
+            max_connections=args.max_connections,
+            admission=admission_controller,
+        )
+        asyncio.run(server.startup())
@@ -14,7 +14,69 @@ DEFAULT_BAN_PERIOD_HOURS = int(os.getenv("BAN_PERIOD_HOURS", 4))
 DEFAULT_MAX_COMPLAINT_COUNT = int(os.getenv("MAX_COMPLAINT_COUNT", 3))
 DEFAULT_MODERATION_CYCLE_SECS = int(os.getenv("MODERATION_CYCLE_SECS", 5))
 DEFAULT_TZ = os.getenv("DEFAULT_TZ", "Europe/Moscow")
+DEFAULT_COMPRESSION_THRESHOLD = int(os.getenv("COMPRESSION_THRESHOLD", 2**12))
+DEFAULT_CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 2**14))
+DEFAULT_PROFILE_SAMPLE_EVERY = int(os.getenv("PROFILE_SAMPLE_EVERY", 0))
+DEFAULT_PROFILE_THRESHOLD_MS = float(os.getenv("PROFILE_THRESHOLD_MS", 0))
+DEFAULT_PROFILE_TOP_K = int(os.getenv("PROFILE_TOP_K", 20))
+DEFAULT_PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+DEFAULT_KEEPALIVE_TIMEOUT_SECS = float(os.getenv("KEEPALIVE_TIMEOUT_SECS", 5))
+DEFAULT_HEADER_TIMEOUT_SECS = float(os.getenv("HEADER_TIMEOUT_SECS", 10))
+DEFAULT_BODY_TIMEOUT_SECS = float(os.getenv("BODY_TIMEOUT_SECS", 30))
+DEFAULT_WRITE_TIMEOUT_SECS = float(os.getenv("WRITE_TIMEOUT_SECS", 30))
+DEFAULT_MAX_BODY_SIZE = int(os.getenv("MAX_BODY_SIZE", 2**20))
+DEFAULT_SERVER_MAX_CONNECTIONS = int(os.getenv("SERVER_MAX_CONNECTIONS", 10000))
+DEFAULT_IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 100000))
+DEFAULT_IDEMPOTENCY_TTL_SECS = float(os.getenv("IDEMPOTENCY_TTL_SECS", 300))
+DEFAULT_SEND_BATCH_SIZE = int(os.getenv("SEND_BATCH_SIZE", 128))
+DEFAULT_SEND_BATCH_DELAY_SECS = float(os.getenv("SEND_BATCH_DELAY_SECS", 0.0002))
+DEFAULT_RECORD_PATH = os.getenv("RECORD_PATH", "")
+DEFAULT_LOAD_PATH = os.getenv("LOAD_PATH", "")
+DEFAULT_ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "")
+DEFAULT_LOOP_LAG_INTERVAL_SECS = float(os.getenv("LOOP_LAG_INTERVAL_SECS", 0.5))
+DEFAULT_OFFLOAD_WORKERS = int(os.getenv("OFFLOAD_WORKERS", 0))
+DEFAULT_OFFLOAD_THRESHOLD = int(os.getenv("OFFLOAD_THRESHOLD", 5000))
+
+# Retention Settings
+DEFAULT_RETENTION_COMMON_MAX_MESSAGES = int(os.getenv("RETENTION_COMMON_MAX_MESSAGES", 0))
+DEFAULT_RETENTION_COMMON_HOURS = float(os.getenv("RETENTION_COMMON_HOURS", 0))
+DEFAULT_RETENTION_PRIVATE_MAX_MESSAGES = int(os.getenv("RETENTION_PRIVATE_MAX_MESSAGES", 0))
+DEFAULT_RETENTION_PRIVATE_HOURS = float(os.getenv("RETENTION_PRIVATE_HOURS", 0))
+DEFAULT_MAX_MESSAGE_TTL_SECS = float(os.getenv("MAX_MESSAGE_TTL_SECS", 7 * 24 * 3600))
+DEFAULT_EXPIRY_BUCKET_SECS = float(os.getenv("EXPIRY_BUCKET_SECS", 1))
+DEFAULT_EXPIRY_CYCLE_SECS = float(os.getenv("EXPIRY_CYCLE_SECS", 1))
+DEFAULT_EXPIRY_SLICE_MS = float(os.getenv("EXPIRY_SLICE_MS", 2))
+
+# Presence Settings
+DEFAULT_PRESENCE_TIMEOUT_SECS = float(os.getenv("PRESENCE_TIMEOUT_SECS", 90))
+DEFAULT_PRESENCE_TICK_SECS = float(os.getenv("PRESENCE_TICK_SECS", 1))
+DEFAULT_PRESENCE_WHEEL_SLOTS = int(os.getenv("PRESENCE_WHEEL_SLOTS", 64))
+
+# Admission Settings
+DEFAULT_ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", 0))
+DEFAULT_ADMISSION_MAX_QUEUE_DEPTH = int(os.getenv("ADMISSION_MAX_QUEUE_DEPTH", 0))
+DEFAULT_ADMISSION_PRIORITY = os.getenv("ADMISSION_PRIORITY", "writes")
+DEFAULT_ADMISSION_RESERVED_SHARE = float(os.getenv("ADMISSION_RESERVED_SHARE", 0.2))
+DEFAULT_ADMISSION_IP_RATE = float(os.getenv("ADMISSION_IP_RATE", 0))
+DEFAULT_ADMISSION_IP_BURST = float(os.getenv("ADMISSION_IP_BURST", 0))
+DEFAULT_ADMISSION_RETRY_AFTER_SECS = float(os.getenv("ADMISSION_RETRY_AFTER_SECS", 0.5))
+
+# Logging Settings
+DEFAULT_LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG")
+DEFAULT_LOG_QUEUED = bool(int(os.getenv("LOG_QUEUED", 1)))
+DEFAULT_LOG_JSON = bool(int(os.getenv("LOG_JSON", 0)))
+DEFAULT_LOG_SAMPLE = os.getenv("LOG_SAMPLE", "")
+DEFAULT_LOG_LINGER_SECS = float(os.getenv("LOG_LINGER_SECS", 0.05))
+
+# Client Settings
+DEFAULT_CLIENT_POOL_SIZE = int(os.getenv("CLIENT_POOL_SIZE", 10))
+DEFAULT_CLIENT_POOL_IDLE_SECS = float(os.getenv("CLIENT_POOL_IDLE_SECS", 4))
+DEFAULT_CLIENT_TIMEOUT_SECS = float(os.getenv("CLIENT_TIMEOUT_SECS", 30))
+DEFAULT_CLIENT_RETRIES = int(os.getenv("CLIENT_RETRIES", 2))
+DEFAULT_CLIENT_BACKOFF_SECS = float(os.getenv("CLIENT_BACKOFF_SECS", 0.05))
 
 # Database Settings
 DEFAULT_MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", 1))
+DEFAULT_STORAGE_SHARDS = int(os.getenv("STORAGE_SHARDS", 8))
+DEFAULT_CHAT_CHANGES_KEPT = int(os.getenv("CHAT_CHANGES_KEPT", 1000))
 DEFAULT_DB_CONNECTION_WAIT_SECS = float(os.getenv("DB_CONNECTION_WAIT_SECS", 0.001))
@@ -1,6 +1,9 @@
+import asyncio
+
 import pytest
 
 from db import ChatStorage
+from server import Server
 
 from .factories import ChatFactory, MessageFactory
 
@@ -11,6 +14,28 @@ async def create_storage():
     """Creates test chat storage"""
     db = ChatStorage(max_connections=1)
     messages = MessageFactory.create_batch(2)
-    chats = [ChatFactory(name="", messages=messages) for _ in range(2)]
+    chats = [
+        ChatFactory(
+            name="", messages={message.id: message for message in messages}
+        )
+        for _ in range(2)
+    ]
     db.chats = {chat.id: chat for chat in chats}
     return db, chats, messages
+
+
+@pytest.fixture
+def server_kwargs():
+    """Keyword arguments of the `server` fixture, overridden by modules"""
+    return {}
+
+
+@pytest.fixture
+def server(event_loop, unused_tcp_port, server_kwargs):
+    """Fires up async server in pytest event loop"""
+    server = Server(port=unused_tcp_port, **server_kwargs)
+    cancel_handle = asyncio.ensure_future(server.startup(), loop=event_loop)
+    event_loop.run_until_complete(asyncio.sleep(0.01))
+    yield server
+    cancel_handle.cancel()
+    event_loop.run_until_complete(asyncio.sleep(0.01))
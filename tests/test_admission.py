@@ -0,0 +1,121 @@
+import asyncio
+import json
+
+import pytest
+
+import admission
+from admission import AdmissionController, TokenBucket
+from client import ChatClient
+from db import ChatStorage
+from server import ERROR_OVERLOADED, Server
+
+pytestmark = pytest.mark.asyncio
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def start_server(event_loop, unused_tcp_port):
+    """Starts a server with admission control in pytest event loop"""
+    handles = []
+
+    async def start(**kwargs) -> Server:
+        server = Server(
+            port=unused_tcp_port, admission=AdmissionController(**kwargs)
+        )
+        # a single cursor makes the next one wait
+        server.database = ChatStorage(max_connections=0)
+        handles.append(asyncio.ensure_future(server.startup()))
+        await asyncio.sleep(0.01)
+        return server
+
+    yield start
+    for handle in handles:
+        handle.cancel()
+    event_loop.run_until_complete(asyncio.sleep(0.01))
+
+
+async def test_token_bucket():
+    bucket = TokenBucket(rate=2, burst=2, now=0)
+
+    assert bucket.take(0) == bucket.take(0) == 0
+    assert bucket.take(0) == pytest.approx(0.5)
+    assert bucket.take(0.5) == 0
+
+
+async def test_rate_limited_per_ip():
+    clock = Clock()
+    controller = AdmissionController(ip_rate=1, ip_burst=2, clock=clock)
+
+    admitted = [
+        controller.admit("GET", "/status", host, 0) is None
+        for host in ("a", "a", "a", "b")
+    ]
+    clock.now = 1
+
+    assert admitted == [True, True, False, True]
+    assert controller.admit("GET", "/status", "a", 0) is None
+    assert controller.shed == {(admission.RATE, admission.READS): 1}
+
+
+@pytest.mark.parametrize(
+    "priority, admitted",
+    [
+        ("writes", {"POST": True, "GET": False}),
+        ("reads", {"POST": False, "GET": True}),
+        ("none", {"POST": True, "GET": True}),
+    ],
+)
+async def test_priority_class_keeps_reserved_share(priority, admitted):
+    controller = AdmissionController(
+        max_in_flight=10, priority=priority, reserved_share=0.2
+    )
+    for _ in range(8):
+        controller.admit("PUT", "/any", "a", 0)
+
+    assert {
+        method: controller.admit(method, "/send", "a", 0) is None
+        for method in ("POST", "GET")
+    } == admitted
+
+
+async def test_queue_depth_and_release():
+    controller = AdmissionController(max_in_flight=1, max_queue_depth=2)
+
+    assert controller.admit("POST", "/send", "a", 2).reason == admission.QUEUE
+    assert controller.admit("POST", "/send", "a", 0) is None
+    rejection = controller.admit("POST", "/send", "a", 0)
+    controller.release()
+
+    assert rejection.reason == admission.IN_FLIGHT
+    assert controller.admit("POST", "/send", "a", 0) is None
+    assert controller.admit("GET", "/metrics", "a", 0) is None
+
+
+async def test_overloaded_server_sheds_fast(start_server):
+    server = await start_server(max_queue_depth=1)
+    client = ChatClient(server_port=server.port)
+    await client.signup()
+    cursor = await server.database.connect()
+
+    queued = asyncio.ensure_future(client.get_status())
+    await asyncio.sleep(0.01)
+    response = json.loads(
+        await client.get("/status", data=dict(user_id=client.uuid))
+    )
+    cursor.disconnect()
+    await queued
+
+    assert response["fail"] == ERROR_OVERLOADED
+    assert response["retry_after"] > 0
+    stats = json.loads(await client.get("/admin/admission"))
+    assert stats["shed"] == {"queue/reads": 1}
+    assert stats["in_flight"] == 1
+    assert 'reason="queue"' in await client.get("/metrics")
+    await client.close()
@@ -0,0 +1,207 @@
+import asyncio
+import io
+import json
+import pickle
+import uuid
+from datetime import timedelta
+
+import pytest
+
+import archive
+import utils
+from client import ChatClient
+from db import ChatStorage, Message
+from server import Server
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def server_kwargs(tmp_path):
+    return dict(archive_dir=str(tmp_path / "archives"))
+
+
+async def filled_storage(**kwargs) -> ChatStorage:
+    storage = ChatStorage(**kwargs)
+    cursor = await storage.connect()
+    alice, bob = cursor.create_user(), cursor.create_user()
+    cursor.get_user(bob).is_banned = True
+    default = cursor.get_chat(cursor.get_default_chat_id())
+    default.authors.update({uuid.UUID(alice), uuid.UUID(bob)})
+    p2p = cursor.get_chat(
+        cursor.create_p2p_chat(name="p2p", authors={uuid.UUID(alice)})
+    )
+    now = utils.now()
+    for number in range(30):
+        chat = default if number % 3 else p2p
+        chat.add_message(
+            Message(
+                uuid.uuid4(),
+                now + timedelta(seconds=number),
+                uuid.UUID(alice),
+                str(number),
+                expires=now + timedelta(days=1) if number == 7 else None,
+            )
+        )
+    deleted = next(iter(default.messages))
+    default.delete_message(deleted)
+    default.add_message(
+        Message(uuid.uuid4(), now, uuid.UUID(bob), "re", is_comment_on=deleted)
+    )
+    cursor.create_complaint(
+        author=uuid.UUID(alice),
+        created=now,
+        reported_user=uuid.UUID(bob),
+        reason="spam",
+    )
+    cursor.disconnect()
+    return storage
+
+
+async def snapshot(storage: ChatStorage) -> dict:
+    cursor = await storage.connect()
+    try:
+        return {
+            "default": storage.default_chat_id,
+            "users": {
+                user.id: (user.is_banned, user.reported_times)
+                for user in cursor.get_user_list()
+            },
+            "chats": {
+                chat.id: (
+                    chat.type,
+                    chat.name,
+                    chat.authors,
+                    list(chat.history_before()),
+                )
+                for chat in cursor.get_chat_list()
+            },
+            "complaints": cursor.get_complaint_list(),
+            "order": [chat.id for chat in cursor.get_chat_list()],
+        }
+    finally:
+        cursor.disconnect()
+
+
+@pytest.mark.parametrize("fmt", archive.FORMATS)
+async def test_storage_survives_export_and_import(fmt):
+    storage = await filled_storage()
+    file = io.BytesIO()
+
+    exported = await archive.export_storage(storage, file, fmt)
+    file.seek(0)
+    loaded = ChatStorage()
+    cursor = await loaded.connect()
+    imported = archive.import_storage(cursor, file, fmt)
+    cursor.disconnect()
+
+    assert exported == imported == {
+        "user": 2,
+        "chat": 2,
+        "message": 30,
+        "complaint": 1,
+    }
+    assert await snapshot(loaded) == await snapshot(storage)
+
+
+async def test_export_in_slices_while_storage_changes(mocker):
+    mocker.patch("archive.BATCH_ROWS", 1)
+    # a single shard, every new user changes the dict being read
+    storage = await filled_storage(shards=1)
+    before = await snapshot(storage)
+
+    async def keep_writing() -> None:
+        for number in range(50):
+            cursor = await storage.connect()
+            user_id = cursor.create_user()
+            chat = cursor.get_chat(storage.default_chat_id)
+            chat.add_message(
+                Message(uuid.uuid4(), utils.now(), uuid.UUID(user_id), "new")
+            )
+            cursor.disconnect()
+            await asyncio.sleep(0)
+
+    file = io.BytesIO()
+    writing = asyncio.ensure_future(keep_writing())
+    counts = await archive.export_storage(storage, file, archive.BINARY)
+    await writing
+    file.seek(0)
+    loaded = ChatStorage()
+    cursor = await loaded.connect()
+    archive.import_storage(cursor, file)
+    cursor.disconnect()
+
+    after = await snapshot(loaded)
+    assert counts["user"] == len(after["users"]) >= len(before["users"])
+    for chat_id, (*_, messages) in before["chats"].items():
+        assert set(messages) <= set(after["chats"][chat_id][-1])
+
+
+async def test_converted_archive_loads_the_same(tmp_path):
+    with open(tmp_path / "seed.bin", "wb") as file:
+        archive.generate(archive.BinaryWriter(file), 5, 3, 1000)
+    with open(tmp_path / "seed.bin", "rb") as source:
+        with open(tmp_path / "seed.ndjson", "wb") as target:
+            archive.write_records(
+                archive.NdjsonWriter(target), archive.BinaryReader(source)
+            )
+
+    storages = [ChatStorage(), ChatStorage()]
+    counts = [
+        await archive.load_file(storage, str(tmp_path / name))
+        for storage, name in zip(storages, ["seed.bin", "seed.ndjson"])
+    ]
+
+    assert counts[0] == counts[1]
+    assert counts[0]["message"] == 1000
+    assert await snapshot(storages[0]) == await snapshot(storages[1])
+
+
+async def test_binary_archive_cannot_name_code():
+    file = io.BytesIO(
+        archive.BINARY_MAGIC
+        + pickle.dumps(("user", None, []))
+        + pickle.dumps(("user", None, [utils.now()]))
+    )
+
+    with pytest.raises(pickle.UnpicklingError, match="datetime"):
+        list(archive.BinaryReader(file))
+
+
+async def test_server_loads_archive(tmp_path):
+    path = str(tmp_path / "seed.ndjson")
+    storage = await filled_storage()
+    with open(path, "wb") as file:
+        await archive.export_storage(storage, file, archive.NDJSON)
+    server = Server(load_path=path)
+
+    await server.load(server.load_path)
+
+    users = (await snapshot(storage))["users"]
+    alice = next(pk for pk, (is_banned, _) in users.items() if not is_banned)
+    status = await server.parse(
+        "GET", "/status", json.dumps(dict(user_id=str(alice)))
+    )
+    assert status["chat_default"] == storage.default_chat_id
+    assert status["chats_with_user_count"] == 2
+
+
+async def test_live_server_round_trip(server):
+    client = ChatClient(server_port=server.port)
+    await client.signup()
+    for number in range(5):
+        await client.post_send(message=str(number))
+
+    response = await archive.request_export(
+        "127.0.0.1", server.port, archive.NDJSON
+    )
+    restored = Server()
+    await restored.load(response["path"])
+
+    assert response["path"].endswith(".ndjson")
+    assert response["message"] == 5
+    assert await snapshot(restored.database) == await snapshot(
+        server.database
+    )
+    invalid = await archive.request_export("127.0.0.1", server.port, "csv")
+    assert "fail" in invalid
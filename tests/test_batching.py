@@ -0,0 +1,101 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+
+from batching import Batcher
+from server import Server
+
+pytestmark = pytest.mark.asyncio
+
+
+async def apply_doubled(items: list) -> list:
+    return [ValueError(item) if item < 0 else item * 2 for item in items]
+
+
+async def test_concurrent_items_batched():
+    batcher = Batcher(apply_doubled, max_size=10, max_delay_secs=0)
+
+    results = await asyncio.gather(
+        *(batcher.submit(item) for item in (1, -1, 3)),
+        return_exceptions=True,
+    )
+
+    assert results[0] == 2
+    assert isinstance(results[1], ValueError)
+    assert results[2] == 6
+    assert (batcher.batches, batcher.items) == (1, 3)
+
+
+async def test_cancelled_batch_releases_callers():
+    started = asyncio.Event()
+
+    async def apply_forever(items: list) -> list:
+        started.set()
+        await asyncio.Event().wait()
+
+    batcher = Batcher(apply_forever, max_size=2, max_delay_secs=0)
+    submitted = asyncio.gather(
+        *(batcher.submit(item) for item in range(2)), return_exceptions=True
+    )
+    await started.wait()
+
+    for task in batcher.tasks:
+        task.cancel()
+    results = await asyncio.wait_for(submitted, 1)
+
+    assert all(isinstance(r, asyncio.CancelledError) for r in results)
+
+
+async def test_full_batch_flushed_without_delay():
+    batcher = Batcher(apply_doubled, max_size=2, max_delay_secs=60)
+
+    results = await asyncio.wait_for(
+        asyncio.gather(*(batcher.submit(item) for item in range(4))), 1
+    )
+
+    assert results == [0, 2, 4, 6]
+    assert batcher.batches == 2
+
+
+async def test_failed_batch_fails_every_item():
+    async def apply(items: list) -> list:
+        raise RuntimeError
+
+    batcher = Batcher(apply, max_size=10, max_delay_secs=0)
+
+    results = await asyncio.gather(
+        batcher.submit(1), batcher.submit(2), return_exceptions=True
+    )
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+async def test_sends_share_a_cursor(mocker):
+    server = Server(send_batch_size=8, send_batch_delay_secs=0.001)
+    users = [(await server.register({}))["token"] for _ in range(3)]
+    server.database.users[uuid.UUID(users[2])].is_banned = True
+    connect = mocker.spy(server.database, "connect")
+
+    responses = await asyncio.gather(
+        *(
+            server.parse(
+                "POST",
+                "/send",
+                json.dumps(dict(author_id=user, message=f"from {user}")),
+            )
+            for user in users
+        )
+    )
+
+    assert connect.call_count == 1
+    assert [list(response) for response in responses] == [
+        ["id"],
+        ["id"],
+        ["fail"],
+    ]
+    chat = server.database.chats[uuid.UUID(server.database.default_chat_id)]
+    assert [message.text for message in chat.messages.values()] == [
+        f"from {user}" for user in users[:2]
+    ]
@@ -0,0 +1,58 @@
+import pytest
+
+from benchmarks import compare, harness
+
+
+def stats(p50: float, throughput: float) -> dict:
+    return dict(p50=p50, p95=p50, p99=p50, throughput=throughput)
+
+
+def test_percentile():
+    values = [float(value) for value in range(1, 101)]
+
+    assert harness.percentile(values, 0.5) == 50
+    assert harness.percentile(values, 0.99) == 99
+    assert harness.percentile(values, 1) == 100
+    assert harness.percentile([], 0.5) == 0
+
+
+def test_summarize():
+    summary = harness.summarize([0.3, 0.1, 0.2], elapsed=2)
+
+    assert summary["p50"] == 0.2
+    assert summary["max"] == 0.3
+    assert summary["throughput"] == 1.5
+    assert summary["mean"] == pytest.approx(0.2)
+
+
+def test_compare_flags_regressions():
+    baseline = {
+        "faster": stats(1.0, 100),
+        "slower": stats(1.0, 100),
+        "fewer ops": stats(1.0, 100),
+        "removed": stats(1.0, 100),
+    }
+    current = {
+        "faster": stats(0.5, 200),
+        "slower": stats(1.2, 100),
+        "fewer ops": stats(1.05, 80),
+        "added": stats(9.0, 1),
+    }
+
+    rows = compare.compare(baseline, current, threshold=0.1)
+
+    assert {(name, metric) for name, metric, *_ in rows} == {
+        ("slower", "p50"),
+        ("slower", "p95"),
+        ("slower", "p99"),
+        ("fewer ops", "throughput"),
+    }
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "results.json")
+    results = {"storage/get_user[1000]": stats(0.001, 1000)}
+
+    harness.save(path, results)
+
+    assert harness.load(path) == results
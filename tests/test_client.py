@@ -2,6 +2,7 @@ import json
 
 import pytest
 
+import protocol
 from client import ChatClient
 from db import User
 
@@ -20,7 +21,9 @@ async def test_connect(mocker):
 
     await client.signup()
 
-    patched_send.assert_called_once_with("POST /connect ")
+    patched_send.assert_called_once_with(
+        "POST /connect ", {protocol.IDEMPOTENCY_KEY: mocker.ANY}
+    )
 
 
 async def test_send(mocker):
@@ -33,7 +36,9 @@ async def test_send(mocker):
     body = json.dumps(
         dict(author_id=TEST_USER, chat_id=None, message=TEST_MESSAGE)
     )
-    patched_send.assert_called_once_with(f"POST /send {body}")
+    patched_send.assert_called_once_with(
+        f"POST /send {body}", {protocol.IDEMPOTENCY_KEY: mocker.ANY}
+    )
 
 
 async def test_send_chat(mocker):
@@ -45,7 +50,9 @@ async def test_send_chat(mocker):
     await client.post_send(chat_id=TEST_CHAT, message=TEST_MESSAGE)
 
     body = json.dumps(data)
-    patched_send.assert_called_once_with(f"POST /send {body}")
+    patched_send.assert_called_once_with(
+        f"POST /send {body}", {protocol.IDEMPOTENCY_KEY: mocker.ANY}
+    )
 
 
 async def test_get_status(mocker):
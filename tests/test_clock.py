@@ -0,0 +1,69 @@
+import asyncio
+import json
+import uuid
+from datetime import timedelta
+
+import pytest
+
+import utils
+from clock import Clock, MessageIds
+from db import Message
+from server import Server
+from settings import DEFAULT_MSG_LIMIT_PERIOD_HOURS
+
+
+def test_clock_does_not_go_back():
+    readings = iter([5_000_000_000, 3_000_000_000, 7_000_000_000])
+    clock = Clock(tz="Europe/Moscow", source=lambda: next(readings))
+
+    times = [clock.now() for _ in range(3)]
+
+    assert [time.timestamp() for time in times] == [5, 5, 7]
+    assert times[0].utcoffset() == timedelta(hours=3)
+
+
+def test_message_ids_grow_when_clock_stalls():
+    readings = iter([2_000_000_000] * 100 + [1_000_000_000] * 100)
+    ids = MessageIds(Clock(source=lambda: next(readings)))
+
+    minted = [ids() for _ in range(200)]
+
+    assert minted == sorted(minted)
+    assert len(set(minted)) == len(minted)
+    assert {pk.version for pk in minted} == {7}
+    assert minted[0].int >> 80 == 2000
+
+
+@pytest.mark.asyncio
+async def test_batched_messages_keep_send_order():
+    server = Server(send_batch_size=8, send_batch_delay_secs=0.001)
+    token = (await server.register({}))["token"]
+
+    await asyncio.gather(
+        *(
+            server.parse(
+                "POST", "/send", json.dumps(dict(author_id=token, message=text))
+            )
+            for text in map(str, range(5))
+        )
+    )
+
+    chat = server.database.chats[uuid.UUID(server.database.default_chat_id)]
+    messages = list(chat.history_before())
+    assert len({message.created for message in messages}) == 1
+    assert [message.text for message in messages] == ["4", "3", "2", "1", "0"]
+
+
+@pytest.mark.asyncio
+async def test_msg_limit_counts_recent_messages(mocker):
+    mocker.patch("server.DEFAULT_MSG_LIMIT", 2)
+    server = Server(msg_limit_enabled=True)
+    token = (await server.register({}))["token"]
+    chat = server.database.chats[uuid.UUID(server.database.default_chat_id)]
+    old = utils.now() - timedelta(hours=DEFAULT_MSG_LIMIT_PERIOD_HOURS + 1)
+    chat.add_message(Message(uuid.uuid4(), old, uuid.UUID(token), "old"))
+    body = json.dumps(dict(author_id=token, message="new"))
+
+    sent = [await server.parse("POST", "/send", body) for _ in range(3)]
+
+    assert [list(response) for response in sent] == [["id"], ["id"], ["fail"]]
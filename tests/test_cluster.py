@@ -0,0 +1,231 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+
+from client import ChatClient
+from cluster import ClusterServer, ConsistentHashRing, LocalMessageBus
+
+TEST_NODES = 3
+TEST_CHATS = 12
+TEST_MESSAGE = "test message"
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture(params=["local", "tcp"])
+def start_node(request, event_loop, unused_tcp_port_factory):
+    """Starts cluster nodes in pytest event loop, the first one seeds"""
+    bus = LocalMessageBus() if request.param == "local" else None
+    nodes, handles = [], []
+
+    async def start() -> ClusterServer:
+        node = ClusterServer(
+            port=unused_tcp_port_factory(),
+            cluster_port=unused_tcp_port_factory(),
+            seeds=[nodes[0].node] if nodes else [],
+            bus=bus,
+        )
+        handles.append(asyncio.ensure_future(node.startup()))
+        await asyncio.sleep(0.1)
+        nodes.append(node)
+        return node
+
+    yield start
+    for handle in handles:
+        handle.cancel()
+    event_loop.run_until_complete(asyncio.sleep(0.01))
+
+
+@pytest.fixture
+async def cluster(start_node):
+    nodes = [await start_node() for _ in range(TEST_NODES)]
+    clients = [ChatClient(server_port=node.port) for node in nodes]
+    for client in clients:
+        await client.signup()
+    return nodes, clients
+
+
+async def create_p2p_chats(clients: list[ChatClient]) -> list[str]:
+    chat_ids = []
+    for _ in range(TEST_CHATS):
+        other = ChatClient(server_port=clients[-1].port)
+        await other.signup()
+        response = await clients[0].post(
+            "/connect_p2p",
+            data=dict(user_id=clients[0].uuid, other_user_id=other.uuid),
+        )
+        chat_ids.append(json.loads(response)["chat_id"])
+    return chat_ids
+
+
+def assert_owned(nodes: list[ClusterServer], chat_ids: list[str]) -> None:
+    for chat_id in map(uuid.UUID, chat_ids):
+        holders = [node for node in nodes if chat_id in node.database.chats]
+        assert len(holders) == 1
+        assert holders[0].owner_of(chat_id) == holders[0].node
+
+
+async def test_ring_moves_only_removed_node_keys():
+    ring = ConsistentHashRing(["a:1", "b:1", "c:1"])
+    keys = [str(uuid.uuid4()) for _ in range(1000)]
+    owners = {key: ring.owner(key) for key in keys}
+
+    ring.remove("b:1")
+
+    assert set(owners.values()) == {"a:1", "b:1", "c:1"}
+    for key in keys:
+        if owners[key] != "b:1":
+            assert ring.owner(key) == owners[key]
+        assert ring.owner(key) != "b:1"
+
+
+async def test_members_agree(cluster):
+    nodes, _ = await cluster
+    default_chat_id = nodes[0].database.default_chat_id
+
+    for node in nodes:
+        assert node.ring.nodes == sorted(node.node for node in nodes)
+        assert node.database.default_chat_id == default_chat_id
+
+
+async def test_default_chat_replicated(cluster):
+    nodes, clients = await cluster
+    data = dict(author_id=clients[1].uuid, chat_id=None, message=TEST_MESSAGE)
+
+    await clients[1].post("/send", data=data)
+
+    for client in clients:
+        response = await client.get("/chats", data=dict(user_id=client.uuid))
+        default = json.loads(response)["chats"][0]
+        assert len(default["authors"]) == TEST_NODES
+        assert [msg["text"] for msg in default["messages"]] == [TEST_MESSAGE]
+
+
+async def test_chats_forwarded_to_owner(cluster):
+    nodes, clients = await cluster
+    chat_ids = await create_p2p_chats(clients)
+
+    assert_owned(nodes, chat_ids)
+    for chat_id in chat_ids:
+        data = dict(
+            author_id=clients[0].uuid, chat_id=chat_id, message=TEST_MESSAGE
+        )
+        response = await clients[1].post("/send", data=data)
+        assert "id" in json.loads(response)
+    response = await clients[2].get(
+        "/status", data=dict(user_id=clients[0].uuid)
+    )
+    assert json.loads(response)["chats_with_user_count"] == TEST_CHATS + 1
+
+
+async def test_inbox_gathered_from_owners(cluster):
+    nodes, clients = await cluster
+    chat_ids = await create_p2p_chats(clients)
+    for chat_id in [None, *chat_ids]:
+        data = dict(
+            author_id=clients[0].uuid, chat_id=chat_id, message=TEST_MESSAGE
+        )
+        await clients[1].post("/send", data=data)
+
+    received, before = [], None
+    while True:
+        data = dict(user_id=clients[0].uuid, msg_count=5, before=before)
+        page = json.loads(await clients[2].get("/inbox", data=data))
+        received.extend(page["messages"])
+        if (before := page["next"]) is None:
+            break
+
+    assert len({entry["id"] for entry in received}) == TEST_CHATS + 1
+    assert {entry["chat_id"] for entry in received} >= set(chat_ids)
+
+
+async def test_join_rebalances(cluster, start_node):
+    nodes, clients = await cluster
+    chat_ids = await create_p2p_chats(clients)
+
+    nodes.append(await start_node())
+
+    members = sorted(node.node for node in nodes)
+    assert all(node.ring.nodes == members for node in nodes)
+    assert_owned(nodes, chat_ids)
+    assert {uuid.UUID(client.uuid) for client in clients} <= set(
+        nodes[-1].database.users
+    )
+    response = await ChatClient(server_port=nodes[-1].port).get(
+        "/chats", data=dict(user_id=clients[0].uuid)
+    )
+    assert len(json.loads(response)["chats"]) == TEST_CHATS + 1
+
+
+async def test_leave_hands_chats_over(cluster):
+    nodes, clients = await cluster
+    chat_ids = await create_p2p_chats(clients)
+    leaving = nodes.pop()
+
+    leaving.sigint_handler()
+    await leaving.stopping
+    await asyncio.sleep(0.01)
+
+    assert leaving.serving.done()
+    members = sorted(node.node for node in nodes)
+    assert all(node.ring.nodes == members for node in nodes)
+    assert len(leaving.database.chats) == 1
+    assert_owned(nodes, chat_ids)
+    response = await clients[0].get(
+        "/chats", data=dict(user_id=clients[0].uuid)
+    )
+    assert len(json.loads(response)["chats"]) == TEST_CHATS + 1
+
+
+async def test_handoff_keeps_chats_until_released(cluster):
+    nodes, clients = await cluster
+    chat_ids = await create_p2p_chats(clients)
+    node = max(nodes, key=lambda node: len(node.database.chats))
+    chat_id = next(pk for pk in chat_ids if uuid.UUID(pk) in node.database.chats)
+    # an address that takes the chat over once it is on the ring
+    taker = next(
+        address
+        for address in (f"127.0.0.1:{port}" for port in range(1, 10000))
+        if ConsistentHashRing([*node.ring.nodes, address]).owner(chat_id)
+        == address
+    )
+    body = json.dumps(dict(node=taker))
+    held = len(node.database.chats)
+
+    streamed = await node.parse("POST", "/_internal/handoff", body)
+
+    moved = [str(record["chat"]["id"]) for record in streamed.items]
+    assert chat_id in moved and set(moved) <= set(chat_ids)
+    assert len(node.database.chats) == held
+    await node.parse("POST", "/_internal/release", body)
+    assert len(node.database.chats) == held - len(moved)
+
+
+async def test_joined_node_answers_like_members(cluster, start_node, mocker):
+    nodes, clients = await cluster
+    await create_p2p_chats(clients)
+    late = ChatClient(server_port=nodes[0].port)
+    take_over = ClusterServer.take_over
+
+    async def write_meanwhile(self, node: str) -> int:
+        # the joining node learns of this only from the catch up snapshot
+        if late.uuid is None:
+            await late.signup()
+            data = dict(author_id=late.uuid, chat_id=None, message="late")
+            await late.post("/send", data=data)
+        return await take_over(self, node)
+
+    mocker.patch.object(ClusterServer, "take_over", write_meanwhile)
+    joined = ChatClient(server_port=(await start_node()).port)
+
+    for client in [clients[0], late]:
+        for url in ["/status", "/inbox"]:
+            data = dict(user_id=client.uuid)
+            expected = json.loads(await client.get(url, data=data))
+            response = json.loads(await joined.get(url, data=data))
+            for volatile in ["time", "online_count"]:
+                expected.pop(volatile, None)
+                response.pop(volatile, None)
+            assert response == expected
@@ -0,0 +1,55 @@
+import zlib
+
+import pytest
+
+import compression
+
+TEST_PAYLOAD = b'{"text": "test message"}' * 1000
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    [
+        (None, compression.IDENTITY),
+        ("", compression.IDENTITY),
+        ("br", compression.IDENTITY),
+        ("deflate", compression.DEFLATE),
+        ("zlib", compression.DEFLATE),
+        ("br, gzip;q=0.9, deflate;q=0.5", compression.DEFLATE),
+    ],
+)
+def test_negotiate(accept_encoding, expected):
+    assert compression.negotiate(accept_encoding) == expected
+
+
+@pytest.mark.parametrize("encoding", compression.available_encodings())
+def test_compress_stream_roundtrip(encoding):
+    chunks = compression.split(TEST_PAYLOAD, 100)
+
+    compressed = list(compression.compress_stream(chunks, encoding))
+
+    codec = compression.decompressor(encoding)
+    data = b"".join(codec.decompress(chunk) for chunk in compressed)
+    assert data + codec.flush() == TEST_PAYLOAD
+    assert sum(map(len, compressed)) < len(TEST_PAYLOAD)
+
+
+def test_compress_stream_identity():
+    chunks = compression.split(TEST_PAYLOAD, 100)
+
+    data = b"".join(compression.compress_stream(chunks, compression.IDENTITY))
+
+    assert data == TEST_PAYLOAD
+
+
+def test_deflate_is_zlib_compatible():
+    chunks = compression.split(TEST_PAYLOAD, 100)
+
+    data = b"".join(compression.compress_stream(chunks, compression.DEFLATE))
+
+    assert zlib.decompress(data) == TEST_PAYLOAD
+
+
+def test_unsupported_encoding():
+    with pytest.raises(ValueError):
+        compression.compressor("br")
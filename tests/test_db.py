@@ -1,9 +1,12 @@
 import asyncio
 import uuid
+from collections import deque
 
 import pytest
 
-from db import ChatStorageCursor, NotConnectedError
+from db import Chat, ChatStorage, ChatStorageCursor, NotConnectedError, User
+
+from .factories import MessageFactory
 
 pytestmark = pytest.mark.asyncio
 
@@ -80,3 +83,163 @@ async def test_message_not_connected(create_storage):
     db, *_ = await create_storage
     with pytest.raises(NotConnectedError):
         ChatStorageCursor(db).get_message()
+
+
+def keys_of_distinct_shards(db: ChatStorage) -> tuple[uuid.UUID, uuid.UUID]:
+    first = uuid.uuid4()
+    other = uuid.uuid4()
+    while db.shard_index(other) == db.shard_index(first):
+        other = uuid.uuid4()
+    return first, other
+
+
+async def test_storage_sharded(create_storage):
+    db, chats, *_ = await create_storage
+
+    assert len(db.chats) == len(chats)
+    for chat in chats:
+        shard = db.shards[db.shard_index(chat.id)]
+        assert shard.chats[chat.id] is chat
+
+
+async def test_independent_shards_in_parallel():
+    db = ChatStorage(max_connections=0, shards=4)
+    first, other = keys_of_distinct_shards(db)
+
+    cursor = await db.connect(first)
+    other_cursor = await asyncio.wait_for(db.connect(other), timeout=0.1)
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(db.connect(first), timeout=0.1)
+
+    assert db.connections == {id(cursor), id(other_cursor)}
+
+
+async def test_shards_acquired_in_order():
+    db = ChatStorage(shards=4)
+    first, other = keys_of_distinct_shards(db)
+
+    cursor = await db.connect(other, first)
+
+    assert cursor.shards == tuple(
+        sorted({db.shard_index(first), db.shard_index(other)})
+    )
+    assert db.cursors[id(cursor)] == cursor.shards
+
+
+async def test_cursor_routes_to_held_shards():
+    db = ChatStorage(shards=4)
+    cursor = await db.connect()
+    chat_id = cursor.create_chat(name="")
+    other = uuid.uuid4()
+    while db.shard_index(other) == db.shard_index(chat_id):
+        other = uuid.uuid4()
+    cursor.disconnect()
+
+    cursor = await db.connect(chat_id)
+
+    assert cursor.get_chat(chat_id).id == uuid.UUID(chat_id)
+    assert db.shard_index(cursor.create_user()) == db.shard_index(chat_id)
+    with pytest.raises(NotConnectedError):
+        cursor.get_user(str(other))
+
+
+async def test_unknown_key_acquires_all_shards():
+    db = ChatStorage(shards=4)
+
+    cursor = await db.connect(uuid.uuid4(), None)
+
+    assert cursor.shards == (0, 1, 2, 3)
+
+
+async def test_chat_changes_since_version():
+    chat = Chat(id=uuid.uuid4(), name="")
+    leaving, staying = User(uuid.uuid4()), User(uuid.uuid4())
+    chat.enter(leaving)
+    etag = chat.etag
+    messages = MessageFactory.create_batch(2)
+
+    for message in messages:
+        chat.add_message(message)
+    chat.enter(staying)
+    chat.leave(leaving)
+    delta = chat.serialize_since(etag)
+
+    assert delta["delta"]
+    assert delta["version"] == chat.etag != etag
+    assert set(delta["messages"]) == set(messages)
+    assert delta["entered"] == [staying.id]
+    assert delta["left"] == [leaving.id]
+    assert chat.serialize_since(chat.etag)["not_modified"]
+
+
+@pytest.mark.parametrize(
+    "etag",
+    [None, "other-0", "{incarnation}-junk", "{incarnation}-0"],
+)
+async def test_chat_serialized_in_full(etag):
+    chat = Chat(id=uuid.uuid4(), name="", changes=deque(maxlen=2))
+    etag = etag and etag.format(incarnation=chat.incarnation)
+
+    for message in MessageFactory.create_batch(3):
+        chat.add_message(message)
+
+    history = chat.serialize_since(etag, count=10)
+    assert len(history["messages"]) == 3
+    assert "delta" not in history
+    assert history["version"] == chat.etag
+
+
+async def test_chat_serialized_in_full_beyond_count():
+    chat = Chat(id=uuid.uuid4(), name="")
+    etag = chat.etag
+
+    for message in MessageFactory.create_batch(3):
+        chat.add_message(message)
+
+    assert "delta" not in chat.serialize_since(etag, count=2)
+    assert chat.serialize_since(etag, count=3)["delta"]
+
+
+async def test_invalidated_chat_serialized_in_full():
+    chat = Chat(id=uuid.uuid4(), name="")
+    etag = chat.etag
+
+    chat.invalidate()
+
+    assert "not_modified" not in chat.serialize_since(etag)
+
+
+async def test_counters_follow_chats_and_users():
+    db = ChatStorage()
+    cursor = await db.connect()
+    user = cursor.get_user(cursor.create_user())
+    other = cursor.get_user(cursor.create_user())
+    chat = cursor.get_chat(cursor.create_chat(name=""))
+    p2p_chat_id = cursor.create_p2p_chat(name="p2p")
+
+    chat.enter(user)
+    chat.enter(other)
+    cursor.get_chat(p2p_chat_id).enter(user)
+    chat.leave(other)
+    cursor.delete_chat(p2p_chat_id)
+
+    assert cursor.count_chats() == 1
+    assert cursor.count_chats_with_user(str(user.id)) == 1
+    assert cursor.count_chats_with_user(str(other.id)) == 0
+    assert db.counters.user_chats == {user.id: {chat.id}}
+
+
+async def test_counters_follow_bans():
+    db = ChatStorage()
+    cursor = await db.connect()
+    user = cursor.get_user(cursor.create_user())
+
+    user.is_banned = True
+    user.is_banned = True
+    cursor.add_user(User(id=uuid.uuid4(), is_banned=True))
+
+    assert cursor.count_banned_users() == 2
+    db.users = {}
+    assert cursor.count_banned_users() == 0
+    user.is_banned = False
+    assert cursor.count_banned_users() == 0
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from server import (
+    BODY,
+    ERROR_BODY_TOO_LARGE,
+    ERROR_NOT_SUPPORTED,
+    HEADER,
+    IDLE,
+    Server,
+)
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def server_kwargs():
+    """Short connection deadlines"""
+    return dict(
+        keepalive_timeout_secs=0.1,
+        header_timeout_secs=0.1,
+        body_timeout_secs=0.1,
+        max_body_size=64,
+        max_connections=2,
+    )
+
+
+async def closed_after(server: Server, data: bytes) -> bytes:
+    reader, writer = await asyncio.open_connection(
+        server.host, server.port
+    )
+    writer.write(data)
+    response = await asyncio.wait_for(reader.read(), 1)
+    writer.close()
+    return response
+
+
+async def test_idle_connection_parked_without_task(server):
+    reader, writer = await asyncio.open_connection(
+        server.host, server.port
+    )
+    await asyncio.sleep(0.01)
+
+    assert len(server.connection_writers) == 1
+    assert not server.connection_tasks
+    assert await asyncio.wait_for(reader.read(), 1) == b""
+    assert server.metrics.timeouts.get((IDLE,)) == 1
+    assert server.metrics.connections.get() == 0
+    writer.close()
+
+
+async def test_slow_headers_closed(server):
+    assert await closed_after(server, b"GET /status\r\nconte") == b""
+    assert server.metrics.timeouts.get((HEADER,)) == 1
+
+
+async def test_slow_body_closed(server):
+    data = b"POST /connect\r\ncontent-length: 10\r\n\r\n{}"
+
+    assert await closed_after(server, data) == b""
+    assert server.metrics.timeouts.get((BODY,)) == 1
+
+
+@pytest.mark.parametrize(
+    "length, error",
+    [(b"65", ERROR_BODY_TOO_LARGE), (b"-1", ERROR_NOT_SUPPORTED)],
+)
+async def test_bad_body_length_answered(server, length, error):
+    data = b"POST /connect\r\ncontent-length: %s\r\n\r\n" % length
+
+    assert error.encode() in await closed_after(server, data)
+
+
+async def test_connections_capped(server):
+    writers = []
+    for _ in range(2):
+        _, writer = await asyncio.open_connection(server.host, server.port)
+        writers.append(writer)
+    await asyncio.sleep(0.01)
+
+    assert await closed_after(server, b"") == b""
+    assert server.metrics.refused.get() == 1
+    for writer in writers:
+        writer.close()
@@ -0,0 +1,91 @@
+import asyncio
+import json
+
+import pytest
+
+from client import AsyncClient
+from idempotency import IdempotencyCache
+
+pytestmark = pytest.mark.asyncio
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def counting_call(calls: list, response: dict):
+    async def call() -> dict:
+        calls.append(1)
+        await asyncio.sleep(0)
+        return response
+
+    return call
+
+
+async def test_key_runs_once():
+    cache = IdempotencyCache()
+    calls = []
+    call = counting_call(calls, {"id": 1})
+
+    responses = await asyncio.gather(
+        *(cache.run("key", call) for _ in range(3))
+    )
+
+    assert responses == [{"id": 1}] * 3
+    assert len(calls) == 1
+    assert cache.hits == 2
+
+
+async def test_failures_not_kept():
+    async def raising() -> dict:
+        raise ValueError
+
+    cache = IdempotencyCache()
+    calls = []
+
+    await cache.run("key", counting_call(calls, {"fail": "error"}))
+    await cache.run("key", counting_call(calls, {"fail": "error"}))
+    with pytest.raises(ValueError):
+        await cache.run("raising", raising)
+
+    assert len(calls) == 2
+    assert len(cache) == 0
+
+
+async def test_keys_expire_and_are_bounded():
+    clock = Clock()
+    cache = IdempotencyCache(max_entries=2, ttl_secs=10, clock=clock)
+    calls = []
+    call = counting_call(calls, {})
+
+    for key in ("a", "b", "c"):
+        await cache.run(key, call)
+    assert list(cache.entries) == ["b", "c"]
+    clock.now = 10
+    await cache.run("b", call)
+
+    assert len(calls) == 4
+    assert list(cache.entries) == ["b"]
+
+
+async def test_retried_posts_deduplicated(server):
+    client = AsyncClient(server_port=server.port)
+    token = json.loads(await client.post("/connect", idempotency_key="u"))
+    again = json.loads(await client.post("/connect", idempotency_key="u"))
+    data = dict(author_id=token["token"], message="once")
+
+    sent = [
+        json.loads(await client.post("/send", data=data, idempotency_key="m"))
+        for _ in range(2)
+    ]
+
+    assert token == again
+    assert len(server.database.users) == 1
+    assert sent[0] == sent[1]
+    chat = server.database.chats[next(iter(server.database.chats))]
+    assert [message.text for message in chat.messages.values()] == ["once"]
+    await client.close()
@@ -0,0 +1,88 @@
+import json
+import random
+import uuid
+from datetime import timedelta
+
+import pytest
+
+import utils
+from db import Chat, Message
+from server import Server
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_timeline_ordered_and_compacted():
+    chat = Chat(id=uuid.uuid4(), name="")
+    now = utils.now()
+    messages = [
+        Message(uuid.uuid4(), now + timedelta(seconds=delay), uuid.uuid4(), "")
+        for delay in random.sample(range(100), 100)
+    ]
+    for message in messages:
+        chat.add_message(message)
+    for message in messages[:60]:
+        chat.delete_message(message.id)
+
+    newest = sorted(messages[60:], key=lambda obj: obj.created, reverse=True)
+    assert list(chat.history_before()) == newest
+    assert list(chat.history_before((newest[9].created, newest[9].id))) == (
+        newest[10:]
+    )
+    assert chat.newest(5) == newest[:5]
+    assert len(chat.timeline) < len(messages)
+
+
+async def test_inbox_pages_merge_chats(event_loop):
+    server = Server()
+    token = (await server.register({}))["token"]
+    other = (await server.register({}))["token"]
+    p2p = await server.parse(
+        "POST",
+        "/connect_p2p",
+        json.dumps(dict(user_id=token, other_user_id=other)),
+    )
+    sent = []
+    for number in range(25):
+        chat_id = p2p["chat_id"] if number % 3 else None
+        response = await server.parse(
+            "POST",
+            "/send",
+            json.dumps(dict(author_id=other, chat_id=chat_id, message="")),
+        )
+        sent.append(response["id"])
+
+    received, before = [], None
+    while True:
+        page = await server.parse(
+            "GET",
+            "/inbox",
+            json.dumps(dict(user_id=token, msg_count=10, before=before)),
+        )
+        received.extend(page["messages"])
+        if (before := page["next"]) is None:
+            break
+
+    stored = {
+        message.id: message
+        for chat in server.database.chats.values()
+        for message in chat.messages.values()
+    }
+    assert [entry["id"] for entry in received] == sorted(
+        sent, key=lambda pk: (stored[pk].created, pk), reverse=True
+    )
+    assert {entry["chat_id"] for entry in received} == {
+        uuid.UUID(p2p["chat_id"]),
+        uuid.UUID(server.database.default_chat_id),
+    }
+
+
+async def test_inbox_cursor_validated(event_loop):
+    server = Server()
+    token = (await server.register({}))["token"]
+
+    response = await server.parse(
+        "GET", "/inbox", json.dumps(dict(user_id=token, before="yesterday"))
+    )
+
+    assert response == {"fail": "Inbox cursor is not valid"}
@@ -1,10 +1,14 @@
 import asyncio
 import json
 import uuid
+from datetime import timedelta
 
 import pytest
 
+import compression
+import utils
 from client import ChatClient
+from db import Chat
 from server import Server
 from settings import DEFAULT_MAX_COMPLAINT_COUNT
 
@@ -190,6 +194,46 @@ async def test_get_chats_single(create_p2p):
     assert client_other.uuid in chat["authors"]
 
 
+async def test_history_cache(create_p2p, mocker):
+    client, client_other, server, chat_id = await create_p2p
+    await client.post_send(chat_id=chat_id, message=TEST_MESSAGE)
+    history = await client.get_history(chat_id)
+    serialize = mocker.spy(Chat, "serialize")
+
+    await client_other.post_send(chat_id=chat_id, message="second")
+    updated = await client.get_history(chat_id)
+    unchanged = await client.get_history(chat_id)
+
+    serialize.assert_not_called()
+    assert updated["version"] != history["version"]
+    assert [message["text"] for message in updated["messages"]] == [
+        "second",
+        TEST_MESSAGE,
+    ]
+    assert unchanged == updated
+    response = await client.get(
+        "/chats", data=dict(user_id=client.uuid, chat_id=chat_id)
+    )
+    full = json.loads(response)["history"]
+    assert full["messages"] == updated["messages"]
+    assert full["version"] == updated["version"]
+
+
+async def test_chats_cache(create_p2p):
+    client, client_other, server, chat_id = await create_p2p
+    chats = await client.get_chats()
+
+    await client_other.post_send(chat_id=chat_id, message=TEST_MESSAGE)
+    await client_other.post(
+        "/chats/exit", data=dict(user_id=client_other.uuid, chat_id=chat_id)
+    )
+    updated = {chat["id"]: chat for chat in await client.get_chats()}
+
+    assert updated.keys() == {chat["id"] for chat in chats}
+    assert updated[chat_id]["authors"] == [client.uuid]
+    assert updated[chat_id]["messages"][0]["text"] == TEST_MESSAGE
+
+
 async def test_sequence(create_p2p):
     client, client_other, server, chat_id = await create_p2p
     data_default = dict(
@@ -360,3 +404,66 @@ async def test_leave(create_p2p):
 
     response_json = json.loads(response)
     assert response_json == {}
+
+
+async def test_get_chats_compressed(server, mocker):
+    """Large histories are delivered whole when compression is negotiated"""
+    spy = mocker.spy(compression, "compress_stream")
+    client = ChatClient(
+        server_port=server.port, limit=1024, encodings=["deflate"]
+    )
+    await client.signup()
+    data_default = dict(author_id=client.uuid, chat_id=None, message="x" * 100)
+    [await client.post("/send", data=data_default) for _ in range(50)]
+
+    response = await client.get(
+        "/chats", data=dict(user_id=client.uuid, msg_count=100)
+    )
+    response_json = json.loads(response)
+
+    assert len(response.encode()) > server.compression_threshold
+    assert spy.call_args.args[1] == compression.DEFLATE
+    assert len(response_json["chats"][0]["messages"]) == 50
+
+
+async def test_get_chats_streamed(server):
+    """Responses larger than the client read limit are reassembled"""
+    client = ChatClient(server_port=server.port, limit=256)
+    await client.signup()
+    data_default = dict(author_id=client.uuid, chat_id=None, message="x" * 100)
+    [await client.post("/send", data=data_default) for _ in range(30)]
+
+    chunks = [
+        chunk
+        async for chunk in client.stream(
+            f"GET /chats {json.dumps(dict(user_id=client.uuid, msg_count=30))}"
+        )
+    ]
+    response_json = json.loads("".join(chunks))
+
+    assert len(response_json["chats"][0]["messages"]) == 30
+
+
+async def test_ttl_send_and_cached_history(create_p2p):
+    client, client_other, server, chat_id = await create_p2p
+    await client.post_send(chat_id=chat_id, message="stays")
+    await client_other.post_send(chat_id=chat_id, message="gone", ttl=1)
+    history = await client.get_history(chat_id)
+    response = await client.post(
+        "/send", data=dict(author_id=client.uuid, chat_id=chat_id, ttl=-1)
+    )
+
+    server.database.retention.expire(
+        await server.database.connect(),
+        utils.now() + timedelta(seconds=3),
+        budget_secs=1,
+    )
+    updated = await client.get_history(chat_id)
+
+    assert "Field ttl is not valid" in response
+    assert [message["text"] for message in history["messages"]] == [
+        "gone",
+        "stays",
+    ]
+    assert [message["text"] for message in updated["messages"]] == ["stays"]
+    assert server.database.chats[uuid.UUID(chat_id)].size == 2
@@ -0,0 +1,56 @@
+import pytest
+
+from benchmarks import loadgen
+
+SCENARIOS = "benchmarks/scenarios"
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_corrected_backfills_held_back_requests():
+    assert list(loadgen.corrected(0.05, 0.1)) == [0.05]
+    assert list(loadgen.corrected(0.35, 0.1)) == pytest.approx(
+        [0.35, 0.25, 0.15]
+    )
+    assert list(loadgen.corrected(0.35, 0)) == [0.35]
+
+
+async def test_load_weighted_mix():
+    scenarios = loadgen.load_scenarios(f"{SCENARIOS}/production.json")
+
+    assert {scenario.name: scenario.weight for scenario in scenarios} == {
+        "chatter": 6,
+        "p2p": 3,
+        "moderation": 1,
+    }
+    assert all(
+        step.action in loadgen.ACTIONS
+        for scenario in scenarios
+        for step in scenario.steps
+    )
+
+
+async def test_unknown_action(tmp_path):
+    path = tmp_path / "bad.json"
+    path.write_text('{"name": "bad", "steps": [{"action": "dance"}]}')
+
+    with pytest.raises(ValueError):
+        loadgen.load_scenarios(str(path))
+
+
+@pytest.mark.parametrize("mode", ["closed", "open"])
+async def test_run_against_server(server, mode):
+    scenarios = loadgen.load_scenarios(f"{SCENARIOS}/p2p.json")
+    for step in scenarios[0].steps:
+        step.think_ms = 0
+
+    recorder, elapsed = await loadgen.run(
+        scenarios, server.port, mode=mode, duration=0.5, users=4, rate=20
+    )
+
+    assert recorder.sessions > 0
+    assert sum(recorder.errors.values()) == 0
+    assert len(server.database.users) >= recorder.sessions
+    results = recorder.results("p2p", elapsed)
+    assert results["loadgen/p2p/signup"]["count"] >= recorder.sessions
+    assert "loadgen/p2p/send (uncorrected)" in results
@@ -0,0 +1,92 @@
+import json
+import logging
+import queue
+
+import pytest
+
+import logs
+
+
+class Payload:
+    """Counts how many times it was rendered into a message"""
+
+    renders = 0
+
+    def __str__(self) -> str:
+        Payload.renders += 1
+        return "payload"
+
+
+@pytest.fixture
+def root_logger():
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    Payload.renders = 0
+    yield root
+    logs.stop_listener()
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+
+def test_parse_sample_rates():
+    assert logs.parse_sample_rates("server=100, db=10,") == {
+        "server": 100,
+        "db": 10,
+    }
+
+
+def test_sampling_filter():
+    sampling = logs.SamplingFilter({"server": 3})
+
+    def passed(name: str, level: int) -> int:
+        record = logging.LogRecord(name, level, "", 0, "msg", (), None)
+        return sum(sampling.filter(record) for _ in range(9))
+
+    assert passed("server", logging.INFO) == 3
+    assert passed("server.db", logging.DEBUG) == 3
+    assert passed("server", logging.WARNING) == 9
+    assert passed("client", logging.INFO) == 9
+
+
+def test_queue_handler_does_not_format(root_logger):
+    records = queue.SimpleQueue()
+    handler = logs.LazyQueueHandler(records)
+    payload = Payload()
+
+    handler.handle(
+        logging.LogRecord("test", logging.INFO, "", 0, "%s", (payload,), None)
+    )
+
+    assert Payload.renders == 0
+    assert records.get_nowait().args == (payload,)
+
+
+def test_queued_records_formatted_by_listener(root_logger, capsys):
+    logs.setup_logging("INFO", queued=True, sample_rates="test.sampled=2")
+    logger = logging.getLogger("test")
+    sampled = logging.getLogger("test.sampled")
+
+    logger.debug("skipped %s", Payload())
+    for _ in range(4):
+        sampled.info("sampled %s", Payload())
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        logger.exception("failed %s", Payload())
+    logs.stop_listener()
+
+    lines = capsys.readouterr().err.splitlines()
+    assert Payload.renders == 3
+    assert sum("sampled payload" in line for line in lines) == 2
+    assert any("ValueError: boom" in line for line in lines)
+
+
+def test_json_output(root_logger, capsys):
+    logs.setup_logging("INFO", queued=False, json_output=True)
+
+    logging.getLogger("test").warning("value %d", 42)
+
+    record = json.loads(capsys.readouterr().err)
+    assert record["level"] == "WARNING"
+    assert record["logger"] == "test"
+    assert record["message"] == "value 42"
@@ -0,0 +1,81 @@
+import pytest
+
+import metrics
+from client import ChatClient
+
+
+@pytest.fixture
+def server_kwargs():
+    return dict(loop_lag_interval_secs=0.01)
+
+
+def test_log_linear_bounds():
+    bounds = metrics.log_linear_bounds(0, 2, sub_count=4)
+
+    assert bounds == (1, 1.25, 1.5, 1.75, 2, 2.5, 3, 3.5, 4)
+
+
+def test_histogram_quantile():
+    histogram = metrics.Histogram("test", "test", ("route",))
+    for value in range(1, 101):
+        histogram.observe(value / 1000, ("/send",))
+
+    assert histogram.count(("/send",)) == 100
+    assert 0.05 <= histogram.quantile(0.5, ("/send",)) < 0.0625
+    assert 0.099 <= histogram.quantile(0.99, ("/send",)) < 0.125
+    assert histogram.quantile(0.5, ("/chats",)) == 0
+
+
+def test_render_prometheus_text():
+    registry = metrics.Registry()
+    counter = registry.counter("errors_total", "Errors", ("error",))
+    histogram = registry.histogram(
+        "latency_seconds", "Latency", bounds=(0.1, 1.0)
+    )
+    counter.inc(('Not "found"',))
+    histogram.observe(0.5)
+    histogram.observe(2)
+
+    assert registry.render().splitlines() == [
+        "# HELP errors_total Errors",
+        "# TYPE errors_total counter",
+        'errors_total{error="Not \\"found\\""} 1',
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="1.0"} 1',
+        'latency_seconds_bucket{le="+Inf"} 2',
+        "latency_seconds_sum 2.5",
+        "latency_seconds_count 2",
+    ]
+
+
+def test_unknown_routes_share_label():
+    server_metrics = metrics.ServerMetrics(["/send"])
+
+    for url in ("/a", "/b", "/send"):
+        server_metrics.observe_request(url, "GET", 0)
+
+    assert set(server_metrics.latency.values) == {
+        ("unknown", "GET"),
+        ("/send", "GET"),
+    }
+
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(server):
+    client = ChatClient(server_port=server.port)
+    await client.signup()
+    await client.get("/status", data=dict(user_id="not uuid"))
+
+    text = await client.get("/metrics")
+
+    assert (
+        'yachat_request_duration_seconds_count{route="/connect",'
+        'method="POST"} 1'
+    ) in text
+    assert (
+        'yachat_request_errors_total{route="/status",error="ValidationError"} 1'
+    ) in text
+    assert 'yachat_db_cursor_wait_seconds_count{user="server"}' in text
+    assert "yachat_connections_in_flight 1" in text
+    assert "yachat_event_loop_lag_seconds_count" in text
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import pickle
+import uuid
+
+import pytest
+
+import utils
+from db import ChatStorage, Message
+from offload import Offloader, count_items, freeze, thaw
+from server import Server
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def server_kwargs():
+    return dict(offload_workers=1)
+
+
+def message(text: str) -> Message:
+    return Message(uuid.uuid4(), utils.now(), uuid.uuid4(), text)
+
+
+async def test_heavy_responses_counted_up_to_threshold():
+    offloader = Offloader(workers=1, threshold=100)
+    chats = {"chats": [{"messages": [message("")] * 60} for _ in range(2)]}
+
+    assert count_items(chats, 1000) == 122
+    assert offloader.is_heavy(chats)
+    assert not offloader.is_heavy({"history": {"messages": [message("")]}})
+    assert offloader.is_heavy(utils.JsonLines([{}] * 100))
+    assert not offloader.is_heavy(utils.JsonLines({} for _ in range(100)))
+    assert not offloader.is_heavy("x" * 1000)
+
+
+async def test_frozen_response_thaws_into_same_response():
+    db = ChatStorage()
+    cursor = await db.connect()
+    user = cursor.get_user(cursor.create_user())
+    history = {
+        "id": uuid.uuid4(),
+        "messages": [message(str(number)) for number in range(1000)],
+        "authors": {user.id},
+    }
+    records = [{"user": user}] * 300
+
+    frozen = await freeze({"history": history, "records": records})
+    thawed = thaw(pickle.loads(pickle.dumps(frozen)))
+
+    assert thawed["history"] == dict(history, authors=[user.id])
+    assert thawed["records"] == records
+    assert thawed["records"][0]["user"].counters is None
+    assert user.counters is db.counters
+
+
+async def test_heavy_response_encoded_by_worker():
+    server = Server(offload_workers=1, offload_threshold=100)
+    chats = {"chats": [{"messages": [message(str(n)) for n in range(150)]}]}
+
+    try:
+        chunks = await server.encode_response(chats)
+    finally:
+        await server.offloader.shutdown()
+
+    assert isinstance(chunks, list)
+    assert b"".join(chunks) == utils.serialize(chats).encode()
+    assert server.metrics.offload_queue.get() == 0
+    assert "yachat_offload_duration_seconds_count 1" in (
+        server.metrics.render()
+    )
+
+
+async def test_pool_lives_as_long_as_server(server):
+    await asyncio.sleep(0)
+    pool = server.offloader.pool
+
+    worker = await server.offloader.run(os.getpid)
+    await server.stop()
+    await asyncio.sleep(0.01)
+
+    assert pool is not None and worker != os.getpid()
+    assert server.offloader.pool is None
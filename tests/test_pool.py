@@ -0,0 +1,158 @@
+import asyncio
+import json
+
+import pytest
+
+import protocol
+from client import AsyncClient
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def fake_server(event_loop, unused_tcp_port):
+    """Serves connections with a test handler instead of the chat server"""
+    servers = []
+
+    async def start(handler) -> int:
+        servers.append(
+            await asyncio.start_server(handler, "127.0.0.1", unused_tcp_port)
+        )
+        return unused_tcp_port
+
+    yield start
+    for server in servers:
+        server.close()
+    event_loop.run_until_complete(asyncio.sleep(0.01))
+
+
+async def answer(writer: asyncio.StreamWriter, keep_alive: bool) -> None:
+    headers = {protocol.TRANSFER_ENCODING: protocol.CHUNKED}
+    if keep_alive:
+        headers[protocol.CONNECTION] = protocol.KEEP_ALIVE
+    writer.write(protocol.encode_headers(headers))
+    writer.writelines(protocol.encode_chunk(b'{"ok": true}'))
+    writer.write(protocol.LAST_CHUNK)
+    await writer.drain()
+
+
+async def test_connection_reused(server):
+    client = AsyncClient(server_port=server.port)
+
+    for _ in range(3):
+        await client.post("/connect")
+
+    assert client.stats.connects == 1
+    assert client.stats.hits == 2
+    assert len(server.database.users) == 3
+    await client.close()
+
+
+async def test_concurrency_limited(server):
+    client = AsyncClient(server_port=server.port, pool_size=2)
+
+    responses = await asyncio.gather(
+        *(client.post("/connect") for _ in range(6))
+    )
+
+    assert all("token" in json.loads(response) for response in responses)
+    assert client.stats.connects == 2
+    assert client.stats.waits > 0
+    await client.close()
+
+
+async def test_idle_connection_evicted(server):
+    client = AsyncClient(server_port=server.port, pool_idle_secs=0.05)
+
+    await client.post("/connect")
+    await asyncio.sleep(0.1)
+    await client.post("/connect")
+
+    assert client.stats.evictions == 1
+    assert client.stats.connects == 2
+    await client.close()
+
+
+async def test_no_reuse_without_idle_timeout(server):
+    client = AsyncClient(server_port=server.port, pool_idle_secs=0)
+
+    await client.post("/connect")
+    await client.post("/connect")
+
+    assert client.stats.connects == 2
+    assert client.stats.hits == 0
+
+
+async def test_stale_connection_reconnected(fake_server):
+    async def close_after_one(reader, writer):
+        await protocol.read_request(reader)
+        await answer(writer, keep_alive=True)
+        await protocol.read_request(reader)
+        writer.close()
+
+    port = await fake_server(close_after_one)
+    client = AsyncClient(server_port=port)
+
+    await client.post("/send")
+    response = await client.post("/send")
+
+    assert json.loads(response) == {"ok": True}
+    assert client.stats.reconnects == 1
+    await client.close()
+
+
+async def test_get_retried(fake_server):
+    connections = []
+
+    async def drop_first(reader, writer):
+        connections.append(writer)
+        await protocol.read_request(reader)
+        if len(connections) > 1:
+            await answer(writer, keep_alive=False)
+        writer.close()
+
+    port = await fake_server(drop_first)
+    client = AsyncClient(server_port=port, backoff_secs=0.01)
+
+    response = await client.get("/status")
+
+    assert json.loads(response) == {"ok": True}
+    assert client.stats.retries == 1
+    connections.clear()
+    with pytest.raises(EOFError):
+        await client.post("/send")
+
+
+async def test_deadline(fake_server):
+    async def never_answer(reader, writer):
+        await protocol.read_request(reader)
+        await reader.read()
+
+    port = await fake_server(never_answer)
+    client = AsyncClient(server_port=port, timeout=0.1)
+
+    with pytest.raises(asyncio.TimeoutError):
+        await client.get("/status")
+
+    assert client.stats.timeouts == 1
+    assert client.stats.retries == 0
+
+
+async def test_keyed_post_retried(fake_server):
+    requests = []
+
+    async def drop_first(reader, writer):
+        requests.append(await protocol.read_request(reader))
+        if len(requests) > 1:
+            await answer(writer, keep_alive=False)
+        writer.close()
+
+    port = await fake_server(drop_first)
+    client = AsyncClient(server_port=port, backoff_secs=0.01)
+
+    response = await client.post("/send", idempotency_key="key")
+
+    assert json.loads(response) == {"ok": True}
+    assert [
+        request.headers[protocol.IDEMPOTENCY_KEY] for request in requests
+    ] == ["key", "key"]
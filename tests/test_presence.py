@@ -0,0 +1,70 @@
+import json
+import random
+
+import pytest
+
+from db import ChatStorage
+from presence import Presence, TimingWheel
+from server import Server
+
+pytestmark = pytest.mark.asyncio
+
+
+async def test_wheel_releases_keys_at_due_tick():
+    wheel = TimingWheel(tick_secs=1, slots=4, levels=3)
+    due = {key: random.randint(1, 100) for key in range(200)}
+    for key, when in due.items():
+        wheel.schedule(key, when)
+    wheel.schedule(0, 150)
+    due[0] = 150
+    wheel.cancel(1)
+    del due[1]
+
+    released = {}
+    for now in range(1, 160):
+        for key in wheel.advance(now):
+            released[key] = now
+
+    assert released == due
+    assert len(wheel) == 0
+
+
+async def test_online_counts_follow_heartbeats_and_members():
+    presence = Presence(timeout_secs=30, tick_secs=1, clock=lambda: 0)
+    db = ChatStorage(presence=presence)
+    cursor = await db.connect()
+    user = cursor.get_user(cursor.create_user())
+    other = cursor.get_user(cursor.create_user())
+    chat = cursor.get_chat(cursor.create_chat(name=""))
+    chat.enter(user)
+
+    assert presence.heartbeat(user.id, now=0)
+    assert not presence.heartbeat(user.id, now=20)
+    presence.heartbeat(other.id, now=30)
+    chat.enter(other)
+    assert chat.serialize()["online"] == 2
+
+    chat.leave(other)
+    assert presence.expire(now=45) == []
+    assert presence.expire(now=51) == [user.id]
+    assert chat.online == 0
+    assert len(presence) == 1
+
+
+async def test_heartbeat_keeps_user_online(event_loop):
+    server = Server()
+    token = (await server.register({}))["token"]
+
+    response = await server.parse(
+        "POST", "/heartbeat", json.dumps(dict(user_id=token))
+    )
+    status = await server.parse(
+        "GET", "/status", json.dumps(dict(user_id=token))
+    )
+    chats = await server.parse(
+        "GET", "/chats", json.dumps(dict(user_id=token))
+    )
+
+    assert response == {"timeout": server.database.presence.timeout_secs}
+    assert status["online_count"] == 1
+    assert chats["chats"][0]["online"] == 1
@@ -0,0 +1,130 @@
+import asyncio
+import json
+import os
+import pstats
+import time
+from datetime import datetime
+
+import pytest
+
+import profiling
+from client import ChatClient
+from server import Server
+
+
+def busy_wait(seconds: float) -> None:
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def make_record(pk: int, duration: float) -> profiling.ProfileRecord:
+    return profiling.ProfileRecord(
+        id=pk,
+        route="/send",
+        method="POST",
+        body_size=0,
+        cursor_wait=0,
+        duration=duration,
+        reason=profiling.SAMPLED,
+        created=datetime.now(),
+    )
+
+
+@pytest.fixture
+def server_kwargs(tmp_path):
+    profiler = profiling.Profiler(sample_every=1, directory=str(tmp_path))
+    return dict(profiler=profiler)
+
+
+def test_slowest_profiles_bounded():
+    slowest = profiling.SlowestProfiles(size=3)
+
+    for pk, duration in enumerate([0.5, 0.1, 0.9, 0.3, 0.7]):
+        slowest.add(make_record(pk, duration))
+
+    assert [record.duration for record in slowest.records()] == [
+        0.9,
+        0.7,
+        0.5,
+    ]
+
+
+def test_sampled_request_profiled():
+    profiler = profiling.Profiler(sample_every=2)
+
+    records = []
+    for _ in range(4):
+        trace = profiler.start("/send", "POST", "{}")
+        profiling.add_cursor_wait(0.25)
+        busy_wait(0.001)
+        records.append(profiler.finish(trace))
+
+    assert records[0] is None and records[2] is None
+    assert records[1].reason == profiling.SAMPLED
+    assert records[1].cursor_wait == 0.25
+    functions = [row["function"] for row in records[1].top_functions(10)]
+    assert any("busy_wait" in function for function in functions)
+
+
+def test_slow_request_stacks_sampled():
+    profiler = profiling.Profiler(threshold_secs=0.05, sampler_interval=0.001)
+    try:
+        fast = profiler.start("/status", "GET", "")
+        assert profiler.finish(fast) is None
+
+        slow = profiler.start("/chats", "GET", "")
+        busy_wait(0.1)
+        record = profiler.finish(slow)
+    finally:
+        profiler.close()
+
+    assert record.reason == profiling.SLOW
+    assert record.stats is None
+    assert any("busy_wait" in row["stack"] for row in record.top_stacks(5))
+
+
+@pytest.mark.asyncio
+async def test_profiles_endpoint(server, tmp_path):
+    client = ChatClient(server_port=server.port)
+    await client.signup()
+
+    response = json.loads(await client.get("/admin/profiles"))
+    dumped = json.loads(await client.post("/admin/profiles/dump"))
+
+    (connect,) = [
+        profile
+        for profile in response["profiles"]
+        if profile["route"] == "/connect"
+    ]
+    assert connect["functions"]
+    # the dump request itself is recorded after the files are written
+    assert len(dumped["paths"]) == len(server.profiler.slowest) - 1
+    for path in dumped["paths"]:
+        assert os.path.dirname(path) == str(tmp_path)
+        assert pstats.Stats(path).total_calls > 0
+
+
+@pytest.mark.asyncio
+async def test_profiles_endpoint_disabled(unused_tcp_port):
+    server = Server(port=unused_tcp_port)
+
+    assert "/admin/profiles" not in server.URL_METHOD_ACTION_MAP
+
+
+@pytest.mark.asyncio
+async def test_sampler_stopped_with_server(unused_tcp_port):
+    profiler = profiling.Profiler(threshold_secs=1, sampler_interval=0.001)
+    server = Server(port=unused_tcp_port, profiler=profiler)
+    serving = asyncio.ensure_future(server.startup())
+    await asyncio.sleep(0.01)
+    await ChatClient(server_port=server.port).signup()
+    sampler = profiler.sampler
+
+    server.sigint_handler()
+    await server.stopping
+    await serving
+    sampler.join(1)
+
+    assert profiler.sampler is None
+    assert not sampler.is_alive()
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+import protocol
+
+pytestmark = pytest.mark.asyncio
+
+
+def feed(*chunks: bytes) -> asyncio.StreamReader:
+    reader = asyncio.StreamReader(limit=64)
+    for chunk in chunks:
+        reader.feed_data(chunk)
+    reader.feed_eof()
+    return reader
+
+
+async def test_read_request():
+    data = protocol.encode_request(
+        "GET", "/chats", '{"user_id": 1}', {protocol.ACCEPT_ENCODING: "zlib"}
+    )
+
+    request = await protocol.read_request(feed(data))
+
+    assert request.method == "GET"
+    assert request.url == "/chats"
+    assert request.body == b'{"user_id": 1}'
+    assert request.headers[protocol.ACCEPT_ENCODING] == "zlib"
+
+
+async def test_read_request_empty():
+    assert await protocol.read_request(feed(b"")) is None
+
+
+async def test_read_pipelined_requests():
+    data = protocol.encode_request("POST", "/send", "{}") + (
+        protocol.encode_request("GET", "/status")
+    )
+    reader = feed(data)
+
+    first = await protocol.read_request(reader)
+    second = await protocol.read_request(reader)
+
+    assert (first.url, first.body) == ("/send", b"{}")
+    assert (second.url, second.body) == ("/status", b"")
+    assert await protocol.read_request(reader) is None
+
+
+async def test_read_head_over_limit():
+    data = protocol.encode_request("GET", "/chats", "", {"x-long": "a" * 100})
+
+    with pytest.raises(ValueError):
+        await protocol.read_request(feed(data))
+
+
+@pytest.mark.parametrize("length", ["-1", "ten", "1e3", ""])
+async def test_read_body_malformed_length(length):
+    data = b"POST /send\r\ncontent-length: %s\r\n\r\n{}" % length.encode()
+
+    with pytest.raises(ValueError, match="content length"):
+        await protocol.read_request(feed(data))
+
+
+async def test_read_body_over_limit():
+    data = protocol.encode_request("POST", "/send", "a" * 11)
+
+    assert (await protocol.read_request(feed(data), 11)).body == b"a" * 11
+    with pytest.raises(protocol.BodyTooLargeError):
+        await protocol.read_request(feed(data), 10)
+
+
+async def test_read_chunks_larger_than_limit():
+    payloads = [b"a" * 100, b"b", b"c" * 1000]
+    frames = [b"".join(protocol.encode_chunk(data)) for data in payloads]
+
+    reader = feed(*frames, protocol.LAST_CHUNK)
+
+    assert [frame async for frame in protocol.read_chunks(reader)] == payloads
+
+
+async def test_read_chunks_truncated():
+    reader = feed(b"".join(protocol.encode_chunk(b"abc")))
+
+    with pytest.raises(asyncio.IncompleteReadError):
+        [frame async for frame in protocol.read_chunks(reader)]
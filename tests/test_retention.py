@@ -0,0 +1,90 @@
+import uuid
+from datetime import timedelta
+
+import pytest
+
+import utils
+from constants import ChatType
+from db import ChatStorage, Message
+from retention import ExpiryIndex, Retention, RetentionPolicy
+
+pytestmark = pytest.mark.asyncio
+
+
+def message_at(created, expires=None) -> Message:
+    return Message(uuid.uuid4(), created, uuid.uuid4(), "", expires=expires)
+
+
+async def storage_with(**policy) -> tuple:
+    retention = Retention({ChatType.COMMON: RetentionPolicy(**policy)})
+    db = ChatStorage(retention=retention)
+    cursor = await db.connect()
+    chat = cursor.get_chat(cursor.create_chat(name=""))
+    return retention, cursor, chat
+
+
+async def test_index_releases_ended_buckets():
+    index = ExpiryIndex(bucket_secs=10)
+    index.add(25, "late")
+    index.add(3, "early")
+    index.add(7, "early too")
+
+    assert list(index.pop_due(19.9)) == ["early", "early too"]
+    assert not index.has_due(29.9)
+    assert list(index.pop_due(30)) == ["late"]
+    assert len(index) == 0
+
+
+async def test_last_messages_kept():
+    _, _, chat = await storage_with(max_messages=2)
+    messages = [message_at(utils.now()) for _ in range(3)]
+
+    for message in messages:
+        chat.add_message(message)
+
+    assert list(chat.messages.values()) == messages[1:]
+
+
+async def test_old_messages_expired():
+    retention, cursor, chat = await storage_with(max_age=timedelta(hours=1))
+    now = utils.now()
+    for minutes in (90, 70, 30):
+        chat.add_message(message_at(now - timedelta(minutes=minutes)))
+    etag = chat.etag
+
+    retention.expire(cursor, now, budget_secs=1)
+
+    assert len(chat.messages) == 1
+    assert retention.expired == 2
+    assert len(chat.serialize_since(etag)["deleted"]) == 2
+    assert not retention.has_due(now.timestamp())
+    assert retention.has_due((now + timedelta(hours=1)).timestamp())
+
+
+async def test_message_ttl():
+    retention, cursor, chat = await storage_with()
+    now = utils.now()
+    ephemeral = message_at(now, expires=now + timedelta(seconds=5))
+    chat.add_message(ephemeral)
+    chat.add_message(message_at(now))
+
+    retention.expire(cursor, now + timedelta(seconds=3), budget_secs=1)
+    assert ephemeral.id in chat.messages
+    retention.expire(cursor, now + timedelta(seconds=10), budget_secs=1)
+    assert ephemeral.id not in chat.messages
+    assert len(chat.messages) == 1
+
+
+async def test_expiry_sliced():
+    retention, cursor, chat = await storage_with(max_age=timedelta(hours=1))
+    now = utils.now()
+    for _ in range(3):
+        chat.add_message(message_at(now - timedelta(hours=2)))
+    chat.add_message(message_at(now, expires=now + timedelta(seconds=1)))
+    later = now + timedelta(seconds=3)
+
+    assert retention.expire(cursor, later, budget_secs=0)
+    assert len(chat.messages) == 3
+    while retention.expire(cursor, later, budget_secs=0):
+        pass
+    assert not chat.messages
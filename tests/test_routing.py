@@ -0,0 +1,80 @@
+import json
+import uuid
+
+import pytest
+
+from errors import ValidationError
+from routing import Schema, accepts, compile_routes, positive_int
+from server import Server
+
+
+def test_schema_parses_declared_fields():
+    schema = Schema(user_id=uuid.UUID, msg_count=positive_int)
+    user_id = uuid.uuid4()
+
+    request = dict(user_id=str(user_id), msg_count=3, other=1)
+
+    body = schema.validate(request)
+
+    assert body == dict(user_id=user_id, msg_count=3, other=1)
+    assert request["user_id"] == str(user_id)
+    assert schema.validate({}) == {}
+    with pytest.raises(ValidationError):
+        schema.validate(dict(msg_count=0))
+    with pytest.raises(ValidationError):
+        schema.validate([str(user_id)])
+
+
+def test_routes_keep_handler_schemas():
+    @accepts(user_id=uuid.UUID)
+    def handler(body: dict) -> dict:
+        return body
+
+    routes = compile_routes({"/a": {"GET": handler, "POST": dict}})
+
+    assert routes["GET", "/a"].schema is handler.schema
+    assert routes["POST", "/a"].schema is None
+    assert ("GET", "/b") not in routes
+
+
+@pytest.mark.asyncio
+async def test_ids_parsed_once(event_loop, mocker):
+    server = Server()
+    token = (await server.register({}))["token"]
+    parse_uuid = mocker.spy(uuid.UUID, "__init__")
+
+    response = await server.parse(
+        "GET", "/status", json.dumps(dict(user_id=token)).encode()
+    )
+    parsed = parse_uuid.call_count
+    invalid = await server.parse(
+        "GET", "/chats", json.dumps(dict(user_id=token, chat_id=1))
+    )
+
+    assert str(response["user"].id) == token
+    assert parsed == 1
+    assert invalid == {"fail": "Field chat_id is not valid"}
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "method, url, field, value",
+    [
+        ("GET", "/chats", "versions", "abc"),
+        ("GET", "/chats", "versions", {"chat": 1}),
+        ("GET", "/chats", "version", 1),
+        ("POST", "/send", "ttl", True),
+        ("POST", "/send", "ttl", "10"),
+    ],
+)
+async def test_invalid_fields_rejected(event_loop, method, url, field, value):
+    server = Server()
+    token = (await server.register({}))["token"]
+    chat_id = server.database.default_chat_id
+    body = dict(user_id=token, author_id=token, chat_id=chat_id, message="")
+
+    response = await server.parse(
+        method, url, json.dumps(dict(body, **{field: value}))
+    )
+
+    assert response == {"fail": f"Field {field} is not valid"}
@@ -0,0 +1,108 @@
+import asyncio
+import json
+
+import pytest
+
+import traffic
+from client import ChatClient
+from server import Server
+
+TEST_MESSAGE = "recorded message"
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def start_server(event_loop, unused_tcp_port_factory):
+    """Starts servers in pytest event loop"""
+    handles = []
+
+    async def start(**kwargs) -> Server:
+        server = Server(port=unused_tcp_port_factory(), **kwargs)
+        handles.append(asyncio.ensure_future(server.startup()))
+        await asyncio.sleep(0.01)
+        return server
+
+    yield start
+    for handle in handles:
+        handle.cancel()
+    event_loop.run_until_complete(asyncio.sleep(0.01))
+
+
+async def record_conversation(port: int) -> str:
+    client, other = ChatClient(server_port=port), ChatClient(server_port=port)
+    await client.signup()
+    await other.signup()
+    response = await client.post(
+        "/connect_p2p",
+        data=dict(user_id=client.uuid, other_user_id=other.uuid),
+    )
+    chat_id = json.loads(response)["chat_id"]
+    await other.post_send(chat_id=chat_id, message=TEST_MESSAGE)
+    await client.get("/chats", data=dict(user_id=client.uuid, chat_id=chat_id))
+    return chat_id
+
+
+async def test_recorded_ids(start_server, tmp_path):
+    path = str(tmp_path / "traffic.jsonl")
+    recorder = traffic.TrafficRecorder(path)
+    server = await start_server(recorder=recorder)
+
+    chat_id = await record_conversation(server.port)
+    recorder.close()
+
+    entries = list(traffic.read_capture(path))
+    assert [entry["url"] for entry in entries] == [
+        "/connect",
+        "/connect",
+        "/connect_p2p",
+        "/send",
+        "/chats",
+    ]
+    assert entries[2]["ids"] == {"chat_id": chat_id}
+    assert entries[3]["body"]["chat_id"] == chat_id
+    assert set(entries[3]["headers"]) == {"idempotency-key"}
+    assert entries[1]["ts"] >= entries[0]["ts"]
+
+
+
+async def test_capture_closed_with_server(start_server, tmp_path):
+    path = str(tmp_path / "traffic.jsonl")
+    recorder = traffic.TrafficRecorder(path)
+    server = await start_server(recorder=recorder)
+    await record_conversation(server.port)
+
+    server.sigint_handler()
+    await server.stopping
+    await asyncio.sleep(0.01)
+
+    assert recorder.file.closed
+    assert len(list(traffic.read_capture(path))) == 5
+
+@pytest.mark.parametrize("speed", [0, 100])
+async def test_replay_remaps_ids(start_server, tmp_path, speed):
+    path = str(tmp_path / "traffic.jsonl")
+    recorder = traffic.TrafficRecorder(path)
+    recording = await start_server(recorder=recorder)
+    await record_conversation(recording.port)
+    recorder.close()
+    fresh = await start_server()
+
+    replayer = traffic.Replayer(ChatClient(server_port=fresh.port), speed)
+    await replayer.replay(traffic.read_capture(path))
+
+    assert sum(replayer.failures.values()) == 0
+    assert len(fresh.database.users) == 2
+    # posts were replayed with their recorded idempotency keys
+    keyed = [
+        entry
+        for entry in traffic.read_capture(path)
+        if "idempotency-key" in entry.get("headers", {})
+    ]
+    assert len(fresh.idempotency) == len(keyed) > 0
+    (message,) = [
+        message
+        for chat in fresh.database.chats.values()
+        for message in chat.messages.values()
+    ]
+    assert message.text == TEST_MESSAGE
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+
+from client import ChatClient
+from partition import p2p_chat_id
+from workers import WorkerServer, owner
+
+TEST_WORKERS = 2
+TEST_MESSAGE = "test message"
+
+pytestmark = pytest.mark.asyncio
+
+
+@pytest.fixture
+def workers(event_loop, unused_tcp_port_factory, tmp_path):
+    """Fires up worker servers on separate ports in pytest event loop"""
+    default_chat_id = str(uuid.uuid4())
+    servers = [
+        WorkerServer(
+            port=unused_tcp_port_factory(),
+            index=index,
+            workers=TEST_WORKERS,
+            ipc_dir=str(tmp_path),
+            default_chat_id=default_chat_id,
+            reuse_port=False,
+        )
+        for index in range(TEST_WORKERS)
+    ]
+    handles = [
+        asyncio.ensure_future(server.startup(), loop=event_loop)
+        for server in servers
+    ]
+    event_loop.run_until_complete(asyncio.sleep(0.05))
+    yield servers
+    for handle in handles:
+        handle.cancel()
+    event_loop.run_until_complete(asyncio.sleep(0.01))
+
+
+@pytest.fixture
+async def clients(workers):
+    """Signs up one client on every worker"""
+    clients = [ChatClient(server_port=server.port) for server in workers]
+    for client in clients:
+        await client.signup()
+    return workers, clients
+
+
+async def test_p2p_chat_id_symmetric():
+    user_id, other_user_id = str(uuid.uuid4()), str(uuid.uuid4())
+
+    assert p2p_chat_id(user_id, other_user_id) == p2p_chat_id(
+        other_user_id, user_id
+    )
+    assert p2p_chat_id(user_id, other_user_id) != p2p_chat_id(
+        user_id, str(uuid.uuid4())
+    )
+
+
+async def test_users_replicated(clients):
+    workers, clients = await clients
+
+    for server in workers:
+        assert {uuid.UUID(client.uuid) for client in clients} == set(
+            server.database.users
+        )
+
+
+async def test_default_chat_replicated(clients):
+    workers, (client, client_other) = await clients
+    data = dict(author_id=client.uuid, chat_id=None, message=TEST_MESSAGE)
+
+    await client.post("/send", data=data)
+
+    response = await client_other.get(
+        "/chats", data=dict(user_id=client_other.uuid)
+    )
+    default = json.loads(response)["chats"][0]
+    assert len(default["authors"]) == TEST_WORKERS
+    assert [msg["text"] for msg in default["messages"]] == [TEST_MESSAGE]
+
+
+async def test_p2p_forwarded_to_owner(clients):
+    workers, (client, client_other) = await clients
+    response = await client.post(
+        "/connect_p2p",
+        data=dict(user_id=client.uuid, other_user_id=client_other.uuid),
+    )
+    chat_id = json.loads(response)["chat_id"]
+    data = dict(author_id=client.uuid, chat_id=chat_id, message=TEST_MESSAGE)
+
+    for sender in (client, client_other):
+        await sender.post("/send", data=data)
+
+    chat_owner = workers[owner(chat_id, TEST_WORKERS)]
+    assert len(chat_owner.database.chats[uuid.UUID(chat_id)].messages) == 2
+    for server in workers:
+        if server is not chat_owner:
+            assert uuid.UUID(chat_id) not in server.database.chats
+    for reader in (client, client_other):
+        response = await reader.get("/chats", data=dict(user_id=reader.uuid))
+        assert len(json.loads(response)["chats"]) == 2
+        response = await reader.get("/status", data=dict(user_id=reader.uuid))
+        assert json.loads(response)["chats_count"] == 2
+
+
+async def test_internal_urls_rejected(clients):
+    _, (client, _) = await clients
+
+    response = await client.post(
+        "/_internal/leave", data=dict(user_id=client.uuid)
+    )
+
+    assert "fail" in json.loads(response)
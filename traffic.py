@@ -0,0 +1,225 @@
+"""Recording of served requests and their replay against a server.
+
+A capture is a JSON-lines file with a request per line:
+
+    {"ts": 1700000000.25, "method": "POST", "url": "/send",
+     "headers": {"idempotency-key": "..."},
+     "body": {"author_id": "...", "message": "hi"}, "ids": {"id": "..."}}
+
+`ts` is the time the request arrived at, so gaps between requests do
+not include the time the server took to answer them. Headers are kept
+except those of the connection, which the replaying client sets itself.
+
+`ids` keeps the UUIDs the server answered with (user tokens, chat and
+message ids), so a replay against a fresh storage can map every recorded
+id onto the one the new server hands out. A request waits for the
+response that creates the ids it refers to.
+
+Usage:
+    python server.py --record traffic.jsonl
+    python traffic.py traffic.jsonl --port 8001 --speed 10
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import Counter, defaultdict
+from typing import Any, Iterator
+
+import protocol
+from client import AsyncClient
+
+logger = logging.getLogger(__name__)
+
+UUID_LENGTH = 36
+# a replay should not queue requests the recorded clients sent at once
+REPLAY_POOL_SIZE = 1000
+CONNECTION_HEADERS = (protocol.CONTENT_LENGTH, protocol.CONNECTION)
+
+
+def is_uuid(value: Any) -> bool:
+    if isinstance(value, uuid.UUID):
+        return True
+    if not isinstance(value, str) or len(value) != UUID_LENGTH:
+        return False
+    try:
+        uuid.UUID(value)
+    except ValueError:
+        return False
+    return True
+
+
+def response_ids(response: Any) -> dict[str, str]:
+    """Top-level UUID fields of a response"""
+    if not isinstance(response, dict):
+        return {}
+    return {
+        key: str(value) for key, value in response.items() if is_uuid(value)
+    }
+
+
+def iter_strings(value: Any) -> Iterator[str]:
+    if isinstance(value, dict):
+        value = value.values()
+    elif not isinstance(value, list):
+        if isinstance(value, str):
+            yield value
+        return
+    for item in value:
+        yield from iter_strings(item)
+
+
+class TrafficRecorder:
+    """Appends served requests to a capture file"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        # line buffered, a killed server loses at most the current request
+        self.file = open(path, "a", buffering=1)
+
+    def record(self, request: protocol.Request, response: Any) -> None:
+        try:
+            body = json.loads(request.body) if request.body else {}
+        except ValueError:
+            body = request.body.decode(errors="replace")
+        entry = dict(
+            ts=request.received,
+            method=request.method,
+            url=request.url,
+            body=body,
+        )
+        headers = {
+            name: value
+            for name, value in request.headers.items()
+            if name not in CONNECTION_HEADERS
+        }
+        if headers:
+            entry.update(headers=headers)
+        if ids := response_ids(response):
+            entry.update(ids=ids)
+        self.file.write(json.dumps(entry, default=str) + "\n")
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def read_capture(path: str) -> Iterator[dict]:
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+class Replayer:
+    """Sends captured requests keeping their relative timing
+
+    `speed` compresses time: 2 replays twice as fast, 0 sends every
+    request as soon as the ids it refers to are known.
+    """
+
+    def __init__(self, client: AsyncClient, speed: float = 1.0) -> None:
+        self.client = client
+        self.speed = speed
+        self.ids: dict[str, asyncio.Future] = {}
+        self.latencies = defaultdict(list)
+        self.failures = Counter()
+
+    async def remap(self, value: Any) -> Any:
+        if isinstance(value, dict):
+            return {
+                key: await self.remap(item) for key, item in value.items()
+            }
+        if isinstance(value, list):
+            return [await self.remap(item) for item in value]
+        if isinstance(value, str) and value in self.ids:
+            return await self.ids[value]
+        return value
+
+    async def send(self, entry: dict) -> None:
+        body = await self.remap(entry["body"])
+        if not isinstance(body, str):
+            body = json.dumps(body) if body else ""
+        started = time.perf_counter()
+        response = None
+        try:
+            response = json.loads(
+                await self.client.send(
+                    f"{entry['method']} {entry['url']} {body}",
+                    entry.get("headers"),
+                )
+            )
+        except (OSError, EOFError, ValueError):
+            logger.exception("Replay of %s failed", entry["url"])
+        self.latencies[entry["url"]].append(time.perf_counter() - started)
+        if not isinstance(response, dict) or "fail" in response:
+            self.failures[entry["url"]] += 1
+            response = {}
+
+        for key, old in entry.get("ids", {}).items():
+            future = self.ids.get(old)
+            if future is not None and not future.done():
+                new = response.get(key)
+                future.set_result(str(new) if new is not None else old)
+
+    async def replay(self, entries: Iterator[dict]) -> None:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        first_ts = None
+        tasks = []
+        for entry in entries:
+            first_ts = entry["ts"] if first_ts is None else first_ts
+            if self.speed:
+                due = started + (entry["ts"] - first_ts) / self.speed
+                if (delay := due - loop.time()) > 0:
+                    await asyncio.sleep(delay)
+            # ids the request refers to itself are not created by it
+            referenced = set(iter_strings(entry["body"]))
+            for old in entry.get("ids", {}).values():
+                if old not in referenced:
+                    self.ids.setdefault(old, loop.create_future())
+            tasks.append(asyncio.create_task(self.send(entry)))
+        await asyncio.gather(*tasks)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("capture", help="JSON-lines file to replay")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="time compression factor, 0 to send as fast as possible",
+    )
+    args = parser.parse_args()
+
+    replayer = Replayer(
+        AsyncClient(
+            server_host=args.host,
+            server_port=args.port,
+            pool_size=REPLAY_POOL_SIZE,
+        ),
+        speed=args.speed,
+    )
+    started = time.perf_counter()
+    asyncio.run(replayer.replay(read_capture(args.capture)))
+    elapsed = time.perf_counter() - started
+
+    total = sum(map(len, replayer.latencies.values()))
+    print(f"replayed {total} requests in {elapsed:.1f}s")
+    for url, latencies in sorted(replayer.latencies.items()):
+        latencies.sort()
+        print(
+            f"{url} | {len(latencies)} | failed {replayer.failures[url]}"
+            f" | p50 {latencies[len(latencies) // 2] * 1000:.3f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
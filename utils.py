@@ -1,15 +1,54 @@
 import json
 from datetime import datetime
+from typing import Iterable, Iterator
 
-import pytz
-
+from clock import default_clock
 from db import DbEncoder
-from settings import DEFAULT_TZ
 
 
 def serialize(data: dict) -> str:
     return json.dumps(data, indent=2, cls=DbEncoder)
 
 
+class JsonLines:
+    """Response streamed as one compact JSON document per line"""
+
+    def __init__(self, items: Iterable) -> None:
+        self.items = items
+
+    def iterencode(self) -> Iterator[str]:
+        encoder = DbEncoder(separators=(",", ":"))
+        for item in self.items:
+            yield from encoder.iterencode(item)
+            yield "\n"
+
+
+def iter_serialize(
+    data: dict | JsonLines | str, chunk_size: int
+) -> Iterator[bytes]:
+    """Lazily serializes data into encoded chunks of about chunk_size
+
+    Text responses are sent as is.
+    """
+    buffer, size = [], 0
+    if isinstance(data, str):
+        pieces = (
+            data[start:start + chunk_size]
+            for start in range(0, len(data), chunk_size)
+        )
+    elif isinstance(data, JsonLines):
+        pieces = data.iterencode()
+    else:
+        pieces = DbEncoder(indent=2).iterencode(data)
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield "".join(buffer).encode()
+            buffer, size = [], 0
+    if buffer:
+        yield "".join(buffer).encode()
+
+
 def now() -> datetime:
-    return pytz.timezone(DEFAULT_TZ).localize(datetime.now())
+    return default_clock.now()
@@ -0,0 +1,138 @@
+"""Multi-process server mode.
+
+Worker processes share the listening port via SO_REUSEPORT. Every chat
+but the default one is owned by a single worker (chat id modulo worker
+count) and requests for chats owned by another worker are forwarded to it
+over a Unix socket. Users and the default chat are replicated to every
+worker, so any of them can validate authors and serve the common chat.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import uuid
+from typing import Any
+
+import protocol
+from client import AsyncClient
+from db import DbEncoder
+from partition import INTERNAL_PREFIX, PartitionedServer
+
+WORKER = "worker"
+PEER_WAIT_SECS = 0.01
+
+logger = logging.getLogger(__name__)
+
+
+def owner(pk: str | uuid.UUID, workers: int) -> int:
+    return uuid.UUID(str(pk)).int % workers
+
+
+class WorkerServer(PartitionedServer):
+    def __init__(
+        self,
+        *args,
+        index: int,
+        workers: int,
+        ipc_dir: str,
+        default_chat_id: str,
+        **kwargs,
+    ):
+        kwargs.setdefault("reuse_port", True)
+        super().__init__(
+            *args, node=index, default_chat_id=default_chat_id, **kwargs
+        )
+        self.index = index
+        self.workers = workers
+        self.ipc_dir = ipc_dir
+        self.peers = {
+            peer: AsyncClient(unix_path=self.ipc_path(peer), limit=self.limit)
+            for peer in range(workers)
+            if peer != index
+        }
+
+    def ipc_path(self, index: int) -> str:
+        return os.path.join(self.ipc_dir, f"worker-{index}.sock")
+
+    def owner_of(self, pk: str | uuid.UUID) -> int:
+        return owner(pk, self.workers)
+
+    def peer_nodes(self) -> list[int]:
+        return list(self.peers)
+
+    async def call(
+        self, node: int, method: str, url: str, body: str = ""
+    ) -> dict:
+        response = await self.peers[node].send(f"{method} {url} {body}")
+        return json.loads(response)
+
+    async def replicate(self, topic: str, data: dict) -> None:
+        body = json.dumps(data, cls=DbEncoder)
+        await asyncio.gather(
+            *(
+                self.call(peer, "POST", f"{INTERNAL_PREFIX}{topic}", body)
+                for peer in self.peers
+            )
+        )
+
+    async def start_internal_server(self) -> asyncio.AbstractServer:
+        return await protocol.start_unix_server(
+            self.internal_connected_callback,
+            path=self.ipc_path(self.index),
+            limit=self.limit,
+        )
+
+    async def before_serving(self) -> None:
+        """Waits for the sockets of every other worker"""
+        while not all(map(os.path.exists, map(self.ipc_path, self.peers))):
+            await asyncio.sleep(PEER_WAIT_SECS)
+
+
+def run_worker(
+    index: int, workers: int, ipc_dir: str, default_chat_id: str, **kwargs
+) -> None:
+    server = WorkerServer(
+        index=index,
+        workers=workers,
+        ipc_dir=ipc_dir,
+        default_chat_id=default_chat_id,
+        **kwargs,
+    )
+    asyncio.run(server.startup())
+
+
+def terminate_handler(signum: int, frame: Any) -> None:
+    raise SystemExit(signum)
+
+
+def run_workers(workers: int, **kwargs) -> None:
+    """Forks worker processes and waits for them to finish"""
+    ipc_dir = tempfile.mkdtemp(prefix="yachat-")
+    default_chat_id = str(uuid.uuid4())
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(
+            target=run_worker,
+            args=(index, workers, ipc_dir, default_chat_id),
+            kwargs=kwargs,
+            name=f"{WORKER}-{index}",
+        )
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    signal.signal(signal.SIGTERM, terminate_handler)
+    try:
+        for process in processes:
+            process.join()
+    except (KeyboardInterrupt, SystemExit):
+        logger.warning("Stopping workers")
+        for process in processes:
+            process.terminate()
+            process.join()
+    finally:
+        shutil.rmtree(ipc_dir, ignore_errors=True)